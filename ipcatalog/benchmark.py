@@ -0,0 +1,446 @@
+import argparse
+import contextlib
+import functools
+import io
+import ipaddress
+import itertools
+import json
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zlib
+
+import ipcatalog
+
+ASN_COUNT: int = 2000
+"""Number of distinct synthetic ASNs"""
+
+ASN_CUM_WEIGHTS: list[float] = list(itertools.accumulate(
+        1 / rank for rank in range(1, ASN_COUNT + 1)))
+"""Zipf weights, so the biggest ASN has about an eighth of the clusters"""
+
+SYNTHETIC_COUNTRIES: tuple[tuple[str, str], ...] = (
+    ("US", "ARIN"), ("CN", "APNIC"), ("RU", "RIPE"), ("DE", "RIPE"),
+    ("NL", "RIPE"), ("BR", "LACNIC"), ("IN", "APNIC"), ("VN", "APNIC"),
+    ("FR", "RIPE"), ("GB", "RIPE"), ("KR", "APNIC"), ("ZA", "AFRINIC"),
+)
+"""(country code, RIR) pairs the synthetic ASNs are spread over"""
+
+CLASSIFICATION_WEIGHTS: dict[str, int] = {"b": 1, "pb": 4, "s": 3, "m": 2}
+"""How often each classification is picked for a synthetic IP"""
+
+RDNS_RATE: int = 7
+"""Out of 10, how many synthetic IPs have a PTR record"""
+
+ADD_COUNT: int = 1000
+"""Default number of IPs added one at a time by the add benchmark"""
+
+REGRESSION_RATIO: float = 1.25
+REGRESSION_MIN_SECONDS: float = 0.01
+"""
+A timing is flagged as slower than the compared run if it took
+REGRESSION_RATIO times as long and at least REGRESSION_MIN_SECONDS more,
+so the noise of millisecond timings isn't flagged.
+"""
+
+def synthetic_asn(rank: int) -> tuple[int, str, str, str]:
+    """
+    :return: The (asn, cc, rir, isp) of the rank-th biggest synthetic ASN.
+    """
+    rng: random.Random = random.Random(rank)
+    cc, rir = rng.choice(SYNTHETIC_COUNTRIES)
+    return (64512 + rank if rank < 1000 else 4200000000 + rank, cc, rir,
+            f"Synthetic Networks {rank} {cc}")
+
+@functools.lru_cache(maxsize=None)
+def synthetic_cluster(network: typing.Union[ipaddress.IPv4Network,
+                                            ipaddress.IPv6Network]) \
+        -> ipcatalog.BgpToolsRecord:
+    """
+    :return: The bgp.tools record of a synthetic /16 or /48, always the
+             same for the same network.
+    """
+    rank: int = random.Random(int(network.network_address)).choices(
+            range(ASN_COUNT), cum_weights=ASN_CUM_WEIGHTS)[0]
+    asn, cc, rir, isp = synthetic_asn(rank)
+    return (str(asn), str(network), cc, rir, isp)
+
+def synthetic_record(ip_address_obj: typing.Union[ipaddress.IPv4Address,
+                                                  ipaddress.IPv6Address]) \
+        -> ipcatalog.BgpToolsRecord:
+    """
+    :return: The bgp.tools record the fake whois server gives an IP.
+    """
+    return synthetic_cluster(ipaddress.ip_network(
+            (ip_address_obj, 16 if ip_address_obj.version == 4 else 48),
+            strict=False))
+
+def synthetic_rdns(ip_address_obj: typing.Union[ipaddress.IPv4Address,
+                                                ipaddress.IPv6Address]) \
+        -> typing.Optional[str]:
+    """
+    :return: The PTR record the fake DNS server gives an IP, if any.
+    """
+    if zlib.crc32(ip_address_obj.packed) % 10 >= RDNS_RATE:
+        return None
+    return ("ip-" + str(ip_address_obj).replace(".", "-").replace(":", "-") +
+            f".as{synthetic_record(ip_address_obj)[0]}.example.net")
+
+def generate_rows(row_count: int, seed: int = 0) -> typing.Iterator[tuple]:
+    """
+    Generates synthetic ipaddress rows, clustered into a few thousand /16s
+    like scanner traffic tends to be, with about a fifth of them IPv6. The
+    clusters belong to a Zipf distribution of ASNs and the enrichment matches
+    what the fake servers answer.
+
+    :param row_count: The number of rows to generate.
+    :param seed: Seed for the random number generator.
+    :return: Rows ready for ipcatalog.UPSERT_IP_STATEMENT.
+    """
+    rng: random.Random = random.Random(seed)
+    ipv4_clusters: list[int] = [rng.randint(1, 0xdfff) << 16
+                                for _ in range(4096)]
+    ipv6_clusters: list[int] = [(0x2000 + rng.randint(0, 0xfff)) << 112 |
+                                rng.randint(0, 2**32 - 1) << 80
+                                for _ in range(1024)]
+    scores: list[int] = [ipcatalog.CLASSIFICATION_TO_SCORE[classification]
+                         for classification in CLASSIFICATION_WEIGHTS]
+    score_weights: list[int] = list(CLASSIFICATION_WEIGHTS.values())
+    for _ in range(row_count):
+        ip_address_obj: typing.Union[ipaddress.IPv4Address,
+                                     ipaddress.IPv6Address]
+        if rng.random() < 0.8:
+            ip_address_obj = ipaddress.IPv4Address(
+                    rng.choice(ipv4_clusters) | rng.randint(0, 0xffff))
+        else:
+            ip_address_obj = ipaddress.IPv6Address(
+                    rng.choice(ipv6_clusters) | rng.randint(0, 2**64 - 1))
+        asn, prefix, cc, rir, isp = synthetic_record(ip_address_obj)
+        yield (str(ip_address_obj), ip_address_obj.version,
+               ip_address_obj.packed, int(asn), prefix, cc, rir, isp,
+               synthetic_rdns(ip_address_obj),
+               rng.choices(scores, score_weights)[0], 1)
+
+class FakeWhoisHandler(socketserver.StreamRequestHandler):
+    """
+    Answers bgp.tools bulk whois queries with synthetic records.
+    """
+    wbufsize: int = 64 * 1024
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            query: str = line.decode("utf-8", "replace").strip()
+            if query == "begin" or query == "":
+                continue
+            if query == "end":
+                break
+            try:
+                ip_address_obj: typing.Union[ipaddress.IPv4Address,
+                                             ipaddress.IPv6Address] = \
+                        ipaddress.ip_address(query)
+            except ValueError:
+                continue
+            asn, prefix, cc, rir, isp = synthetic_record(ip_address_obj)
+            self.wfile.write((f"{asn:<10}| {query:<39}| {prefix:<18}| " +
+                              f"{cc} | {rir:<7}| 2020-01-01 | {isp}\n"
+                              ).encode("utf-8"))
+
+class FakeDnsHandler(socketserver.BaseRequestHandler):
+    """
+    Answers PTR queries with synthetic hostnames, or NXDOMAIN for the IPs
+    without one.
+    """
+
+    def handle(self) -> None:
+        query, dns_sock = self.request
+        try:
+            name, offset = ipcatalog.read_dns_name(query, 12)
+            labels: list[str] = name.lower().split(".")
+            ip_address_obj: typing.Union[ipaddress.IPv4Address,
+                                         ipaddress.IPv6Address]
+            if labels[-2:] == ["in-addr", "arpa"]:
+                ip_address_obj = ipaddress.IPv4Address(
+                        ".".join(reversed(labels[:-2])))
+            else:
+                ip_address_obj = ipaddress.IPv6Address(int(
+                        "".join(reversed(labels[:-2])), 16))
+        except (IndexError, ValueError):
+            return
+        hostname: typing.Optional[str] = synthetic_rdns(ip_address_obj)
+        question: bytes = query[12:offset + 4]
+        if hostname is None:
+            dns_sock.sendto(query[:2] + b"\x81\x83\x00\x01\x00\x00" +
+                            b"\x00\x00\x00\x00" + question,
+                            self.client_address)
+            return
+        rdata: bytes = b"".join(
+                len(label).to_bytes(1, "big") + label.encode("ascii")
+                for label in hostname.split(".")) + b"\x00"
+        dns_sock.sendto(query[:2] + b"\x81\x80\x00\x01\x00\x01\x00\x00" +
+                        b"\x00\x00" + question +
+                        b"\xc0\x0c\x00\x0c\x00\x01\x00\x00\x0e\x10" +
+                        len(rdata).to_bytes(2, "big") + rdata,
+                        self.client_address)
+
+class FakeWhoisServer(socketserver.ThreadingTCPServer):
+    daemon_threads: bool = True
+    allow_reuse_address: bool = True
+
+class FakeDnsServer(socketserver.ThreadingUDPServer):
+    daemon_threads: bool = True
+
+@contextlib.contextmanager
+def serve(server: socketserver.BaseServer) \
+        -> typing.Iterator[tuple[str, int]]:
+    """
+    Runs a server on a background thread for the duration of the block.
+
+    :return: The (host, port) the server listens on.
+    """
+    server_thread: threading.Thread = threading.Thread(
+            target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        yield server.server_address[:2]
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+def populate(shell: ipcatalog.IpCatalogShell, row_count: int) -> None:
+    """
+    Fills the shell's database with synthetic rows.
+    """
+    shell.init_db()
+    assert shell.database is not None
+    with shell.database:
+        shell.upsert_ips(generate_rows(row_count))
+
+def time_call(function: typing.Callable[[], typing.Any]) -> float:
+    """
+    :return: The wall time in seconds of calling the function, with its
+             output discarded.
+    """
+    start_time: float = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    return time.perf_counter() - start_time
+
+def benchmark_add(shell: ipcatalog.IpCatalogShell,
+                  add_count: int) -> dict[str, float]:
+    """
+    Times adding new IPs one command at a time, and how long until their
+    enrichment from the fake servers is written.
+    """
+    rows: list[tuple] = list(generate_rows(add_count, seed=1))
+
+    def add_all() -> None:
+        for row in rows:
+            shell.do_add(f"{row[0]} " +
+                         ipcatalog.SCORE_TO_CLASSIFICATION[row[9]])
+
+    def wait_for_enrichment() -> None:
+        assert shell.enrichment_queue is not None
+        shell.enrichment_queue.wait()
+
+    add_time: float = time_call(add_all)
+    return {"add": add_time,
+            "add enriched": add_time + time_call(wait_for_enrichment)}
+
+def benchmark_write_modes(shell: ipcatalog.IpCatalogShell,
+                          add_count: int) -> dict[str, float]:
+    """
+    Times adding IPs one command at a time, without enrichment, with the
+    rollback journal and full fsync that databases used to open with, with
+    WAL, and with WAL and batched commits.
+    """
+    assert shell.database is not None
+    lookups: tuple[bool, bool, bool] = (shell.rdns_lookup,
+                                        shell.bgp_tools_lookup,
+                                        shell.routes_lookup)
+    shell.rdns_lookup = shell.bgp_tools_lookup = shell.routes_lookup = False
+
+    def add_all(seed: int) -> None:
+        for row in generate_rows(add_count, seed):
+            shell.do_add(f"{row[0]} " +
+                         ipcatalog.SCORE_TO_CLASSIFICATION[row[9]])
+
+    def add_all_batched() -> None:
+        shell.do_batch("1000 200")
+        add_all(4)
+        shell.do_batch("off")
+
+    shell.database.execute("PRAGMA journal_mode=DELETE;")
+    shell.database.execute("PRAGMA synchronous=FULL;")
+    results: dict[str, float] = {
+        "add rollback journal": time_call(lambda: add_all(2)),
+    }
+    shell.database.execute("PRAGMA journal_mode=WAL;")
+    shell.database.execute("PRAGMA synchronous=NORMAL;")
+    results["add wal"] = time_call(lambda: add_all(3))
+    results["add wal batched"] = time_call(add_all_batched)
+    shell.rdns_lookup, shell.bgp_tools_lookup, shell.routes_lookup = lookups
+    return results
+
+def benchmark_get(shell: ipcatalog.IpCatalogShell,
+                  temp_dir: str) -> dict[str, float]:
+    """
+    Times get with a wildcard, CIDR ranges, an ASN filter and a csv dump.
+    """
+    first_row: tuple = next(generate_rows(1))
+    ipv4_row: tuple = next(row for row in generate_rows(100)
+                           if row[1] == 4)
+    ipv6_row: tuple = next(row for row in generate_rows(100)
+                           if row[1] == 6)
+    ipv4_octets: list[str] = ipv4_row[0].split(".")
+    ipv6_network: ipaddress.IPv6Network = ipaddress.ip_network(
+            (ipv6_row[0], 32), strict=False)
+    csv_path: str = os.path.join(temp_dir, "catalog.csv")
+    return {
+        "get wildcard": time_call(lambda: shell.do_get(
+                f"{ipv4_octets[0]}.{ipv4_octets[1]}.%")),
+        "get cidr /16": time_call(lambda: shell.do_get(
+                f"{ipv4_octets[0]}.{ipv4_octets[1]}.0.0/16")),
+        "get cidr /8": time_call(lambda: shell.do_get(
+                f"{ipv4_octets[0]}.0.0.0/8")),
+        "get cidr6 /32": time_call(lambda: shell.do_get(str(ipv6_network))),
+        "get asn": time_call(lambda: shell.do_get(
+                f"asn={first_row[3]} score>=s")),
+        "get csv": time_call(lambda: shell.do_get(
+                f"--format csv --output {csv_path}")),
+    }
+
+def benchmark_subnet(shell: ipcatalog.IpCatalogShell) -> dict[str, float]:
+    """
+    Times subnet4 and subnet6 at common prefix lengths.
+    """
+    results: dict[str, float] = {}
+    for subnet_length in (8, 16, 24):
+        results[f"subnet4 {subnet_length}"] = time_call(
+                lambda: shell.do_subnet4(str(subnet_length)))
+    for subnet_length in (32, 48, 64):
+        results[f"subnet6 {subnet_length}"] = time_call(
+                lambda: shell.do_subnet6(str(subnet_length)))
+    return results
+
+def benchmark_export(shell: ipcatalog.IpCatalogShell,
+                     temp_dir: str) -> dict[str, float]:
+    """
+    Times the nftables blocklist with subnets and a snapshot.
+    """
+    return {
+        "export nftables": time_call(lambda: shell.do_export(
+                "nftables " + os.path.join(temp_dir, "blocklist.nft") +
+                " 3 24 64")),
+        "snapshot": time_call(lambda: shell.do_snapshot(
+                os.path.join(temp_dir, "ipcatalog.snap"))),
+    }
+
+def benchmark_del(shell: ipcatalog.IpCatalogShell) -> dict[str, float]:
+    """
+    Times deleting two clusters of IPs, one by wildcard and one by CIDR.
+    """
+    ipv4_rows: list[tuple] = [row for row in generate_rows(100)
+                              if row[1] == 4]
+    wildcard_octets: list[str] = ipv4_rows[1][0].split(".")
+    cidr_octets: list[str] = ipv4_rows[2][0].split(".")
+    return {
+        "del wildcard": time_call(lambda: shell.do_del(
+                f"{wildcard_octets[0]}.{wildcard_octets[1]}.%")),
+        "del cidr /16": time_call(lambda: shell.do_del(
+                f"{cidr_octets[0]}.{cidr_octets[1]}.0.0/16")),
+    }
+
+def compare_results(old_results: dict[str, dict[str, float]],
+                    results: dict[str, dict[str, float]]) -> None:
+    """
+    Prints how each timing changed from an earlier run to stderr.
+    """
+    for row_count, timings in results.items():
+        for name, seconds in timings.items():
+            old_seconds: typing.Optional[float] = \
+                    old_results.get(row_count, {}).get(name)
+            if old_seconds is None or old_seconds == 0:
+                continue
+            slower: bool = seconds > old_seconds * REGRESSION_RATIO and \
+                    seconds - old_seconds >= REGRESSION_MIN_SECONDS
+            print(f"{row_count} rows {name}: {old_seconds:.3f}s -> " +
+                  f"{seconds:.3f}s " +
+                  f"({(seconds - old_seconds) / old_seconds:+.0%})" +
+                  (" SLOWER" if slower else ""), file=sys.stderr)
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser()
+    argparser.add_argument("--rows", type=int, nargs="+",
+                           default=[10000, 100000, 1000000],
+                           help="Catalog sizes to benchmark.")
+    argparser.add_argument("--adds", type=int, default=ADD_COUNT,
+                           help="Number of IPs the add benchmark adds.")
+    argparser.add_argument("--output", default=None,
+                           help="Also write the JSON results to this file.")
+    argparser.add_argument("--compare", default=None,
+                           help="JSON results of an earlier run to compare " +
+                           "against.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
+    old_results: typing.Optional[dict[str, dict[str, float]]] = None
+    if parsedargs["compare"] is not None:
+        try:
+            with open(parsedargs["compare"]) as compare_file:
+                old_results = json.load(compare_file)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Could not read {parsedargs['compare']}: {e}",
+                  file=sys.stderr)
+            return 1
+
+    results: dict[str, dict[str, float]] = {}
+    with serve(FakeWhoisServer(("127.0.0.1", 0), FakeWhoisHandler)) \
+            as whois_address, \
+            serve(FakeDnsServer(("127.0.0.1", 0), FakeDnsHandler)) \
+            as dns_address:
+        for row_count in parsedargs["rows"]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                shell: ipcatalog.IpCatalogShell = ipcatalog.IpCatalogShell()
+                shell.database_path = os.path.join(temp_dir, "ipcatalog.db")
+                shell.bgp_tools_server = whois_address
+                shell.rdns_server = dns_address
+                row_results: dict[str, float] = {
+                    "populate": time_call(lambda: populate(shell, row_count)),
+                }
+                row_results.update(benchmark_write_modes(shell,
+                                                         parsedargs["adds"]))
+                row_results.update(benchmark_add(shell, parsedargs["adds"]))
+                row_results.update(benchmark_get(shell, temp_dir))
+                row_results.update(benchmark_subnet(shell))
+                row_results.update(benchmark_export(shell, temp_dir))
+                row_results.update(benchmark_del(shell))
+                results[str(row_count)] = row_results
+                shell.do_exit("")
+            print(f"{row_count} rows: " + ", ".join(
+                    f"{name} {seconds:.3f}s"
+                    for name, seconds in results[str(row_count)].items()),
+                  file=sys.stderr)
+            print(f"{row_count} rows add throughput: " + ", ".join(
+                    f"{mode} {parsedargs['adds'] / max(seconds, 1e-9):.0f} "
+                    "IPs/s" for mode, seconds in (
+                        ("rollback journal", row_results["add rollback " +
+                                                         "journal"]),
+                        ("WAL", row_results["add wal"]),
+                        ("WAL batched", row_results["add wal batched"]),
+                    )), file=sys.stderr)
+    if old_results is not None:
+        compare_results(old_results, results)
+    results_json: str = json.dumps(results, indent=2)
+    if parsedargs["output"] is not None:
+        with open(parsedargs["output"], "w") as output_file:
+            output_file.write(results_json + "\n")
+    print(results_json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,16 +1,32 @@
+import argparse
 import cmd
+import concurrent.futures
 import configparser
+import contextlib
+import csv
 import ipaddress
+import json
+import math
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
 import os
+import pathlib
+import re
+import shlex
 import socket
 import sqlite3
 import sys
+import threading
+import time
 import typing
 
+import radixtree
+import snapshot
+
 CREATE_IP_TABLE_STATEMENT: str = \
 '''CREATE TABLE IF NOT EXISTS ipaddress (
     ip TEXT NOT NULL,
+    version INTEGER,
+    ipbin BLOB,
     asn INTEGER,
     prefix TEXT,
     cc TEXT,
@@ -19,8 +35,1368 @@ CREATE_IP_TABLE_STATEMENT: str = \
     rdns TEXT,
     score INTEGER NOT NULL,
     global INTEGER NOT NULL CHECK(global = 0 OR global = 1),
+    hits INTEGER NOT NULL DEFAULT 0,
+    wafhits INTEGER NOT NULL DEFAULT 0,
+    firstseen INTEGER,
+    lastseen INTEGER,
+    scoredtime INTEGER,
+    decayweight REAL,
+    modified INTEGER,
     PRIMARY KEY(ip)
 );'''
+"""
+version is 4 or 6 and ipbin is the packed big-endian address, so that CIDR
+ranges can be found with an index range scan. hits, wafhits, firstseen and
+lastseen are filled in by logingest.py from web server and network logs.
+scoredtime is when the IP was last classified or seen, and decayweight is
+its score scaled for decay as described at CREATE_DECAY_TABLE_STATEMENT.
+modified is when the IP was last classified, which decides merges.
+"""
+
+CREATE_IP_INDEX_STATEMENT: str = "CREATE INDEX IF NOT EXISTS " + \
+        "ipaddress_ipbin_score ON ipaddress (version, ipbin, score);"
+"""Also covers the subnet rollups, which only need ipbin and score"""
+
+CREATE_IP_FILTER_INDEX_STATEMENTS: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS ipaddress_asn_score ON ipaddress " +
+    "(asn, score);",
+    "CREATE INDEX IF NOT EXISTS ipaddress_cc_score ON ipaddress (cc, score);",
+    "CREATE INDEX IF NOT EXISTS ipaddress_isp_score_asn ON ipaddress " +
+    "(isp, score, asn);",
+    "CREATE INDEX IF NOT EXISTS ipaddress_score_lastseen ON ipaddress " +
+    "(score, lastseen);",
+    "CREATE INDEX IF NOT EXISTS ipaddress_lastseen_score ON ipaddress " +
+    "(lastseen, score);",
+)
+"""
+Indexes for the filters of get. Each has score right after the filtered
+column so the common pairing with a score condition is answered from the
+index before reading any rows. They also cover the GROUP BY of the asn and
+org commands.
+"""
+
+CREATE_DECAY_INDEX_STATEMENT: str = "CREATE INDEX IF NOT EXISTS " + \
+        "ipaddress_score_decayweight ON ipaddress (score, decayweight);"
+"""
+Within a classification decayweight orders IPs by current score, so a
+minimum current score is one range per classification
+"""
+
+CREATE_DECAY_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS decay (
+    score INTEGER NOT NULL,
+    halflife INTEGER NOT NULL,
+    landmark INTEGER NOT NULL,
+    PRIMARY KEY(score)
+);'''
+"""
+Half-life in seconds of each classification whose score decays. The
+decayweight of an IP is score * 2 ** ((scoredtime - landmark) / halflife),
+which never changes as time passes, and its current score is decayweight *
+2 ** ((landmark - now) / halflife), one factor per classification. The
+weights are only rescaled when the landmark falls DECAY_REBASE_HALF_LIVES
+behind, to keep them within the range of a float.
+"""
+
+DECAY_REBASE_HALF_LIVES: int = 256
+"""Half-lives the landmark of a classification may fall behind"""
+
+CREATE_CHANGELOG_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS changelog (
+    seq INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL
+);'''
+"""
+Every IP classified or deleted, in order, kept by the triggers below. The
+changes since a merge are the rows after the seq it stopped at, and the IP's
+row in ipaddress or deletedips says what the change was. Only appended to,
+which costs far less than keeping one row per IP. Older rows of an IP are
+dropped by export-delta, but never the last row, so seqs aren't reused.
+"""
+
+CREATE_DELETED_IPS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS deletedips (
+    ip TEXT NOT NULL,
+    modified INTEGER NOT NULL,
+    PRIMARY KEY(ip)
+);'''
+"""Deleted IPs and when, so deletions reach other catalogs too"""
+
+CREATE_CHANGELOG_TRIGGER_STATEMENTS: tuple[str, ...] = (
+    "CREATE TRIGGER IF NOT EXISTS ipaddress_changelog_insert AFTER INSERT " +
+    "ON ipaddress BEGIN DELETE FROM deletedips WHERE ip=NEW.ip; " +
+    "INSERT INTO changelog (ip) VALUES (NEW.ip); END;",
+    "CREATE TRIGGER IF NOT EXISTS ipaddress_changelog_update AFTER UPDATE " +
+    "OF score, modified ON ipaddress WHEN NEW.score IS NOT OLD.score OR " +
+    "NEW.modified IS NOT OLD.modified BEGIN INSERT INTO changelog (ip) " +
+    "VALUES (NEW.ip); END;",
+    "CREATE TRIGGER IF NOT EXISTS ipaddress_changelog_delete AFTER DELETE " +
+    "ON ipaddress BEGIN DELETE FROM deletedips WHERE ip=OLD.ip; " +
+    "INSERT INTO deletedips (ip, modified) VALUES (OLD.ip, " +
+    "CAST(strftime('%s', 'now') AS INTEGER)); " +
+    "INSERT INTO changelog (ip) VALUES (OLD.ip); END;",
+)
+"""
+Only classification changes are logged, not enrichment or sightings. The
+DELETEs are there because the conflict handling of the statement that fired
+a trigger overrides INSERT OR REPLACE inside it.
+"""
+
+CREATE_SYNC_INFO_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS syncinfo (
+    catalogid TEXT NOT NULL,
+    baseseq INTEGER NOT NULL,
+    exportedseq INTEGER NOT NULL
+);'''
+"""
+One row with the random id of this catalog. In a delta written by
+export-delta, baseseq is the seq its changes start after; in a catalog it
+is 0. exportedseq is the last seq written by export-delta.
+"""
+
+CREATE_SYNC_PEERS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS syncpeers (
+    catalogid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY(catalogid)
+);'''
+"""The last seq merged from each other catalog"""
+
+CREATE_DELTA_IP_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS ipaddress (
+    ip TEXT NOT NULL,
+    version INTEGER,
+    ipbin BLOB,
+    asn INTEGER,
+    prefix TEXT,
+    cc TEXT,
+    rir TEXT,
+    isp TEXT,
+    rdns TEXT,
+    score INTEGER NOT NULL,
+    global INTEGER NOT NULL,
+    modified INTEGER,
+    PRIMARY KEY(ip)
+);'''
+"""The columns of ipaddress that merge reads, in a delta file"""
+
+MERGE_QUERY: str = "SELECT c.seq, c.ip, coalesce(i.modified, " + \
+        "d.modified), i.version, i.ipbin, i.asn, i.prefix, i.cc, i.rir, " + \
+        "i.isp, i.rdns, i.score, i.global FROM changelog c " + \
+        "LEFT JOIN ipaddress i ON i.ip=c.ip " + \
+        "LEFT JOIN deletedips d ON d.ip=c.ip WHERE c.seq>? ORDER BY c.seq;"
+"""The changes of a merged catalog or delta, with a NULL score if deleted"""
+
+MERGE_RULES: tuple[str, ...] = ("lww", "max")
+"""
+lww keeps the most recently classified side, max the more severe one. Both
+break ties by severity and let newer deletions win.
+"""
+
+MERGE_REINDEX_FRACTION: int = 16
+"""
+A merge that writes more than 1/MERGE_REINDEX_FRACTION of the IPs drops the
+indexes on ipaddress and builds them again afterwards, which is several
+times faster than updating them row by row.
+"""
+
+CREATE_ENRICH_CACHE_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS enrichcache (
+    source TEXT NOT NULL CHECK(source = 'rdns' OR source = 'bgp'),
+    key TEXT NOT NULL,
+    prefixlen INTEGER,
+    asn INTEGER,
+    cc TEXT,
+    rir TEXT,
+    isp TEXT,
+    rdns TEXT,
+    fetched INTEGER NOT NULL,
+    negative INTEGER NOT NULL CHECK(negative = 0 OR negative = 1),
+    PRIMARY KEY(source, key)
+);'''
+"""
+Cache of lookups. rDNS rows are keyed by IP. bgp.tools rows are keyed by the
+announced prefix so that other IPs in the same prefix can reuse them, or by
+the IP's host route for negative entries.
+"""
+
+CREATE_ROLLUP_LENGTHS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS rolluplengths (
+    version INTEGER NOT NULL CHECK(version = 4 OR version = 6),
+    prefixlen INTEGER NOT NULL,
+    PRIMARY KEY(version, prefixlen)
+);'''
+"""The prefix lengths that have a maintained rollup in subnetrollup"""
+
+CREATE_ROLLUP_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS subnetrollup (
+    version INTEGER NOT NULL,
+    prefixlen INTEGER NOT NULL,
+    network BLOB NOT NULL,
+    count INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    b INTEGER NOT NULL,
+    pb INTEGER NOT NULL,
+    s INTEGER NOT NULL,
+    m INTEGER NOT NULL,
+    PRIMARY KEY(version, prefixlen, network)
+);'''
+"""
+Per-subnet totals of the ipaddress table. network is the packed network
+address, like ipbin.
+"""
+
+UPDATE_ROLLUP_STATEMENT: str = "INSERT INTO subnetrollup " + \
+        "(version, prefixlen, network, count, score, b, pb, s, m) " + \
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET " + \
+        "count=count+excluded.count, score=score+excluded.score, " + \
+        "b=b+excluded.b, pb=pb+excluded.pb, s=s+excluded.s, m=m+excluded.m;"
+
+DEFAULT_ROLLUP_LENGTHS: tuple[tuple[int, int], ...] = (
+    (4, 8), (4, 16), (4, 24), (6, 32), (6, 48), (6, 64),
+)
+"""(version, prefix length) rollups created with a new database"""
+
+CREATE_ROUTES_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS routes (
+    version INTEGER NOT NULL,
+    netstart BLOB NOT NULL,
+    netend BLOB NOT NULL,
+    prefix TEXT NOT NULL,
+    asn INTEGER,
+    cc TEXT,
+    rir TEXT,
+    isp TEXT,
+    PRIMARY KEY(version, netstart)
+);'''
+"""
+Routing table imported from a local dump. Nested prefixes are flattened
+into non-overlapping ranges of packed addresses, each belonging to the most
+specific prefix covering it, so a lookup is a single index seek.
+"""
+
+CREATE_WAF_HITS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS wafhits (
+    ip TEXT NOT NULL,
+    rule INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    lastseen INTEGER NOT NULL,
+    PRIMARY KEY(ip, rule)
+);'''
+"""Number of times each IP triggered each WAF rule"""
+
+UPDATE_WAF_HITS_STATEMENT: str = "INSERT INTO wafhits " + \
+        "(ip, rule, hits, lastseen) VALUES (?, ?, ?, ?) ON CONFLICT DO " + \
+        "UPDATE SET hits=hits+excluded.hits, " + \
+        "lastseen=max(lastseen, excluded.lastseen);"
+
+UPDATE_SIGHTINGS_STATEMENT: str = "UPDATE ipaddress SET hits=hits+?, " + \
+        "wafhits=wafhits+?, firstseen=min(coalesce(firstseen, ?), ?), " + \
+        "lastseen=max(coalesce(lastseen, ?), ?), scoredtime=?, " + \
+        "decayweight=? WHERE ip=?;"
+
+CREATE_INGEST_OFFSETS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS ingestoffsets (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY(device, inode)
+);'''
+"""
+How far logingest.py has read each log file. Keyed by inode so a file that
+is rotated to a new name is not read again from the start.
+"""
+
+CREATE_SIGHTINGS_TABLE_STATEMENT: str = \
+'''CREATE TABLE IF NOT EXISTS sightings (
+    bucket INTEGER NOT NULL,
+    ip TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    ipbin BLOB NOT NULL,
+    source TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY(bucket, ip, source)
+) WITHOUT ROWID;'''
+"""
+Number of times each IP was seen in each log source, per minute for the last
+SIGHTINGS_MINUTE_RETENTION seconds and per hour before that. bucket is the
+unix time the minute or hour starts at. The primary key starts with the
+time so new rows are appended at the end and recent activity is one range.
+"""
+
+CREATE_SIGHTINGS_INDEX_STATEMENT: str = "CREATE INDEX IF NOT EXISTS " + \
+        "sightings_ipbin_bucket ON sightings (version, ipbin, bucket);"
+"""For the timeline of an IP or CIDR"""
+
+UPDATE_SIGHTINGS_BUCKET_STATEMENT: str = "INSERT INTO sightings " + \
+        "(bucket, ip, version, ipbin, source, count) " + \
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET " + \
+        "count=count+excluded.count;"
+
+SIGHTINGS_MINUTE_RETENTION: int = 24 * 60 * 60
+"""Seconds per-minute sightings are kept before being merged into hours"""
+
+SIGHTINGS_RETENTION: int = 30 * 24 * 60 * 60
+"""Seconds sightings are kept at all"""
+
+DURATION_UNITS: dict[str, int] = {"s": 1, "m": 60, "h": 60 * 60,
+                                  "d": 24 * 60 * 60}
+"""Seconds in each unit accepted by parse_duration()"""
+
+UPSERT_IP_STATEMENT: str = "INSERT INTO ipaddress " + \
+        "(ip, version, ipbin, asn, prefix, cc, rir, isp, rdns, score, " + \
+        "global, scoredtime, decayweight, modified) " + \
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO " + \
+        "UPDATE SET asn=excluded.asn, prefix=excluded.prefix, " + \
+        "cc=excluded.cc, rir=excluded.rir, isp=excluded.isp, " + \
+        "rdns=excluded.rdns, score=excluded.score, " + \
+        "global=excluded.global, scoredtime=excluded.scoredtime, " + \
+        "decayweight=excluded.decayweight, modified=excluded.modified;"
+
+UPSERT_IP_SCORE_STATEMENT: str = "INSERT INTO ipaddress " + \
+        "(ip, version, ipbin, asn, prefix, cc, rir, isp, rdns, score, " + \
+        "global, scoredtime, decayweight, modified) " + \
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO " + \
+        "UPDATE SET score=excluded.score, global=excluded.global, " + \
+        "scoredtime=excluded.scoredtime, " + \
+        "decayweight=excluded.decayweight, modified=excluded.modified;"
+"""Same as UPSERT_IP_STATEMENT, but keeps the enrichment of existing IPs"""
+
+UPDATE_ENRICHMENT_STATEMENT: str = "UPDATE ipaddress SET " + \
+        "asn=coalesce(?, asn), prefix=coalesce(?, prefix), " + \
+        "cc=coalesce(?, cc), rir=coalesce(?, rir), " + \
+        "isp=coalesce(?, isp), rdns=coalesce(?, rdns) WHERE ip=?;"
+"""
+Sets the enrichment of an IP from an EnrichmentRecord, keeping what is
+already known where a lookup was off, failed or found nothing
+"""
+
+CLASSIFICATION_TO_SCORE: dict[str, int] = {'b': -3, 'pb': -1, 's': 1, 'm': 3}
+"""Converts a classification to a score"""
+
+SCORE_TO_CLASSIFICATION: dict[int, str] = {
+    score: classification
+    for classification, score in CLASSIFICATION_TO_SCORE.items()
+}
+
+BGP_TOOLS_SERVER: tuple[str, int] = ("bgp.tools", 43)
+"""Host and port of the bgp.tools whois server"""
+
+BGP_TOOLS_TIMEOUT: float = 5
+"""Socket timeout in seconds when talking to bgp.tools"""
+
+BGP_TOOLS_BATCH_SIZE: int = 1000
+"""Number of IPs written to bgp.tools per send() in a bulk query"""
+
+RDNS_CACHE_TTL: int = 24 * 60 * 60
+"""Seconds a cached reverse DNS entry stays valid"""
+
+BGP_TOOLS_CACHE_TTL: int = 7 * 24 * 60 * 60
+"""Seconds a cached bgp.tools prefix stays valid"""
+
+NEGATIVE_CACHE_TTL: int = 60 * 60
+"""Seconds a failed lookup (no PTR record, timeout) is remembered"""
+
+RDNS_WORKERS: int = 32
+"""Number of threads doing reverse DNS lookups in parallel"""
+
+RDNS_TIMEOUT: float = 2
+"""Seconds to wait for an answer when querying a DNS server directly"""
+
+HISTOGRAM_MIN_SECONDS: float = 1e-6
+"""Upper bound of the lowest bucket of a LatencyHistogram"""
+
+HISTOGRAM_BUCKETS_PER_DOUBLING: int = 4
+"""
+Buckets of a LatencyHistogram per doubling of the latency, so percentiles
+are within 19% of the exact value
+"""
+
+ENRICHMENT_BATCH_WINDOW: float = 0.2
+"""Seconds the background enrichment worker waits for more IPs to batch"""
+
+ENRICHMENT_BATCH_SIZE: int = 1000
+"""Most IPs enriched by the background worker in one batch"""
+
+MALICIOUS_WAF_HITS: int = 10
+"""WAF hits after which an automatically scored IP becomes malicious"""
+
+BgpToolsRecord = tuple[typing.Optional[str], typing.Optional[str],
+                       typing.Optional[str], typing.Optional[str],
+                       typing.Optional[str]]
+"""(asn, prefix, cc, rir, isp) as returned by bgp.tools"""
+
+EnrichmentRecord = tuple[typing.Optional[str], typing.Optional[str],
+                         typing.Optional[str], typing.Optional[str],
+                         typing.Optional[str], typing.Optional[str]]
+"""(asn, prefix, cc, rir, isp, rdns) for an IP"""
+
+EMPTY_BGP_TOOLS_RECORD: BgpToolsRecord = (None, None, None, None, None)
+
+SCORE_TO_ROLLUP_COLUMN: dict[int, int] = {-3: 2, -1: 3, 1: 4, 3: 5}
+"""Index of each score's class counter in [count, score, b, pb, s, m]"""
+
+SQL_VARIABLE_BATCH: int = 500
+"""Number of values bound to a single IN (...) clause"""
+
+DATABASE_BUSY_TIMEOUT: float = 10
+"""Seconds to wait for another connection's write to finish before failing"""
+
+DATABASE_CACHE_SIZE: int = -64 * 1024
+"""SQLite page cache per connection, in KiB since it is negative"""
+
+BATCH_COMMITTING_COMMANDS: tuple[str, ...] = ("cache", "decay",
+                                              "export_delta", "merge",
+                                              "rollup", "routes")
+"""
+Commands that write in transactions of their own, so an open batch is
+committed before they run
+"""
+
+def parse_duration(duration_str: str) -> typing.Optional[int]:
+    """
+    Parses a duration like 90s, 15m, 6h or 7d. A bare number is minutes.
+
+    :return: The duration in seconds, or None if it is invalid.
+    """
+    unit: str = "m"
+    if duration_str[-1:] in DURATION_UNITS:
+        unit = duration_str[-1]
+        duration_str = duration_str[:-1]
+    try:
+        duration: float = float(duration_str)
+    except ValueError:
+        return None
+    if duration <= 0:
+        return None
+    return int(duration * DURATION_UNITS[unit])
+
+DecaySettings = dict[int, tuple[int, int]]
+"""Maps each decaying score to its (half-life, landmark)"""
+
+def decay_weight(score: int, scored_time: int,
+                 decay_settings: DecaySettings) -> typing.Optional[float]:
+    """
+    :return: The decayweight of an IP, or None if its score doesn't decay.
+    """
+    if score not in decay_settings:
+        return None
+    halflife, landmark = decay_settings[score]
+    return score * 2.0 ** ((scored_time - landmark) / halflife)
+
+def decay_factors(decay_settings: DecaySettings, now: int) -> dict[int, float]:
+    """
+    :return: Maps each decaying score to what its decayweights are
+             multiplied by to get the current score.
+    """
+    return {
+        score: 2.0 ** ((landmark - now) / halflife)
+        for score, (halflife, landmark) in decay_settings.items()
+    }
+
+def current_score_sql(decay_settings: DecaySettings, now: int) -> str:
+    """
+    :return: An SQL expression for the current score of an IP, which is its
+             score if it doesn't decay.
+    """
+    if len(decay_settings) == 0:
+        return "score"
+    return "coalesce(decayweight * CASE score " + " ".join(
+            f"WHEN {score} THEN {factor!r}"
+            for score, factor in decay_factors(decay_settings, now).items()
+    ) + " END, score)"
+
+def min_score_condition(decay_settings: DecaySettings, now: int,
+                        min_score: float) -> tuple[str, tuple]:
+    """
+    Compiles a minimum current score into a condition that only needs one
+    range of the (score, decayweight) index per decaying score.
+
+    :return: The SQL condition and its parameters.
+    """
+    if len(decay_settings) == 0:
+        return "score>=?", (min_score,)
+    conditions: list[str] = ["(score>=? AND score NOT IN (" +
+                             ",".join("?" * len(decay_settings)) + "))"]
+    condition_params: list[typing.Any] = [min_score, *decay_settings]
+    for score, factor in decay_factors(decay_settings, now).items():
+        if factor > 0:
+            conditions.append("(score=? AND decayweight>=?)")
+            condition_params.extend((score, min_score / factor))
+        elif min_score <= 0:
+            # Decayed so far that every current score is 0.
+            conditions.append("(score=?)")
+            condition_params.append(score)
+    return "(" + " OR ".join(conditions) + ")", tuple(condition_params)
+
+def read_decay_settings(database: sqlite3.Connection) -> DecaySettings:
+    """
+    :return: The half-lives and landmarks of the decaying scores.
+    """
+    return {
+        score: (halflife, landmark)
+        for score, halflife, landmark in database.execute(
+                "SELECT score, halflife, landmark FROM decay;")
+    }
+
+def read_rollup_lengths(database: sqlite3.Connection) \
+        -> list[tuple[int, int]]:
+    """
+    :return: The (version, prefix length) of each maintained rollup.
+    """
+    return database.execute("SELECT version, prefixlen FROM " +
+            "rolluplengths ORDER BY version, prefixlen;").fetchall()
+
+def read_subnet_totals(database: sqlite3.Connection, subnet_length: int,
+                       ip_version: int) -> dict[int, list[float]]:
+    """
+    Adds up the current scores of all IPs by subnet. If no score decays
+    and there is a rollup with the same or a longer prefix length, the
+    subnets are read from it. Otherwise SQLite groups the rows by the
+    whole bytes of the prefix. In both cases the remaining bits are
+    masked off the much smaller grouped result as integers.
+
+    :param database: The catalog, which is only read.
+    :param subnet_length: The prefix length of the subnets.
+    :param ip_version: 4 or 6.
+    :return: Maps the network number, which is the network address
+             shifted right by the host bits, to [score, b, pb, s, m].
+    """
+    address_bits: int = ipaddress.IPV4LENGTH if ip_version == 4 \
+            else ipaddress.IPV6LENGTH
+    host_bits: int = address_bits - subnet_length
+    rollup_lengths: list[int] = [
+        rollup_length
+        for rollup_version, rollup_length in read_rollup_lengths(database)
+        if rollup_version == ip_version and rollup_length >= subnet_length
+    ]
+    current_score: str = current_score_sql(read_decay_settings(database),
+                                           int(time.time()))
+    grouped_rows: typing.Iterable[tuple]
+    extra_bits: int
+    """Bits of each grouped network past the subnet length"""
+    if len(rollup_lengths) > 0 and current_score == "score":
+        grouped_rows = database.execute("SELECT network, score, " +
+                "b, pb, s, m FROM subnetrollup WHERE version=? AND " +
+                "prefixlen=?;", (ip_version, min(rollup_lengths)))
+        extra_bits = host_bits
+    else:
+        prefix_bytes: int = (subnet_length + 7) // 8
+        grouped_rows = database.execute(
+                "SELECT substr(ipbin, 1, ?) AS network, " +
+                f"SUM({current_score}), " +
+                "SUM(score=-3), SUM(score=-1), SUM(score=1), " +
+                "SUM(score=3) FROM ipaddress WHERE version=? " +
+                "GROUP BY network;", (prefix_bytes, ip_version))
+        extra_bits = prefix_bytes * 8 - subnet_length
+    network_scores: dict[int, list[float]] = {}
+    """Maps network number to [score, b, pb, s, m]"""
+    for network_blob, *network_score in grouped_rows:
+        network_int: int = int.from_bytes(network_blob, "big") >> extra_bits
+        if network_int not in network_scores:
+            network_scores[network_int] = network_score
+        else:
+            for i, value in enumerate(network_score):
+                network_scores[network_int][i] += value
+    return network_scores
+
+def read_blocklist(database: sqlite3.Connection, min_score: float,
+                   subnet4_length: typing.Optional[int] = None,
+                   subnet6_length: typing.Optional[int] = None) \
+        -> list[typing.Union[IPv4Network, IPv6Network]]:
+    """
+    Collects the IPs and subnets to block and merges them into the
+    smallest equivalent set of CIDRs.
+
+    :param database: The catalog, which is only read.
+    :param min_score: The minimum current score of a blocked IP or
+                      subnet.
+    :param subnet4_length: If given, also block IPv4 subnets of this
+                           length whose total score is at least min_score.
+    :param subnet6_length: Same for IPv6.
+    :return: The CIDRs, IPv4 first, each version sorted by address.
+    """
+    min_score_clause, min_score_params = min_score_condition(
+            read_decay_settings(database), int(time.time()), min_score)
+    networks: list[typing.Union[IPv4Network, IPv6Network]] = []
+    for ip_version, network_class, address_bits, subnet_length in (
+            (4, IPv4Network, ipaddress.IPV4LENGTH, subnet4_length),
+            (6, IPv6Network, ipaddress.IPV6LENGTH, subnet6_length)):
+        version_networks: list[typing.Union[IPv4Network, IPv6Network]] = [
+            network_class((int.from_bytes(ipbin, "big"), address_bits))
+            for ipbin, in database.execute("SELECT ipbin FROM " +
+                    "ipaddress WHERE version=? AND " + min_score_clause +
+                    " ORDER BY ipbin;", (ip_version, *min_score_params))
+        ]
+        if subnet_length is not None:
+            version_networks.extend(
+                network_class((network_int <<
+                               (address_bits - subnet_length),
+                               subnet_length))
+                for network_int, network_score in read_subnet_totals(
+                        database, subnet_length, ip_version).items()
+                if network_score[0] >= min_score
+            )
+        networks.extend(ipaddress.collapse_addresses(version_networks))
+    return networks
+
+def format_score(score: float) -> str:
+    """
+    :return: A score for display, with decayed scores rounded.
+    """
+    return f"{score:.2f}" if isinstance(score, float) else str(score)
+
+def ip_filter(arg: str) -> tuple[str, tuple]:
+    """
+    Turns a user supplied IP filter into a WHERE clause. A CIDR or plain IP
+    becomes an index range scan over ipbin, anything else is treated as a
+    LIKE pattern on the text form.
+
+    :param arg: An IP, a CIDR like 10.0.0.0/8, or a pattern like 10.1.%
+    :return: The SQL condition and its parameters.
+    """
+    try:
+        network: typing.Union[IPv4Network, IPv6Network] = \
+                ipaddress.ip_network(arg.strip(), strict=False)
+    except ValueError:
+        return "ip LIKE ?", (arg,)
+    return "version=? AND ipbin BETWEEN ? AND ?", (
+        network.version,
+        network.network_address.packed,
+        network.broadcast_address.packed,
+    )
+
+FILTER_FIELDS: dict[str, str] = {
+    "ip": "ip",
+    "asn": "asn",
+    "prefix": "prefix",
+    "cc": "cc",
+    "rir": "rir",
+    "isp": "isp",
+    "rdns": "rdns",
+    "score": "score",
+    "class": "score",
+    "global": "global",
+    "hits": "hits",
+    "wafhits": "wafhits",
+    "firstseen": "firstseen",
+    "lastseen": "lastseen",
+}
+"""Maps the field names of a get filter to their column"""
+
+INTEGER_FILTER_COLUMNS: frozenset[str] = frozenset((
+    "asn", "score", "global", "hits", "wafhits", "firstseen", "lastseen",
+))
+
+FILTER_OPERATORS: dict[str, str] = {
+    "=": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=",
+    "~": "LIKE", "!~": "NOT LIKE",
+}
+"""Maps the operators of a get filter to SQL"""
+
+FILTER_TERM_PATTERN: re.Pattern = re.compile(
+        r"^([a-z]+)(!=|>=|<=|!~|=|<|>|~)(.*)$", re.DOTALL)
+
+def compile_filter(arg: str, now: typing.Optional[int] = None) \
+        -> tuple[str, tuple]:
+    """
+    Turns a get filter into a WHERE clause. A filter is any number of terms
+    that must all match. A term is FIELD OP VALUE with OP one of
+    = != < <= > >= ~ (LIKE) !~ (NOT LIKE), or since=DURATION (last seen that
+    recently) or new=DURATION (first seen that recently). A term without an
+    operator is an IP, CIDR or pattern, as with ip_filter(). Values can be
+    quoted, and null matches missing values.
+
+    :param arg: The filter, like score>=s asn=13335 rdns~%.amazonaws.com
+    :param now: The unix time durations count back from, default now.
+    :return: The SQL condition and its parameters.
+    :raises ValueError: If the filter is invalid.
+    """
+    if now is None:
+        now = int(time.time())
+    conditions: list[str] = []
+    params: list[typing.Any] = []
+    for term in shlex.split(arg):
+        term_match: typing.Optional[re.Match] = FILTER_TERM_PATTERN.match(term)
+        if term_match is None:
+            term_condition, term_params = ip_filter(term)
+            conditions.append(term_condition)
+            params.extend(term_params)
+            continue
+        field, operator, value = term_match.groups()
+
+        if field in ("since", "new"):
+            duration: typing.Optional[int] = parse_duration(value)
+            if operator != "=" or duration is None:
+                raise ValueError(f"Expected {field}=DURATION like 10m, " +
+                                 f"not {term}")
+            conditions.append(("lastseen" if field == "since"
+                               else "firstseen") + ">=?")
+            params.append(now - duration)
+            continue
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown field {field}, must be one of (" +
+                             ", ".join((*FILTER_FIELDS, "since", "new")) +
+                             ")")
+        column: str = FILTER_FIELDS[field]
+        if column == "ip" and operator in ("=", "!="):
+            term_condition, term_params = ip_filter(value)
+            conditions.append(term_condition if operator == "="
+                              else f"NOT ({term_condition})")
+            params.extend(term_params)
+            continue
+        if value.lower() == "null":
+            if operator not in ("=", "!="):
+                raise ValueError(f"null can only be compared with = or !=, " +
+                                 f"not {operator}")
+            conditions.append(column + (" IS NULL" if operator == "="
+                                        else " IS NOT NULL"))
+            continue
+        if operator in ("~", "!~") or column not in INTEGER_FILTER_COLUMNS:
+            conditions.append(f"{column} {FILTER_OPERATORS[operator]} ?")
+            params.append(value.upper() if column == "cc" else value)
+            continue
+        if column == "score" and value in CLASSIFICATION_TO_SCORE:
+            params.append(CLASSIFICATION_TO_SCORE[value])
+        else:
+            try:
+                params.append(int(value.upper().removeprefix("AS")
+                                  if column == "asn" else value))
+            except ValueError:
+                raise ValueError(f"Expected an integer for {field}, " +
+                                 f"not {value}") from None
+        conditions.append(f"{column}{FILTER_OPERATORS[operator]}?")
+    if len(conditions) == 0:
+        return "1", ()
+    return " AND ".join(conditions), tuple(params)
+
+GET_COLUMNS: tuple[str, ...] = (
+    "ip", "asn", "prefix", "cc", "rir", "isp", "rdns", "score", "global",
+    "hits", "wafhits", "firstseen", "lastseen", "current",
+)
+"""
+Columns written by get in the csv and jsonl formats. current is the score
+after decay.
+"""
+
+GET_TABLE_COLUMNS: tuple[str, ...] = ("ip", "asn", "cc", "isp", "rdns",
+                                      "score")
+"""Columns shown by get in the table format"""
+
+GET_OPTIONS: tuple[str, ...] = ("--limit", "--offset", "--after", "--format",
+                                "--output", "--sort")
+
+GET_SORTS: tuple[str, ...] = ("address", "score")
+
+GET_FORMATS: tuple[str, ...] = ("table", "csv", "jsonl")
+
+GET_FETCH_SIZE: int = 10000
+"""Rows fetched and written at a time by get"""
+
+def split_get_options(arg: str) -> tuple[str, dict[str, str]]:
+    """
+    Separates the --options of get from its filter.
+
+    :return: The filter and a dict of the options given, without the dashes.
+    :raises ValueError: If an option is unknown or has no value.
+    """
+    filter_terms: list[str] = []
+    options: dict[str, str] = {}
+    terms: list[str] = shlex.split(arg)
+    term_index: int = 0
+    while term_index < len(terms):
+        term: str = terms[term_index]
+        term_index += 1
+        if not term.startswith("--"):
+            filter_terms.append(term)
+            continue
+        option, has_value, value = term.partition("=")
+        if option not in GET_OPTIONS:
+            raise ValueError(f"Unknown option {option}, must be one of (" +
+                             ", ".join(GET_OPTIONS) + ")")
+        if not has_value:
+            if term_index == len(terms):
+                raise ValueError(f"Expected a value after {option}")
+            value = terms[term_index]
+            term_index += 1
+        options[option[2:]] = value
+    return shlex.join(filter_terms), options
+
+def parse_route_line(line: str) -> typing.Optional[tuple]:
+    """
+    Parses a line of a routing table dump. Both CAIDA pfx2as lines
+    (address, prefix length and ASN separated by whitespace) and CSV lines
+    (prefix, ASN, country code, RIR, name) are accepted.
+
+    :param line: The line to parse.
+    :return: (network, asn, cc, rir, isp), or None if the line isn't a route.
+    """
+    fields: list[str] = line.split()
+    if len(fields) == 3 and fields[1].isdigit():
+        fields = [fields[0] + "/" + fields[1], fields[2]]
+    else:
+        fields = [field.strip() for field in next(csv.reader((line,)), [])]
+    if len(fields) < 2:
+        return None
+    try:
+        network: typing.Union[IPv4Network, IPv6Network] = \
+                ipaddress.ip_network(fields[0], strict=False)
+    except ValueError:
+        # Probably a header line.
+        return None
+    # Multi-origin prefixes list several ASNs, like 13335_4826 or 13335,4826.
+    asn_str: str = fields[1].upper().removeprefix("AS")
+    asn_str = asn_str.replace(",", "_").split("_")[0]
+    return (
+        network,
+        asn_str if asn_str.isdigit() else None,
+        *[(fields[i] if len(fields) > i and fields[i] != "" else None)
+          for i in (2, 3, 4)],
+    )
+
+def flatten_routes(routes: list[tuple]) -> typing.Iterator[tuple]:
+    """
+    Turns nested prefixes into non-overlapping ranges, each belonging to the
+    most specific prefix that covers it.
+
+    :param routes: (start, end, prefixlen, record) for each prefix of one IP
+                   version, with start and end as integers.
+    :return: (start, end, record) ranges in ascending order.
+    """
+    routes = sorted(routes, key=lambda route: (route[0], route[2]))
+    open_routes: list[tuple] = []
+    """Stack of prefixes containing the current position, innermost last"""
+    position: int = 0
+    """First address not yet assigned to a range"""
+    for start, end, _, record in routes:
+        while len(open_routes) > 0 and open_routes[-1][1] < start:
+            closed_route: tuple = open_routes.pop()
+            if position <= closed_route[1]:
+                yield (position, closed_route[1], closed_route[2])
+                position = closed_route[1] + 1
+        if len(open_routes) > 0 and position < start:
+            yield (position, start - 1, open_routes[-1][2])
+        open_routes.append((start, end, record))
+        position = start
+    while len(open_routes) > 0:
+        closed_route = open_routes.pop()
+        if position <= closed_route[1]:
+            yield (position, closed_route[1], closed_route[2])
+            position = closed_route[1] + 1
+
+def format_nftables(networks: list[typing.Union[IPv4Network, IPv6Network]]) \
+        -> str:
+    """
+    Formats a blocklist as an nftables script for nft -f, which replaces
+    the ipcatalog table with interval sets and a chain dropping traffic from
+    them.
+    """
+    set_lines: list[str] = []
+    for ip_version, family, address_type in ((4, "ip", "ipv4_addr"),
+                                             (6, "ip6", "ipv6_addr")):
+        elements: list[str] = [str(network) for network in networks
+                               if network.version == ip_version]
+        set_lines.append(f"\tset blocklist{ip_version} {{\n" +
+                         f"\t\ttype {address_type}\n" +
+                         "\t\tflags interval\n" +
+                         ("\t\telements = {\n\t\t\t" +
+                          ",\n\t\t\t".join(elements) + "\n\t\t}\n"
+                          if len(elements) > 0 else "") +
+                         "\t}\n")
+    return ("table inet ipcatalog\n" +
+            "delete table inet ipcatalog\n" +
+            "table inet ipcatalog {\n" +
+            "".join(set_lines) +
+            "\tchain input {\n" +
+            "\t\ttype filter hook input priority -10; policy accept;\n" +
+            "\t\tip saddr @blocklist4 drop\n" +
+            "\t\tip6 saddr @blocklist6 drop\n" +
+            "\t}\n" +
+            "}\n")
+
+def format_ipset(networks: list[typing.Union[IPv4Network, IPv6Network]]) \
+        -> str:
+    """
+    Formats a blocklist for ipset restore, filling the ipcatalog4 and
+    ipcatalog6 hash:net sets.
+    """
+    lines: list[str] = []
+    for ip_version, family in ((4, "inet"), (6, "inet6")):
+        elements: list[str] = [str(network) for network in networks
+                               if network.version == ip_version]
+        set_name: str = f"ipcatalog{ip_version}"
+        lines.append(f"create {set_name} hash:net family {family} " +
+                     f"maxelem {max(65536, len(elements))} -exist")
+        lines.append(f"flush {set_name}")
+        lines.extend(f"add {set_name} {element}" for element in elements)
+    return "\n".join(lines) + "\n"
+
+def format_caddy(networks: list[typing.Union[IPv4Network, IPv6Network]]) \
+        -> str:
+    """
+    Formats a blocklist as a Caddyfile snippet. import ipcatalog_blocklist
+    in a site block to answer blocked IPs with a 403 error, which goes
+    through handle_errors 403 like a WAF block.
+    """
+    return ("(ipcatalog_blocklist) {\n" +
+            "\t@ipcatalog_blocked remote_ip " +
+            " ".join(str(network) for network in networks) + "\n" +
+            "\terror @ipcatalog_blocked 403\n" +
+            "}\n")
+
+WINDOWS_FIREWALL_RULE_SIZE: int = 1000
+"""Maximum addresses per Windows firewall rule"""
+
+def format_windows(networks: list[typing.Union[IPv4Network, IPv6Network]]) \
+        -> str:
+    """
+    Formats a blocklist as a PowerShell script replacing the
+    "ipcatalog blocklist" inbound and outbound Windows firewall rules.
+    """
+    lines: list[str] = [
+        "Remove-NetFirewallRule -DisplayName \"ipcatalog blocklist *\" " +
+        "-ErrorAction SilentlyContinue",
+    ]
+    network_strs: list[str] = [str(network) for network in networks]
+    for rule_start in range(0, len(network_strs),
+                            WINDOWS_FIREWALL_RULE_SIZE):
+        remote_addresses: str = ",".join(f"\"{network_str}\""
+                for network_str in network_strs[
+                        rule_start:rule_start + WINDOWS_FIREWALL_RULE_SIZE])
+        rule_number: int = rule_start // WINDOWS_FIREWALL_RULE_SIZE + 1
+        for direction in ("Inbound", "Outbound"):
+            lines.append("New-NetFirewallRule -DisplayName " +
+                         f"\"ipcatalog blocklist {direction} {rule_number}\" " +
+                         f"-Direction {direction} -Action Block " +
+                         f"-RemoteAddress @({remote_addresses}) | Out-Null")
+    return "\r\n".join(lines) + "\r\n"
+
+BLOCKLIST_FORMATS: dict[str, typing.Callable[
+        [list[typing.Union[IPv4Network, IPv6Network]]], str]] = {
+    "nftables": format_nftables,
+    "ipset": format_ipset,
+    "caddy": format_caddy,
+    "windows": format_windows,
+}
+"""Maps the format names of the export command to their formatters"""
+
+def query_rdns(ip_address: str,
+               server: typing.Optional[tuple[str, int]] = None) \
+        -> typing.Optional[str]:
+    """
+    Looks up the reverse DNS entry of an IP.
+
+    :param ip_address: The IP address to look up.
+    :param server: The (host, port) of a DNS server to ask directly instead
+                   of going through the system resolver.
+    :return: The hostname, or None if there is no PTR record.
+    """
+    if server is not None:
+        return query_dns_ptr(ip_address, server)
+    try:
+        reverse_dns_entry, _, _ = socket.gethostbyaddr(ip_address)
+        return reverse_dns_entry
+    except (socket.herror, socket.gaierror):
+        return None
+
+def read_dns_name(message: bytes, offset: int) -> tuple[str, int]:
+    """
+    Reads a possibly compressed domain name from a DNS message.
+
+    :return: The name and the offset right after it.
+    """
+    labels: list[str] = []
+    end_offset: typing.Optional[int] = None
+    for _ in range(128):
+        length: int = message[offset]
+        if length & 0xc0 == 0xc0:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = (length & 0x3f) << 8 | message[offset + 1]
+            continue
+        if length == 0:
+            break
+        labels.append(message[offset + 1:offset + 1 + length].decode(
+                "ascii", "replace"))
+        offset += 1 + length
+    else:
+        raise ValueError("DNS name pointer loop")
+    return ".".join(labels), offset + 1 if end_offset is None else end_offset
+
+def query_dns_ptr(ip_address: str, server: tuple[str, int],
+                  timeout: float = RDNS_TIMEOUT) -> typing.Optional[str]:
+    """
+    Asks a DNS server for the PTR record of an IP with a single UDP query.
+
+    :param ip_address: The IP address to look up.
+    :param server: The (host, port) of the DNS server.
+    :param timeout: Seconds to wait for the answer.
+    :return: The hostname, or None if there is no PTR record or no answer.
+    """
+    query_id: bytes = os.urandom(2)
+    query: bytes = query_id + \
+            b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + \
+            b"".join(len(label).to_bytes(1, "big") + label.encode("ascii")
+                     for label in ipaddress.ip_address(
+                             ip_address).reverse_pointer.split(".")) + \
+            b"\x00\x00\x0c\x00\x01"
+    """Recursion desired, one question for the PTR record"""
+    try:
+        with socket.socket(socket.AF_INET6 if ":" in server[0]
+                           else socket.AF_INET, socket.SOCK_DGRAM) as dns_sock:
+            dns_sock.settimeout(timeout)
+            dns_sock.sendto(query, server)
+            response: bytes = dns_sock.recv(4096)
+            while response[:2] != query_id:
+                response = dns_sock.recv(4096)
+        answer_count: int = int.from_bytes(response[6:8], "big")
+        if response[3] & 0x0f != 0:
+            # NXDOMAIN or a server failure.
+            return None
+        _, offset = read_dns_name(response, 12)
+        offset += 4
+        for _ in range(answer_count):
+            _, offset = read_dns_name(response, offset)
+            record_type: int = int.from_bytes(response[offset:offset + 2],
+                                              "big")
+            record_length: int = int.from_bytes(
+                    response[offset + 8:offset + 10], "big")
+            offset += 10
+            if record_type == 12:
+                return read_dns_name(response, offset)[0]
+            offset += record_length
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+def query_bgp_tools(ip_addresses: typing.Iterable[str],
+                    server: tuple[str, int] = BGP_TOOLS_SERVER,
+                    timeout: float = BGP_TOOLS_TIMEOUT,
+                    phase_timer: typing.Optional["PhaseTimer"] = None) \
+        -> dict[str, BgpToolsRecord]:
+    """
+    Looks up IPs with the bgp.tools bulk whois interface. All IPs go out
+    in a single begin ... end query over one connection, written in batches
+    of BGP_TOOLS_BATCH_SIZE while the response is read back.
+
+    :param ip_addresses: The IP addresses to look up.
+    :param server: The (host, port) of the whois server.
+    :param timeout: The socket timeout in seconds.
+    :param phase_timer: If given, records how long connecting, sending the
+                        query and receiving the answer take.
+    :return: Maps each IP that bgp.tools answered for to its record.
+    """
+    ip_address_list: list[str] = list(ip_addresses)
+    results: dict[str, BgpToolsRecord] = {}
+    if len(ip_address_list) == 0:
+        return results
+    query_detail: str = f"{len(ip_address_list)} IPs"
+
+    connect_start_time: float = time.perf_counter()
+    bgp_tools_sock: socket.socket = socket.create_connection(server,
+                                                            timeout=timeout)
+    if phase_timer is not None:
+        phase_timer.record("whois connect", connect_start_time, query_detail)
+
+    def send_query() -> None:
+        send_start_time: float = time.perf_counter()
+        try:
+            bgp_tools_sock.sendall(b"begin\n")
+            for batch_start in range(0, len(ip_address_list),
+                                     BGP_TOOLS_BATCH_SIZE):
+                bgp_tools_sock.sendall(("\n".join(ip_address_list[
+                        batch_start:batch_start + BGP_TOOLS_BATCH_SIZE]) +
+                        "\n").encode("utf-8"))
+            bgp_tools_sock.sendall(b"end\n")
+        except OSError:
+            # The reader will notice the connection went away.
+            return
+        if phase_timer is not None:
+            phase_timer.record("whois send", send_start_time, query_detail)
+
+    # Send from another thread so a large query can't deadlock against
+    # the server filling up our receive buffer.
+    sender_thread: threading.Thread = threading.Thread(target=send_query,
+                                                       daemon=True)
+    sender_thread.start()
+    receive_start_time: float = time.perf_counter()
+    try:
+        with bgp_tools_sock.makefile("rb") as bgp_tools_file:
+            for line in bgp_tools_file:
+                bgp_tools_fields: list[str] = \
+                        line.decode("utf-8", "replace").split('|')
+                if len(bgp_tools_fields) != 7:
+                    continue
+                result_ip: str = bgp_tools_fields[1].strip()
+                try:
+                    result_ip = str(ipaddress.ip_address(result_ip))
+                except ValueError:
+                    pass
+                results[result_ip] = (
+                    bgp_tools_fields[0].strip(),
+                    bgp_tools_fields[2].strip(),
+                    bgp_tools_fields[3].strip(),
+                    bgp_tools_fields[4].strip(),
+                    bgp_tools_fields[6].strip(),
+                )
+        if phase_timer is not None:
+            phase_timer.record("whois recv", receive_start_time, query_detail)
+    finally:
+        bgp_tools_sock.close()
+        sender_thread.join()
+    return results
+
+class Sighting:
+    """
+    What the logs showed of one IP since the last time it was written to
+    the catalog.
+    """
+    __slots__ = ("hits", "waf_hits", "first_seen", "last_seen", "rule_hits",
+                 "minute_hits")
+
+    def __init__(self, timestamp: int) -> None:
+        self.hits: int = 0
+        self.waf_hits: int = 0
+        """Number of requests that triggered at least one WAF rule"""
+        self.first_seen: int = timestamp
+        self.last_seen: int = timestamp
+        self.rule_hits: dict[int, int] = {}
+        """Maps WAF rule ID to the number of times it was triggered"""
+        self.minute_hits: dict[tuple[int, str], int] = {}
+        """Maps (start of minute, log source) to the number of hits"""
+
+    def add(self, timestamp: int, rules: typing.Sequence[int],
+            source: str) -> None:
+        """
+        Counts one request or connection.
+
+        :param rules: The WAF rules it triggered, if any.
+        :param source: The kind of log it came from, such as caddy.
+        """
+        self.hits += 1
+        minute_key: tuple[int, str] = (timestamp - timestamp % 60, source)
+        self.minute_hits[minute_key] = self.minute_hits.get(minute_key, 0) + 1
+        if timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if timestamp > self.last_seen:
+            self.last_seen = timestamp
+        if len(rules) > 0:
+            self.waf_hits += 1
+            for rule in rules:
+                self.rule_hits[rule] = self.rule_hits.get(rule, 0) + 1
+
+class LatencyHistogram:
+    """
+    Counts latencies in logarithmic buckets, so any number of them takes
+    the same little memory and percentiles can still be read off.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        """Maps bucket number to the number of latencies in it"""
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+    def add(self, seconds: float) -> None:
+        bucket: int = 0 if seconds <= HISTOGRAM_MIN_SECONDS else \
+                math.ceil(math.log2(seconds / HISTOGRAM_MIN_SECONDS) *
+                          HISTOGRAM_BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :param fraction: The percentile as a fraction, like 0.99.
+        :return: The upper bound of the bucket holding the percentile.
+        """
+        rank: float = fraction * self.count
+        seen: int = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, HISTOGRAM_MIN_SECONDS *
+                           2 ** (bucket / HISTOGRAM_BUCKETS_PER_DOUBLING))
+        return self.max
+
+class PhaseTimer:
+    """
+    Collects how long the phases of the shell's work take, like reverse DNS
+    lookups, whois traffic, SQL statements and commits, into one histogram
+    per phase. Shared by the shell, its enrichment worker and their database
+    connections, so it is thread safe.
+    """
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.histograms: dict[str, LatencyHistogram] = {}
+        self.trace_file: typing.Optional[typing.TextIO] = None
+        """If set, every timing is also written to it as a JSON line"""
+
+    def record(self, phase: str, start_time: float,
+               detail: typing.Optional[str] = None) -> None:
+        """
+        Records a phase that started at start_time and ends now.
+
+        :param start_time: time.perf_counter() when the phase started.
+        :param detail: What the phase worked on, like the SQL statement or
+                       the IP. Only written to the trace.
+        """
+        seconds: float = time.perf_counter() - start_time
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = LatencyHistogram()
+            self.histograms[phase].add(seconds)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps({
+                    "time": round(time.time() - seconds, 6),
+                    "phase": phase,
+                    "seconds": seconds,
+                    "thread": threading.current_thread().name,
+                    "detail": detail,
+                }) + "\n")
+
+    @contextlib.contextmanager
+    def timed(self, phase: str, detail: typing.Optional[str] = None) \
+            -> typing.Iterator[None]:
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, start_time, detail)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Database connection that records how long statements and commits take
+    while it has a PhaseTimer. Queries are timed until their first row.
+    """
+    phase_timer: typing.Optional[PhaseTimer] = None
+
+    def execute(self, sql: str, parameters: typing.Any = (),
+                /) -> sqlite3.Cursor:
+        if self.phase_timer is None:
+            return super().execute(sql, parameters)
+        with self.phase_timer.timed("sql", sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: typing.Iterable[typing.Any],
+                    /) -> sqlite3.Cursor:
+        if self.phase_timer is None:
+            return super().executemany(sql, parameters)
+        with self.phase_timer.timed("sql", sql):
+            return super().executemany(sql, parameters)
+
+    def commit(self) -> None:
+        if self.phase_timer is None:
+            super().commit()
+            return
+        with self.phase_timer.timed("commit"):
+            super().commit()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> typing.Any:
+        # The context manager commits without going through commit().
+        if self.phase_timer is None or exc_type is not None:
+            return super().__exit__(exc_type, exc_value, traceback)
+        with self.phase_timer.timed("commit"):
+            return super().__exit__(exc_type, exc_value, traceback)
+
+class EnrichmentQueue:
+    """
+    Enriches IPs on a background thread so add can return immediately.
+    Submitted IPs are deduplicated and looked up in batches by a second
+    shell with the same lookup settings and its own database connection,
+    since sqlite connections can't be shared between threads. Only the
+    enrichment columns that were found are written, so a classification
+    changed in the meantime and enrichment already known are kept.
+    """
+
+    def __init__(self, shell: "IpCatalogShell") -> None:
+        # A fresh shell, so the worker shares none of the batch state of
+        # the interactive one, only its lookup settings
+        self.worker_shell: IpCatalogShell = IpCatalogShell()
+        self.worker_shell.database_path = shell.database_path
+        self.worker_shell.bgp_tools_lookup = shell.bgp_tools_lookup
+        self.worker_shell.rdns_lookup = shell.rdns_lookup
+        self.worker_shell.bgp_tools_server = shell.bgp_tools_server
+        self.worker_shell.rdns_server = shell.rdns_server
+        self.worker_shell.rdns_workers = shell.rdns_workers
+        self.worker_shell.routes_lookup = shell.routes_lookup
+        self.worker_shell.bgp_tools_fallback = shell.bgp_tools_fallback
+        self.worker_shell.use_cache = shell.use_cache
+        self.worker_shell.rdns_cache_ttl = shell.rdns_cache_ttl
+        self.worker_shell.bgp_tools_cache_ttl = shell.bgp_tools_cache_ttl
+        self.worker_shell.negative_cache_ttl = shell.negative_cache_ttl
+        # PhaseTimer is thread-safe, and stats includes the worker's lookups
+        self.worker_shell.phase_timer = shell.phase_timer
+        self.condition: threading.Condition = threading.Condition()
+        self.pending: dict[str, None] = {}
+        """IPs waiting to be enriched, in submission order"""
+        self.active: list[str] = []
+        """IPs being enriched right now"""
+        self.done_count: int = 0
+        self.failed_count: int = 0
+        self.last_error: typing.Optional[str] = None
+        self.worker_thread: threading.Thread = threading.Thread(
+                target=self.run, daemon=True)
+        self.worker_thread.start()
+
+    def submit(self, ip_address_str: str) -> None:
+        """
+        Queues an IP, unless it is already queued or being enriched.
+        """
+        with self.condition:
+            if ip_address_str in self.pending or \
+                    ip_address_str in self.active:
+                return
+            self.pending[ip_address_str] = None
+            self.condition.notify_all()
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """
+        Waits until every queued IP has been enriched.
+
+        :return: False if the timeout ran out first.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                    lambda: len(self.pending) == 0 and len(self.active) == 0,
+                    timeout)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0)
+            # Let a burst of adds pile up so they go out in one query.
+            time.sleep(ENRICHMENT_BATCH_WINDOW)
+            with self.condition:
+                self.active = list(self.pending)[:ENRICHMENT_BATCH_SIZE]
+                for ip_address_str in self.active:
+                    del self.pending[ip_address_str]
+            try:
+                enrichments: dict[str, EnrichmentRecord] = \
+                        self.worker_shell.enrich(self.active)
+                assert self.worker_shell.database is not None
+                with self.worker_shell.database:
+                    self.worker_shell.database.executemany(
+                            UPDATE_ENRICHMENT_STATEMENT,
+                            (enrichment + (ip_address_str,) for
+                             ip_address_str, enrichment in enrichments.items()
+                             if any(column is not None
+                                    for column in enrichment)))
+                succeeded: bool = True
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                succeeded = False
+            with self.condition:
+                if succeeded:
+                    self.done_count += len(self.active)
+                else:
+                    self.failed_count += len(self.active)
+                self.active = []
+                self.condition.notify_all()
 
 class IpCatalogShell(cmd.Cmd):
     intro: str = "Type ? or HELP for help."
@@ -31,17 +1407,94 @@ class IpCatalogShell(cmd.Cmd):
     """Whether to check IPs with bgp.tools"""
     rdns_lookup: bool = True
     """Whether to check reverse DNS records on the IPs"""
+    bgp_tools_server: tuple[str, int] = BGP_TOOLS_SERVER
+    """Whois server to query. Point at a local stand-in for testing."""
+    rdns_server: typing.Optional[tuple[str, int]] = None
+    """DNS server to send PTR queries to instead of the system resolver"""
+    rdns_workers: int = RDNS_WORKERS
+    """Number of parallel reverse DNS lookups"""
+    routes_lookup: bool = True
+    """Whether to check IPs against the imported routing table"""
+    bgp_tools_fallback: bool = False
+    """Whether to ask bgp.tools about IPs missing from the routing table"""
+    use_cache: bool = True
+    """Whether to reuse cached lookups instead of going to the network"""
+    rdns_cache_ttl: int = RDNS_CACHE_TTL
+    bgp_tools_cache_ttl: int = BGP_TOOLS_CACHE_TTL
+    negative_cache_ttl: int = NEGATIVE_CACHE_TTL
+    enrichment_queue: typing.Optional[EnrichmentQueue] = None
+    """Background enrichment of added IPs, started by the first add"""
+    batch_limits: typing.Optional[tuple[int, float]] = None
+    """
+    (rows, seconds) after which writes are committed, set by batch. None
+    commits every command.
+    """
+    explicit_batch: bool = False
+    """Set by begin, so writes are only committed by commit"""
+    batch_rows: int = 0
+    """Rows written since the last commit of the batch"""
+    batch_ips: list[str]
+    """IPs added in the batch, enriched once it is committed"""
+    batch_lock: typing.Optional[threading.RLock] = None
+    """Keeps the batch timer from committing in the middle of a command"""
+    batch_timer: typing.Optional[threading.Timer] = None
+    phase_timer: typing.Optional[PhaseTimer] = None
+    """Times commands and their phases while timing is on"""
+    phase_stats: typing.Optional[PhaseTimer] = None
+    """The timings shown by stats, kept after timing is turned off"""
+    command_start_time: float = 0
+    identchars: str = cmd.Cmd.identchars + "-"
+    """Lets export-delta be one command, see parseline()"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.batch_ips = []
+
+    def parseline(self, line: str) -> tuple:
+        """
+        Runs commands with dashes, like export-delta, with the do_ method
+        named with underscores.
+        """
+        command, arg, line = super().parseline(line)
+        if command is not None:
+            command = command.replace("-", "_")
+        return command, arg, line
+
+    def do_help(self, arg) -> None:
+        super().do_help(arg.replace("-", "_"))
+
+    def onecmd(self, line: str) -> bool:
+        if self.batch_lock is None:
+            return super().onecmd(line)
+        with self.batch_lock:
+            command: typing.Optional[str] = self.parseline(line)[0]
+            if command in BATCH_COMMITTING_COMMANDS and \
+                    (self.batch_rows > 0 or self.explicit_batch):
+                print(f"Committing the batch of {self.batch_rows} rows first")
+                self.explicit_batch = False
+                self.commit_batch()
+            return super().onecmd(line)
+
+    def precmd(self, line: str) -> str:
+        self.command_start_time = time.perf_counter()
+        return line
+
+    def postcmd(self, stop: bool, line: str) -> bool:
+        if self.phase_timer is not None:
+            command: typing.Optional[str] = self.parseline(line)[0]
+            if command:
+                self.phase_timer.record(f"command {command}",
+                                        self.command_start_time, line)
+        return stop
  
     def do_add(self, arg) -> None:
         """
         Adds an IP. b = benign, pb = probably benign, s = suspicious, m = malicious
-        If IP already in database, will update instead.
+        If IP already in database, will update instead. The rDNS and
+        bgp.tools lookups run in the background, see jobs and wait.
         ADD <IP> <CLASSIFICATION>
         ADD 127.0.0.1 b
         """
-        classification_to_score: dict[str, int] = {'b': -3, 'pb': -1, 's': 1, 'm': 3}
-        """Converts the argument to a score"""
-
         argv: list[str] = arg.split(' ')
         if len(argv) != 2:
             print(f"ERROR: Wrong number of arguments, expected 2, got {len(argv)}")
@@ -57,121 +1510,1068 @@ class IpCatalogShell(cmd.Cmd):
             print(f"ERROR: Invalid IP address {argv[0]}")
             return
 
-        if argv[1] not in classification_to_score:
+        if argv[1] not in CLASSIFICATION_TO_SCORE:
             print(f"ERROR: Invalid classification {argv[1]}, must be one of (" +
-                  ", ".join(tuple(classification_to_score)) + ")")
+                  ", ".join(tuple(CLASSIFICATION_TO_SCORE)) + ")")
+            return
+
+        self.init_db()
+        assert self.database is not None
+        with self.write_transaction() as batched:
+            self.upsert_ips(((
+                str(ip_address),
+                ip_address.version,
+                ip_address.packed,
+                *EMPTY_BGP_TOOLS_RECORD,
+                None,
+                CLASSIFICATION_TO_SCORE[argv[1]],
+                int(ip_address.is_global),
+            ),), keep_enrichment=True)
+            if batched:
+                # The enrichment worker can't see the IP until the batch is
+                # committed.
+                self.batch_ips.append(str(ip_address))
+        if not batched:
+            self.submit_enrichment([str(ip_address)])
+
+    def do_batch(self, arg) -> None:
+        """
+        Groups the writes of add, del, import and escalate into one
+        transaction that is committed every ROWS rows or every MILLISECONDS,
+        whichever comes first, instead of after every command. IPs are
+        enriched once their batch is committed. off commits after every
+        command again.
+        batch [<ROWS> <MILLISECONDS>|off]
+        batch 1000 200
+        """
+        argv: list[str] = arg.split()
+        if len(argv) == 0:
+            if self.batch_limits is None:
+                print("Batching is off")
+            else:
+                print(f"Committing every {self.batch_limits[0]} rows or " +
+                      f"{self.batch_limits[1] * 1000:g} ms")
+            if self.explicit_batch:
+                print("In a transaction started by begin, " +
+                      f"{self.batch_rows} rows written")
+            return
+        if argv == ["off"]:
+            self.commit_batch()
+            self.batch_limits = None
+            return
+        try:
+            row_limit: int = int(argv[0]) if len(argv) == 2 else 0
+            window: float = float(argv[1]) / 1000 if len(argv) == 2 else 0
+        except ValueError:
+            row_limit = 0
+            window = 0
+        if row_limit <= 0 or window <= 0:
+            print("ERROR: Expected batch [<ROWS> <MILLISECONDS>|off] with " +
+                  "positive numbers")
+            return
+        self.commit_batch()
+        self.batch_limits = (row_limit, window)
+        if self.batch_lock is None:
+            self.batch_lock = threading.RLock()
+
+    def do_begin(self, arg) -> None:
+        """
+        Starts a transaction that holds the writes of add, del, import and
+        escalate until commit, or drops them on rollback. Takes no
+        arguments. Other commands that write, like merge, commit it first.
+        """
+        if arg.strip() != "":
+            print("ERROR: begin takes no arguments")
+            return
+        if self.explicit_batch:
+            print("ERROR: Already in a transaction, commit or rollback first")
+            return
+        self.commit_batch()
+        self.explicit_batch = True
+        if self.batch_lock is None:
+            self.batch_lock = threading.RLock()
+
+    def do_commit(self, arg) -> None:
+        """
+        Commits the writes held by begin or batch. Takes no arguments.
+        """
+        if not self.explicit_batch and self.batch_limits is None:
+            print("ERROR: Not in a transaction, see begin")
+            return
+        committed_rows: int = self.batch_rows
+        self.explicit_batch = False
+        self.commit_batch()
+        print(f"Committed {committed_rows} rows")
+
+    def do_rollback(self, arg) -> None:
+        """
+        Drops the writes held by begin or batch since the last commit.
+        Takes no arguments.
+        """
+        if not self.explicit_batch and self.batch_limits is None:
+            print("ERROR: Not in a transaction, see begin")
+            return
+        assert self.batch_lock is not None
+        with self.batch_lock:
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            if self.database is not None and self.database.in_transaction:
+                self.database.rollback()
+            print(f"Rolled back {self.batch_rows} rows")
+            self.batch_rows = 0
+            self.batch_ips = []
+            self.explicit_batch = False
+
+    def do_asn(self, arg) -> None:
+        """
+        Adds up the scores of all IPs by ASN, highest score first, or lists
+        the IPs of one ASN. escalate raises every IP of the ASN to
+        CLASSIFICATION in one go, except IPs classified as b.
+        asn [top [COUNT]]
+        asn <ASN>
+        asn <ASN> escalate <CLASSIFICATION>
+        asn top 50
+        asn AS13335 escalate m
+        """
+        argv: list[str] = arg.split()
+        if len(argv) == 0 or argv[0] == "top":
+            self.print_group_totals("asn", argv[1:])
+            return
+        try:
+            asn: int = int(argv[0].upper().removeprefix("AS"))
+        except ValueError:
+            print(f"ERROR: Invalid ASN {argv[0]}")
+            return
+        if len(argv) == 1:
+            self.do_get(f"asn={asn}")
+            return
+        self.escalate_group("asn", asn, f"AS{asn}", argv[1:])
+
+    def do_cache(self, arg) -> None:
+        """
+        Shows or manages the cache of rDNS and bgp.tools lookups.
+        cache          Shows the number of cached entries
+        cache purge    Removes expired entries
+        cache clear    Removes all entries
+        """
+        self.init_db()
+        assert self.database is not None
+        if arg.strip() == "clear":
+            with self.database:
+                self.database.execute("DELETE FROM enrichcache;")
+        elif arg.strip() == "purge":
+            now: int = int(time.time())
+            with self.database:
+                self.database.execute("DELETE FROM enrichcache WHERE " +
+                        "fetched<CASE WHEN negative=1 THEN ? " +
+                        "WHEN source='rdns' THEN ? ELSE ? END;", (
+                    now - self.negative_cache_ttl,
+                    now - self.rdns_cache_ttl,
+                    now - self.bgp_tools_cache_ttl,
+                ))
+        elif arg.strip() != "":
+            print(f"ERROR: Unknown cache action {arg.strip()}")
+            return
+        for source, negative, count in self.database.execute(
+                "SELECT source, negative, COUNT(*) FROM enrichcache " +
+                "GROUP BY source, negative ORDER BY source, negative;"):
+            print(f"{source}: {count} " +
+                  ("negative" if negative else "positive"))
+
+    def do_decay(self, arg) -> None:
+        """
+        Shows or sets how fast the score of each classification decays. The
+        current score of an IP halves every HALF_LIFE (like 90s, 10m, 6h or
+        7d) since it was last classified or seen, and is what subnet4,
+        subnet6, tree, export and get --sort score rank by. off makes the
+        classification, or all of them, keep their score forever.
+        decay [<CLASSIFICATION> <HALF_LIFE|off>]
+        decay off
+        decay m 7d
+        decay pb 1d
+        """
+        argv: list[str] = arg.split()
+        if len(argv) > 2:
+            print(f"ERROR: Wrong number of arguments, expected at most 2, " +
+                  f"got {len(argv)}")
+            return
+        self.init_db()
+        assert self.database is not None
+        if argv == ["off"]:
+            with self.database:
+                self.database.execute("DELETE FROM decay;")
+                self.database.execute("UPDATE ipaddress SET " +
+                        "decayweight=NULL WHERE decayweight IS NOT NULL;")
+        elif len(argv) == 2:
+            if argv[0] not in CLASSIFICATION_TO_SCORE:
+                print(f"ERROR: Invalid classification {argv[0]}, must be " +
+                      "one of (" + ", ".join(CLASSIFICATION_TO_SCORE) + ")")
+                return
+            score: int = CLASSIFICATION_TO_SCORE[argv[0]]
+            halflife: typing.Optional[int] = None
+            if argv[1] != "off":
+                halflife = parse_duration(argv[1])
+                if halflife is None or halflife <= 0:
+                    print(f"ERROR: Invalid half-life {argv[1]}")
+                    return
+            now: int = int(time.time())
+            with self.database:
+                self.database.execute("DELETE FROM decay WHERE score=?;",
+                                      (score,))
+                if halflife is not None:
+                    self.database.execute("INSERT INTO decay " +
+                            "(score, halflife, landmark) VALUES (?, ?, ?);",
+                            (score, halflife, now))
+                decay_settings: DecaySettings = self.decay_settings()
+                self.database.executemany("UPDATE ipaddress SET " +
+                        "decayweight=? WHERE rowid=?;", (
+                    (decay_weight(score, scored_time or now, decay_settings),
+                     rowid)
+                    for rowid, scored_time in self.database.execute(
+                            "SELECT rowid, scoredtime FROM ipaddress " +
+                            "WHERE score=?;", (score,)).fetchall()
+                ))
+        elif len(argv) != 0:
+            print("ERROR: Expected a classification and a half-life, or off")
+            return
+
+        decay_settings = self.decay_settings()
+        for classification, score in CLASSIFICATION_TO_SCORE.items():
+            if score in decay_settings:
+                print(f"{classification}: half-life " +
+                      f"{decay_settings[score][0]}s")
+            else:
+                print(f"{classification}: no decay")
+
+    def do_del(self, arg) -> None:
+        """
+        Removes an IP from the database. Takes a CIDR or SQL wildcards to
+        remove multiple.
+        del <IP_ADDRESS>
+        del 127.0.0.1
+        del 2001:db8::/32
+        del 127.0.%
+        """
+        if arg.strip() == "":
+            print("Expected 1 argument, got 0.")
+            return
+        self.init_db()
+        assert self.database is not None
+        where_clause, where_params = ip_filter(arg)
+        with self.write_transaction():
+            self.delete_ips(where_clause, where_params)
+
+    def do_exit(self, arg) -> bool:
+        """
+        Exits the interactive shell. Takes no arguments. Waits for queued
+        enrichment to finish first.
+        """
+        if self.batch_rows > 0:
+            print(f"Committing the batch of {self.batch_rows} rows")
+        self.commit_batch()
+        if self.enrichment_queue is not None and \
+                not self.enrichment_queue.wait(0):
+            print("Waiting for enrichment to finish. Press Ctrl-C to skip.")
+            try:
+                self.enrichment_queue.wait()
+            except KeyboardInterrupt:
+                pass
+        if self.database is not None:
+            # Refreshes the statistics the query planner uses to pick
+            # between the filter indexes.
+            self.database.execute("PRAGMA optimize;")
+            self.database.close()
+        if self.phase_stats is not None and \
+                self.phase_stats.trace_file is not None:
+            self.phase_stats.trace_file.close()
+        return True
+
+    def do_explain(self, arg) -> None:
+        """
+        Shows the SQL a get filter compiles to and how SQLite will run it.
+        SCAN ipaddress means every IP is read; SEARCH with an index means
+        only the matching range is. Takes the same options as get.
+        explain <FILTER> [OPTIONS]
+        explain asn=13335 score>=s
+        """
+        self.init_db()
+        assert self.database is not None
+        try:
+            query, where_params, _ = self.get_query(arg)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return
+        print(query)
+        if len(where_params) > 0:
+            print("Parameters:", ", ".join(repr(param)
+                                           for param in where_params))
+        for _, _, _, detail in self.database.execute(
+                "EXPLAIN QUERY PLAN " + query, where_params):
+            print(" ", detail)
+
+    def do_export(self, arg) -> None:
+        """
+        Writes a firewall blocklist of every IP scoring at least MIN_SCORE
+        (default 3), plus any subnet of the given lengths whose total score
+        is at least MIN_SCORE, merged into as few CIDRs as possible. With
+        decay on, the current scores are used and MIN_SCORE may be a
+        fraction like 1.5. FORMAT is nftables, ipset, caddy or windows. Use
+        - as FILE for stdout.
+        export <FORMAT> <FILE> [MIN_SCORE] [SUBNET4_LENGTH] [SUBNET6_LENGTH]
+        export nftables blocklist.nft
+        export ipset - 1 24 48
+        """
+        argv: list[str] = arg.split()
+        if len(argv) < 2 or len(argv) > 5:
+            print(f"ERROR: Wrong number of arguments, expected 2 to 5, " +
+                  f"got {len(argv)}")
+            return
+        if argv[0] not in BLOCKLIST_FORMATS:
+            print(f"ERROR: Invalid format {argv[0]}, must be one of (" +
+                  ", ".join(BLOCKLIST_FORMATS) + ")")
+            return
+        min_score: float = 3
+        if len(argv) > 2:
+            try:
+                min_score = float(argv[2])
+            except ValueError:
+                print(f"ERROR: Expected a number, not {argv[2]}")
+                return
+        export_args: list[typing.Optional[int]] = [None, None]
+        """SUBNET4_LENGTH and SUBNET6_LENGTH"""
+        for i, export_arg in enumerate(argv[3:]):
+            try:
+                export_args[i] = int(export_arg)
+            except ValueError:
+                print(f"ERROR: Expected an integer, not {export_arg}")
+                return
+        subnet4_length, subnet6_length = export_args
+        if subnet4_length is not None and not 0 <= subnet4_length <= 32:
+            print("ERROR: SUBNET4_LENGTH must be an integer between 0 and 32")
+            return
+        if subnet6_length is not None and not 0 <= subnet6_length <= 128:
+            print("ERROR: SUBNET6_LENGTH must be an integer between 0 and 128")
             return
 
         self.init_db()
+        networks: list[typing.Union[IPv4Network, IPv6Network]] = \
+                self.blocklist(min_score, subnet4_length, subnet6_length)
+        blocklist_str: str = BLOCKLIST_FORMATS[argv[0]](networks)
+        if argv[1] == "-":
+            sys.stdout.write(blocklist_str)
+        else:
+            try:
+                with open(argv[1], "w", newline="") as blocklist_file:
+                    blocklist_file.write(blocklist_str)
+            except OSError as e:
+                print(f"ERROR: Could not write {argv[1]}: {e}")
+                return
+            print(f"Wrote {len(networks)} networks to {argv[1]}")
+
+    def blocklist(self, min_score: float,
+                  subnet4_length: typing.Optional[int] = None,
+                  subnet6_length: typing.Optional[int] = None) \
+            -> list[typing.Union[IPv4Network, IPv6Network]]:
+        """
+        :return: The CIDRs to block, as read_blocklist returns them.
+        """
+        assert self.database is not None
+        return read_blocklist(self.database, min_score, subnet4_length,
+                              subnet6_length)
+
+    def do_export_delta(self, arg) -> None:
+        """
+        Writes the IPs classified or deleted since the last export-delta to
+        a small database file, which others can merge into their catalogs,
+        for example through a shared directory. all writes every change
+        instead.
+        export-delta <FILE> [all]
+        export-delta /mnt/share/alice-0612.delta
+        """
+        argv: list[str] = arg.split()
+        if len(argv) == 0 or len(argv) > 2 or argv[1:] not in ([], ["all"]):
+            print("ERROR: Expected export-delta <FILE> [all]")
+            return
+        delta_path: str = argv[0]
+        self.init_db()
+        assert self.database is not None
+        catalog_id, base_seq = self.database.execute(
+                "SELECT catalogid, exportedseq FROM syncinfo;").fetchone()
+        if len(argv) == 2:
+            base_seq = 0
+        last_seq: int = self.database.execute(
+                "SELECT coalesce(max(seq), 0) FROM changelog;").fetchone()[0]
+
+        temp_path: str = delta_path + ".tmp"
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.database.execute("ATTACH DATABASE ? AS delta;", (temp_path,))
+        except (OSError, sqlite3.Error) as e:
+            print(f"ERROR: Could not write {delta_path}: {e}")
+            return
+        try:
+            with self.database:
+                # Only the last change of each IP matters.
+                self.database.execute("DELETE FROM changelog WHERE seq NOT " +
+                        "IN (SELECT max(seq) FROM changelog GROUP BY ip);")
+                for create_statement in (CREATE_SYNC_INFO_TABLE_STATEMENT,
+                                         CREATE_CHANGELOG_TABLE_STATEMENT,
+                                         CREATE_DELTA_IP_TABLE_STATEMENT,
+                                         CREATE_DELETED_IPS_TABLE_STATEMENT):
+                    self.database.execute(create_statement.replace(
+                            "EXISTS ", "EXISTS delta.", 1))
+                self.database.execute("INSERT INTO delta.syncinfo " +
+                        "(catalogid, baseseq, exportedseq) VALUES (?, ?, ?);",
+                        (catalog_id, base_seq, last_seq))
+                change_count: int = self.database.execute(
+                        "INSERT INTO delta.changelog SELECT seq, ip FROM " +
+                        "changelog WHERE seq>? AND seq<=?;",
+                        (base_seq, last_seq)).rowcount
+                self.database.execute("INSERT INTO delta.ipaddress SELECT " +
+                        "i.ip, i.version, i.ipbin, i.asn, i.prefix, i.cc, " +
+                        "i.rir, i.isp, i.rdns, i.score, i.global, " +
+                        "i.modified FROM delta.changelog c " +
+                        "JOIN ipaddress i ON i.ip=c.ip;")
+                self.database.execute("INSERT INTO delta.deletedips " +
+                        "SELECT d.ip, d.modified FROM delta.changelog c " +
+                        "JOIN deletedips d ON d.ip=c.ip;")
+        finally:
+            self.database.execute("DETACH DATABASE delta;")
+        os.replace(temp_path, delta_path)
+        with self.database:
+            self.database.execute("UPDATE syncinfo SET exportedseq=?;",
+                                  (last_seq,))
+        print(f"Wrote {change_count} changes to {delta_path}")
+
+    def do_get(self, arg) -> None:
+        """
+        Gets the known IP addresses. Omit the argument to get all. You can use
+        a CIDR or SQL wildcards like % and *, and filter on any of the fields
+        ip, asn, prefix, cc, rir, isp, rdns, score (or class), global, hits,
+        wafhits, firstseen and lastseen with = != < <= > >= ~ (LIKE) and
+        !~ (NOT LIKE). since=DURATION and new=DURATION match IPs last or
+        first seen in the logs within that long. All terms must match.
+        --format is table (default), csv or jsonl, which have every column.
+        --output writes to a file instead of the screen. --limit, --offset
+        and --after page through the IPs in address order; --after takes
+        the last IP of the previous page and is fast at any depth.
+        --sort score lists the highest current score (see decay) first.
+        get [FILTER] [--limit N] [--offset N] [--after IP] [--sort address|score] [--format FORMAT] [--output FILE]
+        get
+        get 127.0.0.1
+        get 10.0.0.0/8
+        get 127.0.%
+        get score>=s asn=13335 cc=CN rdns~%.amazonaws.com since=10m
+        get 10.0.0.0/8 class=m isp~"%Digital Ocean%"
+        get --format csv --output catalog.csv
+        get class=m --limit 100 --after 10.2.3.4
+        get score>=s --sort score --limit 20
+        """
+        self.init_db()
+        assert self.database is not None
+        try:
+            query, query_params, options = self.get_query(arg)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return
+        output_format: str = options.get("format", "table")
+        if output_format not in GET_FORMATS:
+            print(f"ERROR: Invalid format {output_format}, must be one of (" +
+                  ", ".join(GET_FORMATS) + ")")
+            return
+
+        output_file: typing.TextIO = sys.stdout
+        if "output" in options:
+            try:
+                output_file = open(options["output"], "w", newline="",
+                                   encoding="utf-8")
+            except OSError as e:
+                print(f"ERROR: Could not write {options['output']}: {e}")
+                return
+        try:
+            row_count, last_ip = self.write_rows(
+                    self.database.execute(query, query_params),
+                    output_format, output_file)
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
+        if "output" in options:
+            print(f"Wrote {row_count} IPs to {options['output']}")
+        if "limit" in options and row_count == int(options["limit"]) and \
+                last_ip is not None:
+            if options.get("sort", "address") == "address":
+                print(f"More IPs follow, continue with --after {last_ip}",
+                      file=sys.stderr)
+            else:
+                print("More IPs follow, continue with --offset " +
+                      str(int(options.get("offset", 0)) + row_count),
+                      file=sys.stderr)
+
+    def get_query(self, arg: str) -> tuple[str, tuple, dict[str, str]]:
+        """
+        Compiles the arguments of get into a query. The database must be
+        open.
+
+        :return: The query, its parameters and the options of get.
+        :raises ValueError: If the arguments are invalid.
+        """
+        filter_str, options = split_get_options(arg)
+        now: int = int(time.time())
+        where_clause, where_params = compile_filter(filter_str, now)
+        columns: tuple[str, ...] = GET_TABLE_COLUMNS \
+                if options.get("format", "table") == "table" else GET_COLUMNS
+        sort: str = options.get("sort", "address")
+        if sort not in GET_SORTS:
+            raise ValueError(f"Invalid sort {sort}, must be one of (" +
+                             ", ".join(GET_SORTS) + ")")
+        if sort != "address" and "after" in options:
+            raise ValueError("--after only works with --sort address")
+        current_score: str = "score"
+        if "current" in columns or sort == "score":
+            assert self.database is not None
+            current_score = current_score_sql(self.decay_settings(), now)
+        if "after" in options:
+            try:
+                after_ip: typing.Union[IPv4Address, IPv6Address] = \
+                        ipaddress.ip_address(options["after"])
+            except ValueError:
+                raise ValueError(f"Invalid IP address {options['after']}") \
+                        from None
+            where_clause = f"({where_clause}) AND (version, ipbin)>(?, ?)"
+            where_params += (after_ip.version, after_ip.packed)
+        query: str = "SELECT " + ", ".join(
+                f"{current_score} AS current" if column == "current"
+                else column for column in columns) + \
+                " FROM ipaddress WHERE " + where_clause
+        paged: bool = any(option in options
+                          for option in ("limit", "offset", "after"))
+        if sort == "score":
+            query += f" ORDER BY {current_score} DESC, version, ipbin"
+        elif paged:
+            # Pages need a stable order, and the address index gives one
+            # that --after can seek into.
+            query += " ORDER BY version, ipbin"
+        if paged:
+            limit_params: list[int] = []
+            for option in ("limit", "offset"):
+                try:
+                    limit_params.append(int(options.get(option, -1 if
+                                                        option == "limit"
+                                                        else 0)))
+                except ValueError:
+                    raise ValueError(f"Expected an integer for --{option}, " +
+                                     f"not {options[option]}") from None
+            query += " LIMIT ? OFFSET ?"
+            where_params += tuple(limit_params)
+        return query + ";", where_params, options
+
+    @staticmethod
+    def write_rows(cursor: sqlite3.Cursor, output_format: str,
+                   output_file: typing.TextIO) \
+            -> tuple[int, typing.Optional[str]]:
+        """
+        Writes the rows of a get query as they are fetched, a batch of
+        GET_FETCH_SIZE rows at a time.
+
+        :return: The number of rows written and the IP of the last one.
+        """
+        row_count: int = 0
+        last_ip: typing.Optional[str] = None
+        csv_writer = csv.writer(output_file)
+        if output_format == "csv":
+            csv_writer.writerow(GET_COLUMNS)
+        while True:
+            rows: list[tuple] = cursor.fetchmany(GET_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            if output_format == "csv":
+                csv_writer.writerows(rows)
+            elif output_format == "jsonl":
+                output_file.write("".join(
+                        json.dumps(dict(zip(GET_COLUMNS, row))) + "\n"
+                        for row in rows))
+            else:
+                output_file.write("".join(
+                        f"{ip:<20.20}|" +
+                        f"{'NA' if asn is None else str(asn):<10.10}|" +
+                        f"{'NA' if cc is None else cc:<2.2}|" +
+                        f"{'NA' if isp is None else isp:<16.16}|" +
+                        f"{'NA' if rdns is None else rdns:<25.25}|" +
+                        f"{str(score):<2.2}\n"
+                        for ip, asn, cc, isp, rdns, score in rows))
+            row_count += len(rows)
+            last_ip = rows[-1][0]
+        return row_count, last_ip
+
+    def do_import(self, arg) -> None:
+        """
+        Adds IPs in bulk from a file with one IP and classification per line,
+        separated by whitespace or a comma. Blank lines and lines starting
+        with # are ignored. Reverse DNS runs in parallel and bgp.tools is
+        queried in bulk, then everything is written in one transaction.
+        import <FILE>
+        import attackers.txt
+        """
+        if arg.strip() == "":
+            print("Expected 1 argument, got 0.")
+            return
+        self.import_file(pathlib.Path(arg.strip()))
+
+    def import_file(self, import_path: pathlib.Path) -> bool:
+        """
+        Imports IP/classification pairs from a file.
+
+        :param import_path: The file to import.
+        :return: True if the file was imported, False on error.
+        """
+        start_time: float = time.perf_counter()
+        ip_scores: dict[str, int] = {}
+        """Maps each IP to import to its score. Later lines win."""
+        try:
+            with open(import_path) as import_file:
+                for line_number, line in enumerate(import_file, 1):
+                    line = line.strip()
+                    if line == "" or line.startswith("#"):
+                        continue
+                    fields: list[str] = line.replace(",", " ").split()
+                    if len(fields) != 2:
+                        print(f"WARNING: {import_path}:{line_number}: " +
+                              f"expected 2 fields, got {len(fields)}")
+                        continue
+                    try:
+                        ip_address_str: str = \
+                                str(ipaddress.ip_address(fields[0]))
+                    except ValueError:
+                        print(f"WARNING: {import_path}:{line_number}: " +
+                              f"invalid IP address {fields[0]}")
+                        continue
+                    if fields[1] not in CLASSIFICATION_TO_SCORE:
+                        print(f"WARNING: {import_path}:{line_number}: " +
+                              f"invalid classification {fields[1]}")
+                        continue
+                    ip_scores[ip_address_str] = \
+                            CLASSIFICATION_TO_SCORE[fields[1]]
+        except OSError as e:
+            print(f"ERROR: Could not read {import_path}: {e}")
+            return False
+
+        self.init_db()
+        assert self.database is not None
+
+        enrich_stats: dict[str, float] = {}
+        enrichments: dict[str, EnrichmentRecord] = self.enrich(ip_scores,
+                                                               enrich_stats)
+        with self.write_transaction(len(ip_scores)):
+            self.upsert_ips([
+                (ip_address_str, ip_address_obj.version, ip_address_obj.packed,
+                 *enrichments[ip_address_str], score,
+                 int(ip_address_obj.is_global))
+                for ip_address_str, score in ip_scores.items()
+                for ip_address_obj in (ipaddress.ip_address(ip_address_str),)
+            ])
+        elapsed_time: float = time.perf_counter() - start_time
+        print(f"Imported {len(ip_scores)} IPs in {elapsed_time:.2f}s " +
+              f"({len(ip_scores) / max(elapsed_time, 1e-9):.1f} IPs/s)")
+        print(f"  rDNS: {int(enrich_stats['rdns_cached'])} cached, " +
+              f"{int(enrich_stats['rdns_queried'])} looked up in " +
+              f"{enrich_stats['rdns_time']:.2f}s")
+        print(f"  Routing table: {int(enrich_stats['routes'])} found")
+        print(f"  bgp.tools: {int(enrich_stats['bgp_cached'])} cached, " +
+              f"{int(enrich_stats['bgp_queried'])} looked up in " +
+              f"{enrich_stats['bgp_time']:.2f}s")
+        return True
+
+    def do_jobs(self, arg) -> None:
+        """
+        Shows the progress of the background enrichment of added IPs.
+        Takes no arguments.
+        """
+        if self.enrichment_queue is None:
+            print("No enrichment jobs")
+            return
+        enrichment_queue: EnrichmentQueue = self.enrichment_queue
+        with enrichment_queue.condition:
+            pending: list[str] = list(enrichment_queue.pending)
+            active: list[str] = list(enrichment_queue.active)
+            print(f"{len(pending)} queued, {len(active)} in progress, " +
+                  f"{enrichment_queue.done_count} done, " +
+                  f"{enrichment_queue.failed_count} failed")
+            if len(active) > 0:
+                print("In progress:", " ".join(active[:10]) +
+                      (" ..." if len(active) > 10 else ""))
+            if len(pending) > 0:
+                print("Queued:", " ".join(pending[:10]) +
+                      (" ..." if len(pending) > 10 else ""))
+            if enrichment_queue.last_error is not None:
+                print("Last error:", enrichment_queue.last_error)
+
+    def do_merge(self, arg) -> None:
+        """
+        Merges the changes from another catalog, or from a delta written by
+        export-delta, that came after the last merge from it. With lww (the
+        default) the most recently classified side of each IP wins, with max
+        the more severe one. A newer deletion deletes the IP either way.
+        merge <FILE> [lww|max]
+        merge /mnt/share/bob/ipcatalog.db
+        merge /mnt/share/alice-0612.delta max
+        """
+        argv: list[str] = arg.split()
+        if len(argv) == 0 or len(argv) > 2:
+            print(f"ERROR: Wrong number of arguments, expected 1 or 2, " +
+                  f"got {len(argv)}")
+            return
+        merge_rule: str = argv[1] if len(argv) == 2 else "lww"
+        if merge_rule not in MERGE_RULES:
+            print(f"ERROR: Invalid rule {merge_rule}, must be one of (" +
+                  ", ".join(MERGE_RULES) + ")")
+            return
+        if not os.path.isfile(argv[0]):
+            print(f"ERROR: {argv[0]} does not exist")
+            return
+        self.init_db()
+        start_time: float = time.perf_counter()
+        try:
+            peer_database: sqlite3.Connection = sqlite3.connect(
+                    pathlib.Path(argv[0]).resolve().as_uri() + "?mode=ro",
+                    uri=True)
+        except sqlite3.Error as e:
+            print(f"ERROR: Could not open {argv[0]}: {e}")
+            return
+        try:
+            merge_counts: typing.Optional[dict[str, int]] = \
+                    self.merge_catalog(peer_database, merge_rule)
+        except sqlite3.Error as e:
+            print(f"ERROR: Could not merge {argv[0]}: {e}")
+            return
+        finally:
+            peer_database.close()
+        if merge_counts is None:
+            return
+        print(f"Merged {merge_counts['changes']} changes from {argv[0]} in " +
+              f"{time.perf_counter() - start_time:.2f}s: " +
+              f"{merge_counts['added']} added, " +
+              f"{merge_counts['updated']} updated, " +
+              f"{merge_counts['deleted']} deleted, " +
+              f"{merge_counts['kept']} kept")
+
+    def merge_catalog(self, peer_database: sqlite3.Connection,
+                      merge_rule: str) -> typing.Optional[dict[str, int]]:
+        """
+        Merges the new changes of another catalog in one transaction.
+
+        :param peer_database: The other catalog or delta.
+        :param merge_rule: One of MERGE_RULES.
+        :return: The number of changes read and IPs added, updated, deleted
+                 and kept as they were, or None if the file can't be merged.
+        """
+        assert self.database is not None
+        local_id: str = self.database.execute(
+                "SELECT catalogid FROM syncinfo;").fetchone()[0]
+        try:
+            peer_id, peer_base_seq, _ = peer_database.execute(
+                    "SELECT catalogid, baseseq, exportedseq FROM syncinfo;"
+                    ).fetchone()
+        except sqlite3.OperationalError:
+            print("ERROR: Not a catalog or delta. Catalogs from older " +
+                  "versions need to be opened once to be merged.")
+            return None
+        if peer_id == local_id:
+            print("ERROR: Can't merge a catalog into itself")
+            return None
+        merged_seq_row: typing.Optional[tuple] = self.database.execute(
+                "SELECT seq FROM syncpeers WHERE catalogid=?;",
+                (peer_id,)).fetchone()
+        merged_seq: int = 0 if merged_seq_row is None else merged_seq_row[0]
+        missing_changes: bool = peer_base_seq > merged_seq
+        if missing_changes:
+            print(f"WARNING: This delta starts after change {peer_base_seq} " +
+                  f"of catalog {peer_id}, but only changes up to " +
+                  f"{merged_seq} were merged. Merge the deltas before it too.")
 
-        reverse_dns_entry: typing.Optional[str] = None
-        if self.rdns_lookup:
-            try:
-                reverse_dns_entry, _, _ = socket.gethostbyaddr(str(ip_address))
-            except socket.herror:
-                pass
-            print("rDNS:", reverse_dns_entry)
-
-        asn: typing.Optional[str] = None
-        prefix: typing.Optional[str] = None
-        cc: typing.Optional[str] = None
-        rir: typing.Optional[str] = None
-        isp: typing.Optional[str] = None
-        if self.bgp_tools_lookup:
-            if ip_address.is_global:
-                try:
-                    bgp_tools_sock: socket.socket = socket.socket(
-                            family=socket.AF_INET, type=socket.SOCK_STREAM)
-                    bgp_tools_sock.settimeout(5)
-                    bgp_tools_sock.connect(("bgp.tools", 43))
-                    bgp_tools_sock.send(
-                        f"begin\n{ip_address}\nend\n".encode("utf-8")
-                    )
-                    bgp_tools_received_data: bytearray = bytearray()
-                    while True:
-                        bgp_tools_recv_chunk = bgp_tools_sock.recv(4096)
-                        bgp_tools_received_data.extend(bgp_tools_recv_chunk)
-                        if len(bgp_tools_recv_chunk) < 4096:
-                            break
-                    bgp_tools_str_raw: str = bgp_tools_received_data.decode("utf-8")
-                    """The unprocessed string returned from bgp.tools"""
-                    bgp_tools_fields: list[str] = bgp_tools_str_raw.split('|')
-                    if len(bgp_tools_fields) == 7:
-                        asn = bgp_tools_fields[0].strip()
-                        prefix = bgp_tools_fields[2].strip()
-                        cc = bgp_tools_fields[3].strip()
-                        rir = bgp_tools_fields[4].strip()
-                        isp = bgp_tools_fields[6].strip()
+        merge_counts: dict[str, int] = {"changes": 0, "added": 0,
+                                        "updated": 0, "deleted": 0, "kept": 0}
+        last_seq: int = merged_seq
+        upsert_rows: list[tuple] = []
+        deletions: list[tuple[int, str]] = []
+        """(modified, ip) of each IP to delete"""
+        peer_cursor: sqlite3.Cursor = peer_database.execute(MERGE_QUERY,
+                                                            (merged_seq,))
+        while True:
+            peer_rows: list[tuple] = peer_cursor.fetchmany(SQL_VARIABLE_BATCH)
+            if len(peer_rows) == 0:
+                break
+            last_seq = peer_rows[-1][0]
+            # The rows of an IP changed more than once are all its latest.
+            peer_changes: dict[str, tuple] = {row[1]: row for row in peer_rows}
+            merge_counts["changes"] += len(peer_changes)
+            ip_address_batch: list[str] = list(peer_changes)
+            batch_params: str = ",".join("?" * len(ip_address_batch))
+            local_rows: dict[str, tuple] = {
+                row[0]: row for row in self.database.execute(
+                        "SELECT ip, score, modified FROM ipaddress WHERE " +
+                        f"ip IN ({batch_params});", ip_address_batch)
+            }
+            local_deletions: dict[str, int] = dict(self.database.execute(
+                    "SELECT ip, modified FROM deletedips WHERE ip IN " +
+                    f"({batch_params});", ip_address_batch).fetchall())
+            for (_, ip_address_str, modified, ip_version, ipbin,
+                 *peer_enrichment, score, is_global) in peer_changes.values():
+                if modified is None:
+                    continue
+                local_row: typing.Optional[tuple] = \
+                        local_rows.get(ip_address_str)
+                if score is None:
+                    if local_row is not None and \
+                            modified >= (local_row[2] or 0):
+                        deletions.append((modified, ip_address_str))
+                        merge_counts["deleted"] += 1
                     else:
-                        print("WARNING: bgp.tools returned corrupt response")
-                except TimeoutError:
-                    print("WARNING: Timed out when contacting bgp.tools.")
-
-        assert self.database is not None
-        self.database.execute("INSERT INTO ipaddress " + 
-                "(ip, asn, prefix, cc, rir, isp, rdns, score, global) " + 
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO " + 
-                "UPDATE SET asn=excluded.asn, prefix=excluded.prefix, " + 
-                "cc=excluded.cc, rir=excluded.rir, isp=excluded.isp, " + 
-                "rdns=excluded.rdns, score=excluded.score, " + 
-                "global=excluded.global;", (
-            str(ip_address),
-            asn,
-            prefix,
-            cc,
-            rir,
-            isp,
-            reverse_dns_entry,
-            classification_to_score[argv[1]],
-            int(ip_address.is_global),
-        ))
-        self.database.commit()
+                        merge_counts["kept"] += 1
+                    continue
+                if local_row is None:
+                    if local_deletions.get(ip_address_str, -1) >= modified:
+                        merge_counts["kept"] += 1
+                        continue
+                    upsert_rows.append((ip_address_str, ip_version, ipbin,
+                                        *peer_enrichment, score, is_global,
+                                        modified))
+                    merge_counts["added"] += 1
+                    continue
+                local_score: int = local_row[1]
+                local_modified: int = local_row[2] or 0
+                if merge_rule == "lww":
+                    peer_wins: bool = (modified, score) > \
+                            (local_modified, local_score)
+                else:
+                    peer_wins = score > local_score
+                    modified = max(modified, local_modified)
+                if not peer_wins:
+                    merge_counts["kept"] += 1
+                    continue
+                upsert_rows.append((ip_address_str, ip_version, ipbin,
+                                    *peer_enrichment, score, is_global,
+                                    modified))
+                merge_counts["updated"] += 1
 
-    def do_del(self, arg) -> None:
+        ip_count: int = self.database.execute(
+                "SELECT count(*) FROM ipaddress;").fetchone()[0]
+        with self.database:
+            ip_indexes: list[tuple[str, str]] = []
+            if (len(upsert_rows) + len(deletions)) * \
+                    MERGE_REINDEX_FRACTION > ip_count:
+                ip_indexes = self.database.execute("SELECT name, sql FROM " +
+                        "sqlite_master WHERE type='index' AND " +
+                        "tbl_name='ipaddress' AND sql IS NOT NULL;"
+                        ).fetchall()
+                for index_name, _ in ip_indexes:
+                    self.database.execute(f"DROP INDEX {index_name};")
+            # Only the classification is merged. Updating the enrichment too
+            # would rewrite every filter index.
+            self.upsert_ips(upsert_rows, keep_enrichment=True)
+            for batch_start in range(0, len(deletions), SQL_VARIABLE_BATCH):
+                deletion_batch: list[tuple[int, str]] = deletions[
+                        batch_start:batch_start + SQL_VARIABLE_BATCH]
+                self.delete_ips("ip IN (" +
+                                ",".join("?" * len(deletion_batch)) + ")",
+                                tuple(ip for _, ip in deletion_batch))
+            # Keep when the deletions happened, not when they were merged.
+            self.database.executemany("UPDATE deletedips SET modified=? " +
+                                      "WHERE ip=?;", deletions)
+            for _, create_index_statement in ip_indexes:
+                self.database.execute(create_index_statement)
+            if not missing_changes:
+                # Otherwise the deltas before this one could not be merged
+                # anymore. Merging this one again later does no harm.
+                self.database.execute("INSERT INTO syncpeers " +
+                        "(catalogid, seq) VALUES (?, ?) ON CONFLICT DO " +
+                        "UPDATE SET seq=excluded.seq;", (peer_id, last_seq))
+        return merge_counts
+
+    def do_org(self, arg) -> None:
         """
-        Removes an IP from the database. Support the use of wildcards to remove
-        multiple.
-        del <IP_ADDRESS>
-        del 127.0.0.1
+        Adds up the scores of all IPs by organization (the ISP reported by
+        bgp.tools), highest score first, or lists the IPs of one
+        organization. escalate raises every IP of the organization to
+        CLASSIFICATION in one go, except IPs classified as b. Quote names
+        with spaces.
+        org [top [COUNT]]
+        org <NAME>
+        org <NAME> escalate <CLASSIFICATION>
+        org "DigitalOcean, LLC" escalate s
         """
-        if arg.strip() == "":
-            print("Expected 1 argument, got 0.")
+        try:
+            argv: list[str] = shlex.split(arg)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return
+        if len(argv) == 0 or argv[0] == "top":
+            self.print_group_totals("isp", argv[1:])
             return
+        if len(argv) == 1:
+            self.do_get(shlex.join([f"isp={argv[0]}"]))
+            return
+        self.escalate_group("isp", argv[0], argv[0], argv[1:])
+
+    def do_rollup(self, arg) -> None:
+        """
+        Manages the subnet rollups that subnet4 and subnet6 read from. A
+        query for a prefix length without a rollup uses the next longer
+        rollup, or scans the IPs if there is none.
+        rollup                     Lists the rollup prefix lengths
+        rollup add <4|6> <LENGTH>  Builds a rollup for a prefix length
+        rollup del <4|6> <LENGTH>  Drops a rollup
+        rollup check               Rebuilds all rollups, reporting any
+                                   subnets that were out of date
+        """
         self.init_db()
         assert self.database is not None
-        self.database.execute("DELETE FROM ipaddress WHERE ip LIKE ?", (arg,))
-        self.database.commit()
+        argv: list[str] = arg.split()
+        if len(argv) == 0:
+            for ip_version, subnet_length in self.rollup_lengths():
+                print(f"IPv{ip_version} /{subnet_length}")
+            return
+        if argv[0] == "check":
+            mismatch_count: int = 0
+            with self.database:
+                old_rollup: dict[tuple, tuple] = {
+                    tuple(row[:3]): tuple(row[3:])
+                    for row in self.database.execute(
+                            "SELECT * FROM subnetrollup;")
+                }
+                self.rebuild_rollups()
+                new_rollup: dict[tuple, tuple] = {
+                    tuple(row[:3]): tuple(row[3:])
+                    for row in self.database.execute(
+                            "SELECT * FROM subnetrollup;")
+                }
+            for rollup_key in old_rollup.keys() | new_rollup.keys():
+                if old_rollup.get(rollup_key) != new_rollup.get(rollup_key):
+                    mismatch_count += 1
+                    ip_version, subnet_length, network_blob = rollup_key
+                    print("Fixed " + str(ipaddress.ip_address(network_blob)) +
+                          f"/{subnet_length}: {old_rollup.get(rollup_key)} " +
+                          f"-> {new_rollup.get(rollup_key)}")
+            print(f"Checked {len(new_rollup)} subnets, " +
+                  f"{mismatch_count} were out of date")
+            return
+        if argv[0] not in ("add", "del") or len(argv) != 3:
+            print("ERROR: Expected rollup, rollup check, " +
+                  "or rollup add|del <4|6> <LENGTH>")
+            return
+        try:
+            ip_version: int = int(argv[1])
+            subnet_length: int = int(argv[2])
+        except ValueError:
+            print(f"ERROR: Expected integers, not {argv[1]} {argv[2]}")
+            return
+        if ip_version not in (4, 6):
+            print(f"ERROR: IP version must be 4 or 6, not {ip_version}")
+            return
+        max_length: int = ipaddress.IPV4LENGTH if ip_version == 4 \
+                else ipaddress.IPV6LENGTH
+        if subnet_length < 0 or subnet_length > max_length:
+            print("ERROR: LENGTH must be an integer between 0 and " +
+                  str(max_length))
+            return
+        with self.database:
+            if argv[0] == "add":
+                self.database.execute("INSERT OR IGNORE INTO rolluplengths " +
+                        "(version, prefixlen) VALUES (?, ?);",
+                        (ip_version, subnet_length))
+                self.rebuild_rollups(((ip_version, subnet_length),))
+            else:
+                self.database.execute("DELETE FROM rolluplengths WHERE " +
+                        "version=? AND prefixlen=?;",
+                        (ip_version, subnet_length))
+                self.database.execute("DELETE FROM subnetrollup WHERE " +
+                        "version=? AND prefixlen=?;",
+                        (ip_version, subnet_length))
 
-    def do_exit(self, arg) -> bool:
+    def do_routes(self, arg) -> None:
         """
-        Exits the interactive shell. Takes no arguments.
+        Manages the offline routing table used instead of bgp.tools. The
+        file can be a CAIDA pfx2as dump or a CSV file with the columns
+        prefix, ASN, country code, RIR and name. Importing replaces the
+        current table.
+        routes                  Shows the number of routes
+        routes import <FILE>    Imports a routing table
+        routes clear            Removes the routing table
         """
-        if self.database is not None:
-            self.database.close()
-        return True
+        self.init_db()
+        assert self.database is not None
+        action, _, routes_path = arg.strip().partition(" ")
+        if action == "import":
+            if routes_path.strip() == "":
+                print("Expected a file to import.")
+                return
+            self.import_routes(pathlib.Path(routes_path.strip()))
+        elif action == "clear":
+            with self.database:
+                self.database.execute("DELETE FROM routes;")
+        elif action != "":
+            print(f"ERROR: Unknown routes action {action}")
+            return
+        for ip_version, count, prefix_count in self.database.execute(
+                "SELECT version, COUNT(*), COUNT(DISTINCT prefix) " +
+                "FROM routes GROUP BY version ORDER BY version;"):
+            print(f"IPv{ip_version}: {prefix_count} prefixes in " +
+                  f"{count} ranges")
 
-    def do_get(self, arg) -> None:
+    def do_snapshot(self, arg) -> None:
         """
-        Gets the known IP addresses. Omit the argument to get all. You can use
-        SQL wildcards like % and *.
-        get
-        get 127.0.0.1
-        get 127.0.%
+        Writes the IPs with their scores, ASNs, country codes and ISPs to a
+        compact binary file that snapshot.py can query without sqlite.
+        snapshot <FILE>
         """
-        if arg.strip() == "":
-            arg = '%'
+        argv: list[str] = arg.split()
+        if len(argv) != 1:
+            print(f"ERROR: Wrong number of arguments, expected 1, " +
+                  f"got {len(argv)}")
+            return
+
         self.init_db()
         assert self.database is not None
-        for row in self.database.execute("SELECT ip, asn, cc, isp, rdns, score " + 
-                                         "FROM ipaddress WHERE ip LIKE ?;",
-                                         (arg,)):
-            row_temp: list[str] = []
-            for val in row:
-                row_temp.append("NA" if val is None else str(val))
-            row = tuple(row_temp)
-            print(row[0].ljust(20)[:20] + "|" + row[1].ljust(10)[:10] + 
-                  "|" + row[2].ljust(2)[:2] + "|" + row[3].ljust(16)[:16] + 
-                  "|" + row[4].ljust(25)[:25] + "|" + row[5].ljust(2)[:2])
+        try:
+            ip_count: int = snapshot.write_snapshot(argv[0],
+                    self.database.execute("SELECT version, ipbin, score, " +
+                    "asn, cc, isp FROM ipaddress ORDER BY version, ipbin;"))
+        except OSError as e:
+            print(f"ERROR: Could not write {argv[0]}: {e}")
+            return
+        print(f"Wrote {ip_count} IPs to {argv[0]}")
+
+    def do_stats(self, arg) -> None:
+        """
+        Shows how long commands and their phases took since timing was
+        turned on: reverse DNS lookups (rdns), connecting to, sending to and
+        receiving from bgp.tools (whois), SQL statements (sql, queries until
+        their first row) and commits. Times are in milliseconds; percentiles
+        are rounded up by at most 19%. reset clears them.
+        stats [reset]
+        """
+        argv: list[str] = arg.split()
+        if argv not in ([], ["reset"]):
+            print("ERROR: Expected stats [reset]")
+            return
+        if self.phase_stats is None or len(self.phase_stats.histograms) == 0:
+            print("No timings recorded. Turn them on with timing on.")
+            return
+        with self.phase_stats.lock:
+            if len(argv) == 1:
+                self.phase_stats.histograms.clear()
+                return
+            print(f"{'phase':<24} {'count':>8} {'total':>10} {'mean':>9} " +
+                  f"{'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+            for phase, histogram in sorted(
+                    self.phase_stats.histograms.items()):
+                print(f"{phase:<24} {histogram.count:>8} " +
+                      f"{histogram.total * 1000:>10.1f} " +
+                      f"{histogram.total / histogram.count * 1000:>9.3f} " +
+                      " ".join(f"{histogram.percentile(fraction) * 1000:>9.3f}"
+                               for fraction in (0.5, 0.9, 0.99)) +
+                      f" {histogram.max * 1000:>9.3f}")
 
     def do_subnet4(self, arg) -> None:
         """
@@ -205,6 +2605,288 @@ class IpCatalogShell(cmd.Cmd):
             return
         self.print_subnet(subnet_length, True)
 
+    def do_timeline(self, arg) -> None:
+        """
+        Shows how often an IP, or all IPs in a CIDR, were seen in the logs
+        over the last WINDOW (default 1h), per minute and per log source.
+        Older activity is shown per hour. WINDOW is like 90s, 15m, 6h or 7d.
+        timeline <IP|CIDR> [WINDOW]
+        timeline 10.0.0.0/8 1d
+        """
+        argv: list[str] = arg.split()
+        if len(argv) < 1 or len(argv) > 2:
+            print(f"ERROR: Wrong number of arguments, expected 1 or 2, " +
+                  f"got {len(argv)}")
+            return
+        window: typing.Optional[int] = parse_duration(argv[1]) \
+                if len(argv) > 1 else 60 * 60
+        if window is None:
+            print(f"ERROR: Invalid window {argv[1]}")
+            return
+
+        self.init_db()
+        assert self.database is not None
+        where_clause, where_params = ip_filter(argv[0])
+        for bucket, total_count, source_counts in self.database.execute(
+                "SELECT bucket, SUM(count), group_concat(source || ' ' || " +
+                "count, ', ') FROM (SELECT bucket, source, SUM(count) AS " +
+                "count FROM sightings WHERE " + where_clause + " AND " +
+                "bucket>=? GROUP BY bucket, source) GROUP BY bucket " +
+                "ORDER BY bucket;",
+                (*where_params, int(time.time()) - window)):
+            print(time.strftime("%m/%d %H:%M", time.localtime(bucket)),
+                  f"{total_count:>8}", f"({source_counts})")
+
+    def do_timing(self, arg) -> None:
+        """
+        Turns timing of commands and their phases on or off; see stats for
+        the results. With TRACE_FILE, every timing is also appended to it as
+        a JSON line for offline analysis.
+        timing [on [TRACE_FILE]|off]
+        timing on /tmp/ipcatalog-trace.jsonl
+        """
+        argv: list[str] = arg.split()
+        if len(argv) == 0:
+            trace_file: typing.Optional[typing.TextIO] = None \
+                    if self.phase_stats is None \
+                    else self.phase_stats.trace_file
+            print("Timing is " +
+                  ("off" if self.phase_timer is None else "on") +
+                  ("" if trace_file is None
+                   else f", tracing to {trace_file.name}"))
+            return
+        if argv[0] not in ("on", "off") or len(argv) > 2 or \
+                (argv[0] == "off" and len(argv) > 1):
+            print("ERROR: Expected timing [on [TRACE_FILE]|off]")
+            return
+        if self.phase_stats is None:
+            self.phase_stats = PhaseTimer()
+        with self.phase_stats.lock:
+            if self.phase_stats.trace_file is not None:
+                self.phase_stats.trace_file.close()
+                self.phase_stats.trace_file = None
+            if len(argv) == 2:
+                try:
+                    self.phase_stats.trace_file = open(argv[1], "a",
+                                                       buffering=1)
+                except OSError as e:
+                    print(f"ERROR: Could not open {argv[1]}: {e}")
+                    return
+        self.set_phase_timer(self.phase_stats if argv[0] == "on" else None)
+
+    def do_top(self, arg) -> None:
+        """
+        Shows the IPs seen the most in the logs over the last WINDOW
+        (default 15m), with their classification. WINDOW is like 90s, 15m,
+        6h or 7d.
+        top [WINDOW] [COUNT]
+        top 1h 50
+        """
+        argv: list[str] = arg.split()
+        if len(argv) > 2:
+            print(f"ERROR: Wrong number of arguments, expected 0 to 2, " +
+                  f"got {len(argv)}")
+            return
+        window: typing.Optional[int] = parse_duration(argv[0]) \
+                if len(argv) > 0 else 15 * 60
+        if window is None:
+            print(f"ERROR: Invalid window {argv[0]}")
+            return
+        top_count: int = 20
+        if len(argv) > 1:
+            try:
+                top_count = int(argv[1])
+            except ValueError:
+                print(f"ERROR: Expected an integer, not {argv[1]}")
+                return
+
+        self.init_db()
+        assert self.database is not None
+        for ip_address_str, hit_count, source_counts, score in \
+                self.database.execute("SELECT top.ip, top.hits, " +
+                "top.sources, ipaddress.score FROM (SELECT ip, SUM(count) " +
+                "AS hits, group_concat(source || ' ' || count, ', ') AS " +
+                "sources FROM (SELECT ip, source, SUM(count) AS count FROM " +
+                "sightings WHERE bucket>=? GROUP BY ip, source) GROUP BY " +
+                "ip ORDER BY hits DESC LIMIT ?) AS top LEFT JOIN ipaddress " +
+                "ON ipaddress.ip=top.ip ORDER BY top.hits DESC;",
+                (int(time.time()) - window, top_count)):
+            print(f"{ip_address_str:<39} {hit_count:>8} " +
+                  f"{SCORE_TO_CLASSIFICATION.get(score, 'NA'):<2} " +
+                  f"({source_counts})")
+
+    def do_tree(self, arg) -> None:
+        """
+        Shows the hottest IPv4 subnets as a hierarchy, with the total score of
+        every subnet. Subnets scoring below MIN_SCORE are left out, and so are
+        branches with nothing scoring at least MIN_SCORE. Defaults to 8 32 1.
+        tree [MIN_PREFIX] [MAX_PREFIX] [MIN_SCORE]
+        tree 16 24 5
+        """
+        self.print_tree(arg, False)
+
+    def do_tree6(self, arg) -> None:
+        """
+        Shows the hottest IPv6 subnets as a hierarchy, with the total score of
+        every subnet. Subnets scoring below MIN_SCORE are left out, and so are
+        branches with nothing scoring at least MIN_SCORE. Defaults to 32 128 1.
+        tree6 [MIN_PREFIX] [MAX_PREFIX] [MIN_SCORE]
+        tree6 32 64 5
+        """
+        self.print_tree(arg, True)
+
+    def do_wait(self, arg) -> None:
+        """
+        Waits until every added IP has been enriched, or for at most SECONDS.
+        Ctrl-C stops waiting.
+        wait [SECONDS]
+        """
+        timeout: typing.Optional[float] = None
+        if arg.strip() != "":
+            try:
+                timeout = float(arg)
+            except ValueError:
+                print(f"ERROR: Expected a number of seconds, not {arg.strip()}")
+                return
+        if self.enrichment_queue is None:
+            return
+        try:
+            if not self.enrichment_queue.wait(timeout):
+                print("Enrichment still in progress")
+        except KeyboardInterrupt:
+            print()
+
+    def print_group_totals(self, column: str, argv: list[str]) -> None:
+        """
+        Prints the score and class counts of the IPs grouped by a column,
+        highest score first.
+
+        :param column: asn or isp.
+        :param argv: The arguments after top, if any: [COUNT].
+        """
+        top_count: int = 20
+        if len(argv) > 1:
+            print(f"ERROR: Wrong number of arguments, expected at most 1 " +
+                  f"after top, got {len(argv)}")
+            return
+        if len(argv) == 1:
+            try:
+                top_count = int(argv[0])
+            except ValueError:
+                print(f"ERROR: Expected an integer, not {argv[0]}")
+                return
+
+        self.init_db()
+        assert self.database is not None
+        # Only reads the (column, score) index.
+        group_rows: list[tuple] = self.database.execute(
+                f"SELECT {column}, SUM(score), COUNT(*), SUM(score=-3), " +
+                "SUM(score=-1), SUM(score=1), SUM(score=3) FROM ipaddress " +
+                f"WHERE {column} IS NOT NULL GROUP BY {column} " +
+                f"ORDER BY SUM(score) DESC, {column} LIMIT ?;",
+                (top_count,)).fetchall()
+        if column == "asn":
+            print("ASN: Score  IPs  B/PB/S/M  CC  ISP")
+            for asn, *group_totals in group_rows:
+                asn_row: typing.Optional[tuple] = self.database.execute(
+                        "SELECT cc, isp FROM ipaddress WHERE asn=? AND " +
+                        "isp IS NOT NULL LIMIT 1;", (asn,)).fetchone()
+                cc, isp = ("NA", "NA") if asn_row is None else asn_row
+                print(f"AS{asn}: Score {group_totals[0]}  IPs " +
+                      f"{group_totals[1]}  " +
+                      "/".join(str(i) for i in group_totals[2:]) +
+                      f"  {cc or 'NA'}  {isp}")
+        else:
+            print("Org: Score  IPs  B/PB/S/M  ASNs")
+            for isp, *group_totals in group_rows:
+                asns: list[str] = [f"AS{asn}" for asn, in self.database.execute(
+                        "SELECT DISTINCT asn FROM ipaddress WHERE isp=? " +
+                        "AND asn IS NOT NULL ORDER BY asn;", (isp,))]
+                if len(asns) > 5:
+                    asns[5:] = [f"+{len(asns) - 5} more"]
+                print(f"{isp}: Score {group_totals[0]}  IPs " +
+                      f"{group_totals[1]}  " +
+                      "/".join(str(i) for i in group_totals[2:]) +
+                      "  " + (", ".join(asns) or "NA"))
+
+    def escalate_group(self, column: str, value: typing.Any, name: str,
+                       argv: list[str]) -> None:
+        """
+        Handles the escalate action of the asn and org commands.
+
+        :param column: asn or isp.
+        :param value: The ASN or organization.
+        :param name: How to refer to the group in messages.
+        :param argv: The arguments after the group: [escalate, CLASSIFICATION].
+        """
+        if len(argv) != 2 or argv[0] != "escalate":
+            print("ERROR: Expected escalate <CLASSIFICATION>")
+            return
+        if argv[1] not in CLASSIFICATION_TO_SCORE:
+            print(f"ERROR: Invalid classification {argv[1]}, must be one " +
+                  "of (" + ", ".join(tuple(CLASSIFICATION_TO_SCORE)) + ")")
+            return
+        self.init_db()
+        assert self.database is not None
+        with self.write_transaction():
+            escalated_count: int = self.escalate_ips(
+                    f"{column}=?", (value,), CLASSIFICATION_TO_SCORE[argv[1]])
+        print(f"Escalated {escalated_count} IPs in {name} to {argv[1]}")
+
+    def print_tree(self, arg: str, ipv6: bool) -> None:
+        """
+        Parses the arguments of tree/tree6 and prints the tree.
+
+        :param ipv6: If True, will show IPv6 addresses.
+        """
+        ip_version: int = 6 if ipv6 else 4
+        address_bits: int = ipaddress.IPV6LENGTH if ipv6 \
+                else ipaddress.IPV4LENGTH
+        tree_args: list[int] = [32 if ipv6 else 8, address_bits, 1]
+        """MIN_PREFIX, MAX_PREFIX and MIN_SCORE"""
+        argv: list[str] = arg.split()
+        if len(argv) > 3:
+            print(f"ERROR: Wrong number of arguments, expected at most 3, " +
+                  f"got {len(argv)}")
+            return
+        for i, tree_arg in enumerate(argv):
+            try:
+                tree_args[i] = int(tree_arg)
+            except ValueError:
+                print(f"ERROR: Expected an integer, not {tree_arg}")
+                return
+        min_prefix, max_prefix, min_score = tree_args
+        if not 0 <= min_prefix <= max_prefix <= address_bits:
+            print("ERROR: Expected 0 <= MIN_PREFIX <= MAX_PREFIX <= " +
+                  str(address_bits))
+            return
+
+        self.init_db()
+        radix_tree: radixtree.RadixTree = radixtree.RadixTree.from_networks(
+                address_bits, max_prefix,
+                self.subnet_totals(max_prefix, ip_version))
+
+        print("Subnet: Score  B/PB/S/M")
+        address_class: type = IPv6Address if ipv6 else IPv4Address
+        node_stack: list[tuple[radixtree.RadixNode, int]] = \
+                [(radix_tree.root, 0)]
+        """Nodes left to visit and their indentation"""
+        while len(node_stack) > 0:
+            node, indent = node_stack.pop()
+            if node.best < min_score:
+                # Nothing in this branch is hot enough.
+                continue
+            child_indent: int = indent
+            if node.prefixlen >= min_prefix and node.score >= min_score:
+                print("  " * indent + str(address_class(node.network)) +
+                      f"/{node.prefixlen}: " +
+                      f"Score {format_score(node.score)}  " +
+                      f"{node.b}/{node.pb}/{node.s}/{node.m}")
+                child_indent += 1
+            # Reversed so that the highest scoring child is popped first.
+            for child in reversed(node.children()):
+                node_stack.append((child, child_indent))
+
     def print_subnet(self, subnet_length: int, ipv6: bool) -> None:
         """
         Prints the subnet information.
@@ -217,41 +2899,811 @@ class IpCatalogShell(cmd.Cmd):
             target_ip_version = 6
         self.init_db()
         assert self.database is not None
-        network_scores: dict[str, list[int]] = {}
-        """Maps network to [count, b, pb, s, m]"""
-        for ip_address_str, score in \
-                self.database.execute("SELECT ip, score FROM ipaddress;"):
+        for network_str, network_score in \
+                self.subnet_scores(subnet_length, target_ip_version):
+            print(network_str +
+                  f": Score {format_score(network_score[0])}  " +
+                  "/".join([str(i) for i in network_score[1:]]))
+
+    def subnet_scores(self, subnet_length: int, ip_version: int) \
+            -> list[tuple[str, list[float]]]:
+        """
+        Adds up the scores of all IPs by subnet.
+
+        :param subnet_length: The prefix length of the subnets.
+        :param ip_version: 4 or 6.
+        :return: (network, [score, b, pb, s, m]) pairs, highest score first.
+        """
+        host_bits: int = (ipaddress.IPV4LENGTH if ip_version == 4
+                          else ipaddress.IPV6LENGTH) - subnet_length
+        network_scores: dict[int, list[float]] = \
+                self.subnet_totals(subnet_length, ip_version)
+        network_int_to_str: typing.Callable[[int], str] = \
+                lambda network_int: str(IPv6Address(network_int))
+        if ip_version == 4:
+            # Much faster than going through IPv4Address, same output.
+            network_int_to_str = lambda network_int: socket.inet_ntoa(
+                    network_int.to_bytes(4, "big"))
+        subnet_suffix: str = f"/{subnet_length}"
+        subnet_strings_sort: list[tuple[float, str, list[float]]] = [
+            (network_score[0],
+             network_int_to_str(network_int << host_bits) + subnet_suffix,
+             network_score)
+            for network_int, network_score in network_scores.items()
+        ]
+        """List to use for sorting the subnet strings"""
+        subnet_strings_sort.sort(key=lambda subnet: subnet[:2], reverse=True)
+        return [(network_str, network_score)
+                for _, network_str, network_score in subnet_strings_sort]
+
+    def subnet_totals(self, subnet_length: int, ip_version: int) \
+            -> dict[int, list[float]]:
+        """
+        :return: The current scores and class counts of all subnets of a
+                 length, as read_subnet_totals returns them.
+        """
+        assert self.database is not None
+        return read_subnet_totals(self.database, subnet_length, ip_version)
+
+    @contextlib.contextmanager
+    def write_transaction(self, row_count: int = 1) -> typing.Iterator[bool]:
+        """
+        Runs the writes of a command as one transaction. Outside a batch it
+        is committed right away. Inside a batch started by begin or batch,
+        it becomes a savepoint in the batch's transaction, which is
+        committed once the batch has enough rows or its window has passed.
+
+        :param row_count: The number of rows the command writes.
+        :return: Whether the writes are part of a batch.
+        """
+        assert self.database is not None
+        if not self.explicit_batch and self.batch_limits is None:
+            with self.database:
+                yield False
+            return
+        assert self.batch_lock is not None
+        with self.batch_lock:
+            if not self.database.in_transaction:
+                self.database.execute("BEGIN;")
+                self.batch_rows = 0
+                self.batch_ips = []
+                if not self.explicit_batch:
+                    assert self.batch_limits is not None
+                    self.batch_timer = threading.Timer(self.batch_limits[1],
+                                                       self.commit_batch)
+                    self.batch_timer.daemon = True
+                    self.batch_timer.start()
+            self.database.execute("SAVEPOINT command;")
+            try:
+                yield True
+            except BaseException:
+                self.database.execute("ROLLBACK TO command;")
+                self.database.execute("RELEASE command;")
+                raise
+            self.database.execute("RELEASE command;")
+            self.batch_rows += row_count
+            if not self.explicit_batch and self.batch_limits is not None \
+                    and self.batch_rows >= self.batch_limits[0]:
+                self.commit_batch()
+
+    def commit_batch(self) -> None:
+        """
+        Commits the open batch, unless begin is holding it, and queues the
+        IPs added in it for enrichment. Called by the batch timer too.
+        """
+        if self.batch_lock is None:
+            return
+        with self.batch_lock:
+            if self.explicit_batch:
+                return
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            if self.database is not None and self.database.in_transaction:
+                self.database.commit()
+            self.batch_rows = 0
+            batch_ips: list[str] = self.batch_ips
+            self.batch_ips = []
+        self.submit_enrichment(batch_ips)
+
+    def submit_enrichment(self, ip_addresses: list[str]) -> None:
+        """
+        Queues IPs for background enrichment if any lookups are on. The
+        routing table only counts once one has been imported.
+        """
+        if len(ip_addresses) == 0 or not (self.rdns_lookup or
+                self.bgp_tools_lookup or
+                (self.routes_lookup and self.has_routes())):
+            return
+        if self.enrichment_queue is None:
+            self.enrichment_queue = EnrichmentQueue(self)
+        for ip_address_str in ip_addresses:
+            self.enrichment_queue.submit(ip_address_str)
+
+    def set_phase_timer(self, phase_timer: typing.Optional[PhaseTimer]) \
+            -> None:
+        """
+        Starts or stops timing in the shell, its enrichment worker and their
+        database connections.
+        """
+        self.phase_timer = phase_timer
+        if isinstance(self.database, TimedConnection):
+            self.database.phase_timer = phase_timer
+        if self.enrichment_queue is not None:
+            self.enrichment_queue.worker_shell.set_phase_timer(phase_timer)
+
+    def timed_query_rdns(self, ip_address_str: str) -> typing.Optional[str]:
+        """
+        Looks up the reverse DNS entry of an IP, recording how long it took
+        if timing is on.
+        """
+        if self.phase_timer is None:
+            return query_rdns(ip_address_str, self.rdns_server)
+        with self.phase_timer.timed("rdns", ip_address_str):
+            return query_rdns(ip_address_str, self.rdns_server)
+
+    def enrich(self, ip_addresses: typing.Iterable[str],
+               stats: typing.Optional[dict[str, float]] = None) \
+            -> dict[str, EnrichmentRecord]:
+        """
+        Looks up the rDNS and bgp.tools information for IPs. Fresh cache
+        entries are used where possible, including any cached prefix that
+        contains the IP, followed by the imported routing table. The rest are
+        looked up over the network in parallel and written back to the cache.
+        If there is a routing table, bgp.tools is only asked about IPs missing
+        from it when bgp_tools_fallback is set.
+
+        :param ip_addresses: Normalized IP address strings.
+        :param stats: If given, filled with counts and timings of the lookups.
+        :return: Maps each IP to its (asn, prefix, cc, rir, isp, rdns).
+        """
+        self.init_db()
+        assert self.database is not None
+        ip_address_list: list[str] = list(dict.fromkeys(ip_addresses))
+        now: int = int(time.time())
+
+        rdns_results: dict[str, typing.Optional[str]] = {}
+        rdns_misses: list[str] = []
+        if self.rdns_lookup:
+            for ip_address_str in ip_address_list:
+                cached_rdns: typing.Optional[tuple] = \
+                        self.cache_lookup_rdns(ip_address_str, now)
+                if cached_rdns is None:
+                    rdns_misses.append(ip_address_str)
+                else:
+                    rdns_results[ip_address_str] = cached_rdns[0]
+
+        bgp_tools_results: dict[str, BgpToolsRecord] = {}
+        bgp_tools_misses: list[str] = []
+        route_hits: int = 0
+        if self.bgp_tools_lookup or self.routes_lookup:
+            cached_prefix_lengths: list[int] = self.cache_prefix_lengths() \
+                    if self.bgp_tools_lookup else []
+            have_routes: bool = self.routes_lookup and self.has_routes()
+            for ip_address_str in ip_address_list:
+                if not ipaddress.ip_address(ip_address_str).is_global:
+                    continue
+                if self.bgp_tools_lookup:
+                    cached_bgp_tools: typing.Optional[BgpToolsRecord] = \
+                            self.cache_lookup_bgp_tools(ip_address_str, now,
+                                                        cached_prefix_lengths)
+                    if cached_bgp_tools is not None:
+                        bgp_tools_results[ip_address_str] = cached_bgp_tools
+                        continue
+                if have_routes:
+                    route: typing.Optional[BgpToolsRecord] = \
+                            self.lookup_route(ip_address_str)
+                    if route is not None:
+                        bgp_tools_results[ip_address_str] = route
+                        route_hits += 1
+                        continue
+                if self.bgp_tools_lookup and \
+                        (not have_routes or self.bgp_tools_fallback):
+                    bgp_tools_misses.append(ip_address_str)
+
+        if stats is not None:
+            stats["rdns_cached"] = len(rdns_results)
+            stats["rdns_queried"] = len(rdns_misses)
+            stats["rdns_time"] = 0
+            stats["bgp_cached"] = len(bgp_tools_results) - route_hits
+            stats["routes"] = route_hits
+            stats["bgp_queried"] = len(bgp_tools_misses)
+            stats["bgp_time"] = 0
+
+        def timed_bgp_tools_query() -> tuple[dict[str, BgpToolsRecord], float]:
+            bgp_tools_start_time: float = time.perf_counter()
+            return (query_bgp_tools(bgp_tools_misses, self.bgp_tools_server,
+                                    phase_timer=self.phase_timer),
+                    time.perf_counter() - bgp_tools_start_time)
+
+        new_rdns_results: dict[str, typing.Optional[str]] = {}
+        new_bgp_tools_results: dict[str, BgpToolsRecord] = {}
+        bgp_tools_failed: bool = False
+        if len(rdns_misses) > 0 or len(bgp_tools_misses) > 0:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, self.rdns_workers)) as executor:
+                # Kick off the bulk bgp.tools query first so it overlaps with
+                # the reverse DNS lookups.
+                bgp_tools_future: typing.Optional[concurrent.futures.Future] = \
+                        None
+                if len(bgp_tools_misses) > 0:
+                    bgp_tools_future = executor.submit(timed_bgp_tools_query)
+                rdns_start_time: float = time.perf_counter()
+                for ip_address_str, reverse_dns_entry in zip(
+                        rdns_misses, executor.map(self.timed_query_rdns,
+                                                  rdns_misses)):
+                    new_rdns_results[ip_address_str] = reverse_dns_entry
+                if stats is not None:
+                    stats["rdns_time"] = time.perf_counter() - rdns_start_time
+                if bgp_tools_future is not None:
+                    try:
+                        new_bgp_tools_results, bgp_tools_time = \
+                                bgp_tools_future.result()
+                        if stats is not None:
+                            stats["bgp_time"] = bgp_tools_time
+                    except TimeoutError:
+                        print("WARNING: Timed out when contacting bgp.tools.")
+                        bgp_tools_failed = True
+                    except OSError as e:
+                        print(f"WARNING: Failed to contact bgp.tools: {e}")
+                        bgp_tools_failed = True
+            unanswered_count: int = len(bgp_tools_misses) - \
+                    len(new_bgp_tools_results)
+            if not bgp_tools_failed and unanswered_count > 0:
+                print("WARNING: bgp.tools returned corrupt response for " +
+                      f"{unanswered_count} of {len(bgp_tools_misses)} IPs")
+            rdns_results.update(new_rdns_results)
+            bgp_tools_results.update(new_bgp_tools_results)
+            if self.use_cache:
+                self.cache_store(now, new_rdns_results, bgp_tools_misses,
+                                 new_bgp_tools_results)
+
+        return {ip_address_str: bgp_tools_results.get(
+                    ip_address_str, EMPTY_BGP_TOOLS_RECORD) +
+                    (rdns_results.get(ip_address_str),)
+                for ip_address_str in ip_address_list}
+
+    def has_routes(self) -> bool:
+        """
+        :return: Whether a routing table has been imported.
+        """
+        self.init_db()
+        assert self.database is not None
+        return self.database.execute(
+                "SELECT 1 FROM routes LIMIT 1;").fetchone() is not None
+
+    def lookup_route(self, ip_address_str: str) \
+            -> typing.Optional[BgpToolsRecord]:
+        """
+        Finds the most specific prefix containing an IP in the imported
+        routing table.
+
+        :return: The route as a bgp.tools record, or None if not routed.
+        """
+        assert self.database is not None
+        ip_address_obj: typing.Union[IPv4Address, IPv6Address] = \
+                ipaddress.ip_address(ip_address_str)
+        route_row: typing.Optional[tuple] = self.database.execute(
+                "SELECT netend, asn, prefix, cc, rir, isp FROM routes " +
+                "WHERE version=? AND netstart<=? " +
+                "ORDER BY netstart DESC LIMIT 1;",
+                (ip_address_obj.version, ip_address_obj.packed)).fetchone()
+        if route_row is None or route_row[0] < ip_address_obj.packed:
+            return None
+        return (None if route_row[1] is None else str(route_row[1]),
+                *route_row[2:])
+
+    def import_routes(self, routes_path: pathlib.Path) -> bool:
+        """
+        Replaces the routing table with a pfx2as or CSV dump.
+
+        :param routes_path: The file to import.
+        :return: True if the file was imported, False on error.
+        """
+        start_time: float = time.perf_counter()
+        routes_by_version: dict[int, dict[tuple[int, int], tuple]] = \
+                {4: {}, 6: {}}
+        """Maps (network, prefix length) to its route, per IP version"""
+        try:
+            with open(routes_path, newline="") as routes_file:
+                for line in routes_file:
+                    if line.startswith("#"):
+                        continue
+                    parsed_route: typing.Optional[tuple] = \
+                            parse_route_line(line)
+                    if parsed_route is None:
+                        continue
+                    network, *record = parsed_route
+                    routes_by_version[network.version][(
+                        int(network.network_address), network.prefixlen
+                    )] = (str(network), *record)
+        except OSError as e:
+            print(f"ERROR: Could not read {routes_path}: {e}")
+            return False
+
+        self.init_db()
+        assert self.database is not None
+        range_count: int = 0
+        with self.database:
+            self.database.execute("DELETE FROM routes;")
+            for ip_version, routes in routes_by_version.items():
+                address_bytes: int = (ipaddress.IPV4LENGTH if ip_version == 4
+                                      else ipaddress.IPV6LENGTH) // 8
+                address_bits: int = address_bytes * 8
+                route_ranges: list[tuple] = list(flatten_routes([
+                    (network_int,
+                     network_int | ((1 << (address_bits - prefixlen)) - 1),
+                     prefixlen, record)
+                    for (network_int, prefixlen), record in routes.items()
+                ]))
+                range_count += len(route_ranges)
+                self.database.executemany("INSERT INTO routes " +
+                        "(version, netstart, netend, prefix, asn, cc, rir, " +
+                        "isp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", (
+                    (ip_version, start.to_bytes(address_bytes, "big"),
+                     end.to_bytes(address_bytes, "big"), *record)
+                    for start, end, record in route_ranges
+                ))
+        prefix_count: int = sum(len(routes)
+                                for routes in routes_by_version.values())
+        print(f"Imported {prefix_count} prefixes as {range_count} ranges " +
+              f"in {time.perf_counter() - start_time:.2f}s")
+        return True
+
+    def cache_lookup_rdns(self, ip_address_str: str, now: int) \
+            -> typing.Optional[tuple[typing.Optional[str]]]:
+        """
+        Looks up a fresh cached reverse DNS entry.
+
+        :return: None on a cache miss, otherwise a 1-tuple with the hostname,
+                 which is None for a cached failure.
+        """
+        if not self.use_cache:
+            return None
+        assert self.database is not None
+        return self.database.execute("SELECT rdns FROM enrichcache " +
+                "WHERE source='rdns' AND key=? AND fetched>=CASE negative " +
+                "WHEN 1 THEN ? ELSE ? END;", (
+            ip_address_str,
+            now - self.negative_cache_ttl,
+            now - self.rdns_cache_ttl,
+        )).fetchone()
+
+    def cache_prefix_lengths(self) -> list[int]:
+        """
+        :return: The distinct prefix lengths in the bgp.tools cache.
+        """
+        if not self.use_cache:
+            return []
+        assert self.database is not None
+        return [row[0] for row in self.database.execute(
+                "SELECT DISTINCT prefixlen FROM enrichcache " +
+                "WHERE source='bgp';")]
+
+    def cache_lookup_bgp_tools(self, ip_address_str: str, now: int,
+                               prefix_lengths: list[int]) \
+            -> typing.Optional[BgpToolsRecord]:
+        """
+        Finds the longest fresh cached prefix containing an IP.
+
+        :param prefix_lengths: The prefix lengths to try, as returned by
+                               cache_prefix_lengths().
+        :return: None on a cache miss, otherwise the cached record, which is
+                 all None for a cached failure.
+        """
+        if not self.use_cache or len(prefix_lengths) == 0:
+            return None
+        assert self.database is not None
+        ip_address_obj: typing.Union[IPv4Address, IPv6Address] = \
+                ipaddress.ip_address(ip_address_str)
+        ip_address_int: int = int(ip_address_obj)
+        max_prefix_length: int = ip_address_obj.max_prefixlen
+        supernets: list[str] = [
+            str(type(ip_address_obj)(ip_address_int >>
+                    (max_prefix_length - prefix_length) <<
+                    (max_prefix_length - prefix_length))) +
+                    f"/{prefix_length}"
+            for prefix_length in prefix_lengths
+            if prefix_length <= max_prefix_length
+        ]
+        cached_row: typing.Optional[tuple] = self.database.execute(
+                "SELECT key, asn, cc, rir, isp, negative FROM enrichcache " +
+                "WHERE source='bgp' AND key IN (" +
+                ",".join("?" * len(supernets)) + ") AND fetched>=CASE " +
+                "negative WHEN 1 THEN ? ELSE ? END " +
+                "ORDER BY prefixlen DESC LIMIT 1;", (
+            *supernets,
+            now - self.negative_cache_ttl,
+            now - self.bgp_tools_cache_ttl,
+        )).fetchone()
+        if cached_row is None:
+            return None
+        if cached_row[5]:
+            return EMPTY_BGP_TOOLS_RECORD
+        return (None if cached_row[1] is None else str(cached_row[1]),
+                cached_row[0], cached_row[2], cached_row[3], cached_row[4])
+
+    def cache_store(self, now: int,
+                    rdns_results: dict[str, typing.Optional[str]],
+                    bgp_tools_queried: list[str],
+                    bgp_tools_results: dict[str, BgpToolsRecord]) -> None:
+        """
+        Writes fresh lookup results to the cache. IPs that were queried
+        with bgp.tools but got no answer are cached as negative entries.
+        """
+        assert self.database is not None
+        cache_rows: list[tuple] = []
+        for ip_address_str, reverse_dns_entry in rdns_results.items():
+            cache_rows.append(("rdns", ip_address_str, None, None, None, None,
+                               None, reverse_dns_entry, now,
+                               int(reverse_dns_entry is None)))
+        for ip_address_str in bgp_tools_queried:
+            if ip_address_str in bgp_tools_results:
+                asn, prefix, cc, rir, isp = bgp_tools_results[ip_address_str]
+                try:
+                    prefix_network: typing.Union[IPv4Network, IPv6Network] = \
+                            ipaddress.ip_network(prefix, strict=False)
+                except (TypeError, ValueError):
+                    continue
+                cache_rows.append(("bgp", str(prefix_network),
+                                   prefix_network.prefixlen, asn, cc, rir,
+                                   isp, None, now, 0))
+            else:
+                host_network: typing.Union[IPv4Network, IPv6Network] = \
+                        ipaddress.ip_network(ip_address_str)
+                cache_rows.append(("bgp", str(host_network),
+                                   host_network.prefixlen, None, None, None,
+                                   None, None, now, 1))
+        with self.database:
+            self.database.executemany("INSERT OR REPLACE INTO enrichcache " +
+                    "(source, key, prefixlen, asn, cc, rir, isp, rdns, " +
+                    "fetched, negative) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    cache_rows)
+
+    def upsert_ips(self, rows: typing.Iterable[tuple],
+                   keep_enrichment: bool = False) -> None:
+        """
+        Inserts or updates IPs and keeps the subnet rollups up to date. Does
+        not commit, so callers can group writes into one transaction.
+
+        :param rows: Rows in the same order as the columns of
+                     UPSERT_IP_STATEMENT up to global, optionally followed
+                     by when the IP was classified, which defaults to now.
+        :param keep_enrichment: If set, existing IPs only get their score
+                                and global flag updated.
+        """
+        assert self.database is not None
+        now: int = int(time.time())
+        decay_settings: DecaySettings = self.decay_settings(now)
+        new_rows: dict[str, tuple] = {
+            row[0]: (*row[:11], scored_time,
+                     decay_weight(row[9], scored_time, decay_settings),
+                     scored_time)
+            for row in rows
+            for scored_time in (row[11] if len(row) > 11 else now,)
+        }
+        """Maps IP to its row, so the last write of an IP wins"""
+        rollup_lengths: list[tuple[int, int]] = self.rollup_lengths()
+        rollup_deltas: dict[tuple[int, int, bytes], list[int]] = {}
+        if len(rollup_lengths) > 0:
+            ip_address_list: list[str] = list(new_rows)
+            unchanged_ips: set[str] = set()
+            """IPs whose score stays the same, which the rollups skip"""
+            for batch_start in range(0, len(ip_address_list),
+                                     SQL_VARIABLE_BATCH):
+                ip_address_batch: list[str] = ip_address_list[
+                        batch_start:batch_start + SQL_VARIABLE_BATCH]
+                for ip_address_str, version, ipbin, score in \
+                        self.database.execute(
+                        "SELECT ip, version, ipbin, score FROM ipaddress " +
+                        "WHERE ip IN (" +
+                        ",".join("?" * len(ip_address_batch)) + ");",
+                        ip_address_batch):
+                    if score == new_rows[ip_address_str][9]:
+                        unchanged_ips.add(ip_address_str)
+                        continue
+                    self.add_rollup_delta(rollup_deltas, rollup_lengths,
+                                          version, ipbin, score, -1)
+            for ip_address_str, row in new_rows.items():
+                if ip_address_str not in unchanged_ips:
+                    self.add_rollup_delta(rollup_deltas, rollup_lengths,
+                                          row[1], row[2], row[9], 1)
+        self.database.executemany(UPSERT_IP_SCORE_STATEMENT if
+                keep_enrichment else UPSERT_IP_STATEMENT, new_rows.values())
+        self.apply_rollup_deltas(rollup_deltas)
+
+    def delete_ips(self, where_clause: str, where_params: tuple) -> int:
+        """
+        Deletes IPs and keeps the subnet rollups up to date. Does not commit.
+
+        :param where_clause: SQL condition selecting the rows to delete.
+        :param where_params: Parameters of the condition.
+        :return: The number of IPs deleted.
+        """
+        assert self.database is not None
+        rollup_lengths: list[tuple[int, int]] = self.rollup_lengths()
+        rollup_deltas: dict[tuple[int, int, bytes], list[int]] = {}
+        if len(rollup_lengths) > 0:
+            for version, ipbin, score in self.database.execute(
+                    "SELECT version, ipbin, score FROM ipaddress WHERE " +
+                    where_clause + ";", where_params):
+                self.add_rollup_delta(rollup_deltas, rollup_lengths,
+                                      version, ipbin, score, -1)
+        self.database.execute("DELETE FROM wafhits WHERE ip IN " +
+                "(SELECT ip FROM ipaddress WHERE " + where_clause + ");",
+                where_params)
+        self.database.execute("DELETE FROM sightings WHERE (version, ipbin) " +
+                "IN (SELECT version, ipbin FROM ipaddress WHERE " +
+                where_clause + ");", where_params)
+        deleted_count: int = self.database.execute(
+                "DELETE FROM ipaddress WHERE " + where_clause + ";",
+                where_params).rowcount
+        self.apply_rollup_deltas(rollup_deltas)
+        return deleted_count
+
+    def escalate_ips(self, where_clause: str, where_params: tuple,
+                     score: int) -> int:
+        """
+        Raises the score of IPs below a score to it, leaving IPs classified
+        as b alone, and keeps the subnet rollups up to date. Does not commit.
+
+        :param where_clause: SQL condition selecting the IPs.
+        :param where_params: Parameters of the condition.
+        :param score: The new score.
+        :return: The number of IPs escalated.
+        """
+        assert self.database is not None
+        escalate_clause: str = f"({where_clause}) AND score<? AND score!=?"
+        escalate_params: tuple = (*where_params, score,
+                                  CLASSIFICATION_TO_SCORE["b"])
+        rollup_lengths: list[tuple[int, int]] = self.rollup_lengths()
+        rollup_deltas: dict[tuple[int, int, bytes], list[int]] = {}
+        if len(rollup_lengths) > 0:
+            for version, ipbin, old_score in self.database.execute(
+                    "SELECT version, ipbin, score FROM ipaddress WHERE " +
+                    escalate_clause + ";", escalate_params):
+                self.add_rollup_delta(rollup_deltas, rollup_lengths,
+                                      version, ipbin, old_score, -1)
+                self.add_rollup_delta(rollup_deltas, rollup_lengths,
+                                      version, ipbin, score, 1)
+        now: int = int(time.time())
+        decay_settings: DecaySettings = self.decay_settings(now)
+        escalated_count: int = self.database.execute(
+                "UPDATE ipaddress SET score=?, scoredtime=?, decayweight=?, " +
+                "modified=? WHERE " + escalate_clause + ";",
+                (score, now, decay_weight(score, now, decay_settings), now,
+                 *escalate_params)).rowcount
+        self.apply_rollup_deltas(rollup_deltas)
+        return escalated_count
+
+    def record_sightings(self, sightings: dict[str, "Sighting"]) -> list[str]:
+        """
+        Adds log sightings to the catalog and scores the IPs automatically.
+        New IPs become pb, or s once they trigger the WAF, or m after
+        MALICIOUS_WAF_HITS WAF hits. Known IPs are only ever escalated this
+        way, and IPs classified as b are left alone. Does not commit.
+
+        :param sightings: Maps normalized IP to what was seen of it.
+        :return: The IPs that were not in the catalog before.
+        """
+        assert self.database is not None
+        known_ips: dict[str, tuple[int, int, typing.Optional[int]]] = {}
+        """Maps IP to its current (score, wafhits, scoredtime)"""
+        ip_address_list: list[str] = list(sightings)
+        for batch_start in range(0, len(ip_address_list), SQL_VARIABLE_BATCH):
+            ip_address_batch: list[str] = ip_address_list[
+                    batch_start:batch_start + SQL_VARIABLE_BATCH]
+            for ip_address_str, score, waf_hits, scored_time in \
+                    self.database.execute("SELECT ip, score, wafhits, " +
+                    "scoredtime FROM ipaddress WHERE ip IN (" +
+                    ",".join("?" * len(ip_address_batch)) + ");",
+                    ip_address_batch):
+                known_ips[ip_address_str] = (score, waf_hits, scored_time)
+
+        new_ips: list[str] = []
+        score_rows: list[tuple] = []
+        sighting_scores: dict[str, tuple[int, int]] = {}
+        """
+        Maps IP to its score and scoredtime after this batch. Being seen
+        again restarts the decay of the score.
+        """
+        for ip_address_str, sighting in sightings.items():
+            known_ip: typing.Optional[tuple] = known_ips.get(ip_address_str)
+            scored_time: int = sighting.last_seen if known_ip is None \
+                    else max(known_ip[2] or 0, sighting.last_seen)
+            total_waf_hits: int = sighting.waf_hits + \
+                    (0 if known_ip is None else known_ip[1])
+            auto_score: int = CLASSIFICATION_TO_SCORE["pb"]
+            if total_waf_hits >= MALICIOUS_WAF_HITS:
+                auto_score = CLASSIFICATION_TO_SCORE["m"]
+            elif total_waf_hits > 0:
+                auto_score = CLASSIFICATION_TO_SCORE["s"]
+            if known_ip is None:
+                new_ips.append(ip_address_str)
+            elif known_ip[0] == CLASSIFICATION_TO_SCORE["b"] or \
+                    known_ip[0] >= auto_score:
+                sighting_scores[ip_address_str] = (known_ip[0], scored_time)
+                continue
+            sighting_scores[ip_address_str] = (auto_score, scored_time)
             ip_address_obj: typing.Union[IPv4Address, IPv6Address] = \
                     ipaddress.ip_address(ip_address_str)
-            if ip_address_obj.version != target_ip_version:
-                # Skip this network. Wrong IP version
+            score_rows.append((ip_address_str, ip_address_obj.version,
+                               ip_address_obj.packed, *EMPTY_BGP_TOOLS_RECORD,
+                               None, auto_score,
+                               int(ip_address_obj.is_global)))
+        self.upsert_ips(score_rows, keep_enrichment=True)
+        decay_settings: DecaySettings = self.decay_settings()
+        self.database.executemany(UPDATE_SIGHTINGS_STATEMENT, (
+            (sighting.hits, sighting.waf_hits, sighting.first_seen,
+             sighting.first_seen, sighting.last_seen, sighting.last_seen,
+             scored_time, decay_weight(score, scored_time, decay_settings),
+             ip_address_str)
+            for ip_address_str, sighting in sightings.items()
+            for score, scored_time in (sighting_scores[ip_address_str],)
+        ))
+        self.database.executemany(UPDATE_WAF_HITS_STATEMENT, (
+            (ip_address_str, rule, rule_hits, sighting.last_seen)
+            for ip_address_str, sighting in sightings.items()
+            for rule, rule_hits in sighting.rule_hits.items()
+        ))
+        self.database.executemany(UPDATE_SIGHTINGS_BUCKET_STATEMENT, (
+            (minute, ip_address_str, ip_address_obj.version,
+             ip_address_obj.packed, source, minute_hits)
+            for ip_address_str, sighting in sightings.items()
+            for ip_address_obj in (ipaddress.ip_address(ip_address_str),)
+            for (minute, source), minute_hits in sighting.minute_hits.items()
+        ))
+        return new_ips
+
+    def compact_sightings(self, now: int) -> None:
+        """
+        Merges per-minute sightings older than SIGHTINGS_MINUTE_RETENTION
+        into hours and drops those older than SIGHTINGS_RETENTION. The first
+        minute of each hour doubles as the hour's bucket. Does not commit.
+        """
+        assert self.database is not None
+        hour_cutoff: int = now - SIGHTINGS_MINUTE_RETENTION
+        hour_cutoff -= hour_cutoff % 3600
+        self.database.execute("INSERT INTO sightings " +
+                "(bucket, ip, version, ipbin, source, count) " +
+                "SELECT bucket - bucket % 3600, ip, version, ipbin, source, " +
+                "SUM(count) FROM sightings WHERE bucket<? AND " +
+                "bucket % 3600!=0 GROUP BY bucket - bucket % 3600, ip, " +
+                "source ON CONFLICT DO UPDATE SET count=count+excluded.count;",
+                (hour_cutoff,))
+        self.database.execute("DELETE FROM sightings WHERE bucket<? AND " +
+                              "bucket % 3600!=0;", (hour_cutoff,))
+        self.database.execute("DELETE FROM sightings WHERE bucket<?;",
+                              (now - SIGHTINGS_RETENTION,))
+
+    def decay_settings(self, rebase_time: typing.Optional[int] = None) \
+            -> DecaySettings:
+        """
+        Reads the half-lives of the decaying scores.
+
+        :param rebase_time: If given, first moves the landmark of any score
+                            more than DECAY_REBASE_HALF_LIVES half-lives
+                            behind this time up to it, rescaling the
+                            decayweights to match. Does not commit.
+        """
+        assert self.database is not None
+        decay_settings: DecaySettings = read_decay_settings(self.database)
+        if rebase_time is None:
+            return decay_settings
+        for score, factor in decay_factors(decay_settings,
+                                           rebase_time).items():
+            halflife, landmark = decay_settings[score]
+            if rebase_time - landmark <= DECAY_REBASE_HALF_LIVES * halflife:
                 continue
-            ip_network: typing.Union[IPv4Network, IPv6Network] = \
-                    ipaddress.ip_network(ip_address_str)\
-                    .supernet(new_prefix=subnet_length)
-            network_str: str = str(ip_network)
-            if network_str not in network_scores:
-                network_scores[network_str] = [0, 0, 0, 0, 0]
-            network_scores[network_str][0] += score
-            if score == -3:
-                network_scores[network_str][1] += 1
-            elif score == -1:
-                network_scores[network_str][2] += 1
-            elif score == 1:
-                network_scores[network_str][3] += 1
-            elif score == 3:
-                network_scores[network_str][4] += 1
-        subnet_strings_sort: list[tuple[int, str]] = []
-        """List to use for sorting the subnet strings"""
-        for network_ip, network_score in network_scores.items():
-            subnet_strings_sort.append((
-                network_score[0], 
-                network_ip + f": Score {network_score[0]}  " + 
-                        "/".join([str(i) for i in network_score[1:]]),
+            self.database.execute("UPDATE ipaddress SET decayweight=" +
+                                  "decayweight*? WHERE score=?;",
+                                  (factor, score))
+            self.database.execute("UPDATE decay SET landmark=? WHERE score=?;",
+                                  (rebase_time, score))
+            decay_settings[score] = (halflife, rebase_time)
+        return decay_settings
+
+    def rollup_lengths(self) -> list[tuple[int, int]]:
+        """
+        :return: The (version, prefix length) of each maintained rollup.
+        """
+        assert self.database is not None
+        return read_rollup_lengths(self.database)
+
+    @staticmethod
+    def add_rollup_delta(rollup_deltas: dict[tuple[int, int, bytes],
+                                             list[int]],
+                         rollup_lengths: list[tuple[int, int]],
+                         ip_version: int, ipbin: bytes, score: int,
+                         sign: int) -> None:
+        """
+        Adds or subtracts one IP from the pending changes to the rollups.
+
+        :param rollup_deltas: Maps (version, prefix length, network) to the
+                              change in [count, score, b, pb, s, m].
+        :param sign: 1 to add the IP, -1 to remove it.
+        """
+        address_bits: int = len(ipbin) * 8
+        ip_address_int: int = int.from_bytes(ipbin, "big")
+        for rollup_version, rollup_length in rollup_lengths:
+            if rollup_version != ip_version:
+                continue
+            host_bits: int = address_bits - rollup_length
+            rollup_key: tuple[int, int, bytes] = (
+                ip_version,
+                rollup_length,
+                (ip_address_int >> host_bits << host_bits).to_bytes(
+                        len(ipbin), "big"),
+            )
+            if rollup_key not in rollup_deltas:
+                rollup_deltas[rollup_key] = [0, 0, 0, 0, 0, 0]
+            rollup_delta: list[int] = rollup_deltas[rollup_key]
+            rollup_delta[0] += sign
+            rollup_delta[1] += sign * score
+            if score in SCORE_TO_ROLLUP_COLUMN:
+                rollup_delta[SCORE_TO_ROLLUP_COLUMN[score]] += sign
+
+    def apply_rollup_deltas(self, rollup_deltas: dict[tuple[int, int, bytes],
+                                                      list[int]]) -> None:
+        """
+        Writes pending changes to the rollups, dropping subnets that no
+        longer contain any IPs.
+        """
+        assert self.database is not None
+        if len(rollup_deltas) == 0:
+            return
+        self.database.executemany(UPDATE_ROLLUP_STATEMENT, (
+            rollup_key + tuple(rollup_delta)
+            for rollup_key, rollup_delta in rollup_deltas.items()
+            if any(rollup_delta)
+        ))
+        # Only subnets that lost IPs can have become empty. Looking them up
+        # by key keeps a single add from scanning the whole rollup table.
+        self.database.executemany("DELETE FROM subnetrollup WHERE version=? " +
+                "AND prefixlen=? AND network=? AND count<=0;", (
+            rollup_key
+            for rollup_key, rollup_delta in rollup_deltas.items()
+            if rollup_delta[0] < 0
+        ))
+
+    def rebuild_rollups(self, rollup_lengths: typing.Optional[
+                typing.Iterable[tuple[int, int]]] = None) -> None:
+        """
+        Recomputes rollups from scratch. Does not commit.
+
+        :param rollup_lengths: The (version, prefix length) to rebuild, or
+                               None for all of them.
+        """
+        assert self.database is not None
+        if rollup_lengths is None:
+            rollup_lengths = self.rollup_lengths()
+        for ip_version, subnet_length in rollup_lengths:
+            self.database.execute("DELETE FROM subnetrollup WHERE " +
+                    "version=? AND prefixlen=?;", (ip_version, subnet_length))
+            address_bits: int = ipaddress.IPV4LENGTH if ip_version == 4 \
+                    else ipaddress.IPV6LENGTH
+            prefix_bytes: int = (subnet_length + 7) // 8
+            extra_bits: int = prefix_bytes * 8 - subnet_length
+            host_bits: int = address_bits - subnet_length
+            rollup: dict[bytes, list[int]] = {}
+            for network_blob, *network_totals in self.database.execute(
+                    "SELECT substr(ipbin, 1, ?) AS network, COUNT(*), " +
+                    "SUM(score), SUM(score=-3), SUM(score=-1), " +
+                    "SUM(score=1), SUM(score=3) FROM ipaddress " +
+                    "WHERE version=? GROUP BY network;",
+                    (prefix_bytes, ip_version)).fetchall():
+                network_key: bytes = (int.from_bytes(network_blob, "big") >>
+                        extra_bits << host_bits).to_bytes(address_bits // 8,
+                                                          "big")
+                if network_key not in rollup:
+                    rollup[network_key] = network_totals
+                else:
+                    for i, value in enumerate(network_totals):
+                        rollup[network_key][i] += value
+            self.database.executemany(UPDATE_ROLLUP_STATEMENT, (
+                (ip_version, subnet_length, network_key, *network_totals)
+                for network_key, network_totals in rollup.items()
             ))
-        subnet_strings_sort.sort()
-        for subnet_string in reversed(subnet_strings_sort):
-            print(subnet_string[1])
 
     def init_db(self) -> None:
         """
@@ -260,13 +3712,158 @@ class IpCatalogShell(cmd.Cmd):
         if self.database is None:
             # Connect to the database and create the IP table if it doesn't
             # exist.
-            self.database = sqlite3.connect(self.database_path)
+            # The batch timer commits from its own thread, serialized by
+            # batch_lock.
+            self.database = sqlite3.connect(self.database_path,
+                                            timeout=DATABASE_BUSY_TIMEOUT,
+                                            factory=TimedConnection,
+                                            check_same_thread=False)
+            self.database.phase_timer = self.phase_timer
+            # WAL lets readers like ipcatalogd and the enrichment worker
+            # carry on while the shell writes, and with synchronous=NORMAL a
+            # commit only appends to the WAL instead of waiting for fsync.
+            self.database.execute("PRAGMA journal_mode=WAL;")
+            self.database.execute("PRAGMA synchronous=NORMAL;")
+            self.database.execute(
+                    f"PRAGMA cache_size={DATABASE_CACHE_SIZE};")
             self.database.execute(CREATE_IP_TABLE_STATEMENT)
+            self.migrate_db()
+            self.database.execute(CREATE_IP_INDEX_STATEMENT)
+            for create_index_statement in CREATE_IP_FILTER_INDEX_STATEMENTS:
+                self.database.execute(create_index_statement)
+            self.database.execute(CREATE_DECAY_INDEX_STATEMENT)
+            self.database.execute(CREATE_DECAY_TABLE_STATEMENT)
+            if self.database.execute("SELECT name FROM sqlite_master " +
+                    "WHERE type='table' AND name='changelog';"
+                    ).fetchone() is None:
+                # New database, or one from before merging existed. Log
+                # every IP so the first merge from it brings them all.
+                self.database.execute(CREATE_CHANGELOG_TABLE_STATEMENT)
+                self.database.execute(CREATE_SYNC_INFO_TABLE_STATEMENT)
+                self.database.execute("INSERT INTO changelog (ip) " +
+                                      "SELECT ip FROM ipaddress;")
+                self.database.execute("INSERT INTO syncinfo " +
+                        "(catalogid, baseseq, exportedseq) VALUES (?, 0, 0);",
+                        (os.urandom(8).hex(),))
+            self.database.execute(CREATE_DELETED_IPS_TABLE_STATEMENT)
+            for create_trigger_statement in \
+                    CREATE_CHANGELOG_TRIGGER_STATEMENTS:
+                self.database.execute(create_trigger_statement)
+            self.database.execute(CREATE_SYNC_PEERS_TABLE_STATEMENT)
+            self.database.execute(CREATE_ENRICH_CACHE_TABLE_STATEMENT)
+            self.database.execute(CREATE_ROUTES_TABLE_STATEMENT)
+            self.database.execute(CREATE_ROLLUP_TABLE_STATEMENT)
+            self.database.execute(CREATE_WAF_HITS_TABLE_STATEMENT)
+            self.database.execute(CREATE_INGEST_OFFSETS_TABLE_STATEMENT)
+            self.database.execute(CREATE_SIGHTINGS_TABLE_STATEMENT)
+            self.database.execute(CREATE_SIGHTINGS_INDEX_STATEMENT)
+            if self.database.execute("SELECT name FROM sqlite_master " +
+                    "WHERE type='table' AND name='rolluplengths';"
+                    ).fetchone() is None:
+                # New database, or one from before rollups existed.
+                self.database.execute(CREATE_ROLLUP_LENGTHS_TABLE_STATEMENT)
+                self.database.executemany("INSERT INTO rolluplengths " +
+                        "(version, prefixlen) VALUES (?, ?);",
+                        DEFAULT_ROLLUP_LENGTHS)
+                self.rebuild_rollups()
             self.database.commit()
 
+    def migrate_db(self) -> None:
+        """
+        Brings databases created by older versions up to the current schema.
+        """
+        assert self.database is not None
+        ip_columns: set[str] = {row[1] for row in self.database.execute(
+                "PRAGMA table_info(ipaddress);")}
+        # Replaced by ipaddress_ipbin_score.
+        self.database.execute("DROP INDEX IF EXISTS ipaddress_ipbin;")
+        if "ipbin" not in ip_columns:
+            # Added the packed IP columns for range queries.
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN version INTEGER;")
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN ipbin BLOB;")
+            self.database.executemany("UPDATE ipaddress " +
+                    "SET version=?, ipbin=? WHERE ip=?;", [
+                (ip_address_obj.version, ip_address_obj.packed, ip_address_str)
+                for ip_address_str, in self.database.execute(
+                        "SELECT ip FROM ipaddress;").fetchall()
+                for ip_address_obj in (ipaddress.ip_address(ip_address_str),)
+            ])
+        if "hits" not in ip_columns:
+            # Added the log sighting counters.
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN hits INTEGER NOT NULL DEFAULT 0;")
+            self.database.execute("ALTER TABLE ipaddress ADD COLUMN " +
+                                  "wafhits INTEGER NOT NULL DEFAULT 0;")
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN firstseen INTEGER;")
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN lastseen INTEGER;")
+        if "scoredtime" not in ip_columns:
+            # Added score decay. Existing scores start decaying from when
+            # they were last seen, or from now.
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN scoredtime INTEGER;")
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN decayweight REAL;")
+            self.database.execute("UPDATE ipaddress SET " +
+                                  "scoredtime=coalesce(lastseen, ?);",
+                                  (int(time.time()),))
+        if "modified" not in ip_columns:
+            # Added merging.
+            self.database.execute("ALTER TABLE ipaddress " +
+                                  "ADD COLUMN modified INTEGER;")
+            self.database.execute("UPDATE ipaddress SET modified=scoredtime;")
+
 def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser()
+    argparser.add_argument("--database", type=pathlib.Path,
+                           default="ipcatalog.db",
+                           help="The database file with the IPs.")
+    argparser.add_argument("--import", dest="import_file", type=pathlib.Path,
+                           help="Import IP/classification pairs from this " +
+                           "file and exit instead of starting the shell.")
+    argparser.add_argument("--bgp-tools-server", default=None,
+                           help="HOST:PORT of the whois server to use " +
+                           "instead of bgp.tools.")
+    argparser.add_argument("--rdns-server", default=None,
+                           help="HOST:PORT of a DNS server to send reverse " +
+                           "DNS queries to instead of the system resolver.")
+    argparser.add_argument("--no-bgp-tools", action="store_true",
+                           help="Don't look up IPs with bgp.tools.")
+    argparser.add_argument("--no-rdns", action="store_true",
+                           help="Don't look up reverse DNS records.")
+    argparser.add_argument("--import-routes", type=pathlib.Path,
+                           help="Replace the offline routing table with " +
+                           "this pfx2as or CSV dump before starting.")
+    argparser.add_argument("--bgp-tools-fallback", action="store_true",
+                           help="Ask bgp.tools about IPs that are not in " +
+                           "the offline routing table.")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always look up IPs over the network " +
+                           "instead of reusing cached results.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
     ipcatalogshell: IpCatalogShell = IpCatalogShell()
-    ipcatalogshell.database_path = "ipcatalog.db"
+    ipcatalogshell.database_path = str(parsedargs["database"])
+    ipcatalogshell.bgp_tools_lookup = not parsedargs["no_bgp_tools"]
+    ipcatalogshell.rdns_lookup = not parsedargs["no_rdns"]
+    ipcatalogshell.use_cache = not parsedargs["no_cache"]
+    ipcatalogshell.bgp_tools_fallback = parsedargs["bgp_tools_fallback"]
+    if parsedargs["bgp_tools_server"] is not None:
+        host, _, port = parsedargs["bgp_tools_server"].rpartition(":")
+        ipcatalogshell.bgp_tools_server = (host.strip("[]"), int(port))
+    if parsedargs["rdns_server"] is not None:
+        host, _, port = parsedargs["rdns_server"].rpartition(":")
+        ipcatalogshell.rdns_server = (host.strip("[]"), int(port))
+    if parsedargs["import_routes"] is not None:
+        if not ipcatalogshell.import_routes(parsedargs["import_routes"]):
+            return 1
+    if parsedargs["import_file"] is not None:
+        imported: bool = ipcatalogshell.import_file(parsedargs["import_file"])
+        ipcatalogshell.do_exit("")
+        return 0 if imported else 1
     ipcatalogshell.cmdloop()
     return 0
 
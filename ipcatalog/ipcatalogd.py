@@ -0,0 +1,458 @@
+import argparse
+import array
+import asyncio
+import bisect
+import ipaddress
+from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
+import os
+import pathlib
+import random
+import sqlite3
+import sys
+import time
+import typing
+
+import ipcatalog
+
+RELOAD_CHECK_INTERVAL: float = 2
+"""Seconds between checks for changes to the database"""
+
+DECAY_RELOAD_FRACTION: int = 16
+"""Number of reloads per shortest half-life when scores decay"""
+
+STREAM_DRAIN_INTERVAL: int = 64
+"""Number of answers written to a stream connection between drains"""
+
+class VerdictTable:
+    """
+    Read-only snapshot of the catalog for fast lookups. Each IP version has
+    a sorted array of addresses with their scores, found by binary search,
+    and the blocklist as sorted non-overlapping [start, end] ranges, which
+    are found the same way since collapsed CIDRs never nest.
+    """
+
+    def __init__(self, addresses: dict[int, typing.MutableSequence[int]],
+                 scores: dict[int, array.array],
+                 bad: dict[int, bytearray],
+                 blocked_starts: dict[int, list[int]],
+                 blocked_networks: dict[int, list[typing.Union[IPv4Network,
+                                                               IPv6Network]]],
+                 decay_reload_interval: typing.Optional[float] = None
+                 ) -> None:
+        self.addresses: dict[int, typing.MutableSequence[int]] = addresses
+        """Sorted addresses as integers, by IP version"""
+        self.scores: dict[int, array.array] = scores
+        """Score of each address in addresses"""
+        self.bad: dict[int, bytearray] = bad
+        """1 for each address in addresses whose current score is bad"""
+        self.blocked_starts: dict[int, list[int]] = blocked_starts
+        """First address of each blocked network, sorted, by IP version"""
+        self.blocked_networks: dict[int, list[typing.Union[
+                IPv4Network, IPv6Network]]] = blocked_networks
+        self.decay_reload_interval: typing.Optional[float] = \
+                decay_reload_interval
+        """
+        Seconds after which the current scores have decayed enough that the
+        table should be reloaded, or None if no score decays
+        """
+
+    @classmethod
+    def load(cls, database_path: str, min_score: float,
+             subnet4_length: typing.Optional[int],
+             subnet6_length: typing.Optional[int]) -> "VerdictTable":
+        """
+        Reads the catalog into a new table.
+
+        :param database_path: The ipcatalog database.
+        :param min_score: The minimum current score of a bad IP or subnet.
+        :param subnet4_length: If given, IPv4 subnets of this length whose
+                               total score reaches min_score are bad too.
+        :param subnet6_length: Same for IPv6.
+        """
+        # Read-only, so reloads never write to the catalog or wait for the
+        # shell's write lock
+        database: sqlite3.Connection = sqlite3.connect(
+                pathlib.Path(database_path).absolute().as_uri() + "?mode=ro",
+                uri=True, timeout=ipcatalog.DATABASE_BUSY_TIMEOUT)
+        addresses: dict[int, typing.MutableSequence[int]] = {
+            4: array.array("I"),
+            6: [],
+        }
+        scores: dict[int, array.array] = {4: array.array("b"),
+                                           6: array.array("b")}
+        bad: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+        try:
+            # One read transaction, so the IPs and the blocklist match
+            database.execute("BEGIN;")
+            decay_settings: ipcatalog.DecaySettings = \
+                    ipcatalog.read_decay_settings(database)
+            current_score: str = ipcatalog.current_score_sql(
+                    decay_settings, int(time.time()))
+            for ip_version, ipbin, score, ip_bad in database.execute(
+                    f"SELECT version, ipbin, score, {current_score}>=? " +
+                    "FROM ipaddress ORDER BY version, ipbin;", (min_score,)):
+                addresses[ip_version].append(int.from_bytes(ipbin, "big"))
+                scores[ip_version].append(score)
+                bad[ip_version].append(ip_bad)
+            blocklist: list[typing.Union[IPv4Network, IPv6Network]] = \
+                    ipcatalog.read_blocklist(database, min_score,
+                                             subnet4_length, subnet6_length)
+        finally:
+            database.close()
+        blocked_networks: dict[int, list[typing.Union[IPv4Network,
+                                                      IPv6Network]]] = \
+                {4: [], 6: []}
+        for network in blocklist:
+            blocked_networks[network.version].append(network)
+        decay_reload_interval: typing.Optional[float] = None
+        if len(decay_settings) > 0:
+            decay_reload_interval = min(halflife for halflife, _ in
+                    decay_settings.values()) / DECAY_RELOAD_FRACTION
+        return cls(addresses, scores, bad, {
+            ip_version: [int(network.network_address) for network in networks]
+            for ip_version, networks in blocked_networks.items()
+        }, blocked_networks, decay_reload_interval)
+
+    def blocked_network(self, ip_version: int, address: int) \
+            -> typing.Optional[typing.Union[IPv4Network, IPv6Network]]:
+        """
+        :return: The blocked network containing an address, if any.
+        """
+        index: int = bisect.bisect_right(self.blocked_starts[ip_version],
+                                         address) - 1
+        if index < 0:
+            return None
+        network: typing.Union[IPv4Network, IPv6Network] = \
+                self.blocked_networks[ip_version][index]
+        if int(network.broadcast_address) < address:
+            return None
+        return network
+
+    def blocked_overlaps(self, ip_version: int, first_address: int,
+                         last_address: int) -> bool:
+        """
+        :return: Whether any blocked network overlaps the range of
+                 addresses, either by covering its first address or by
+                 starting inside it.
+        """
+        if self.blocked_network(ip_version, first_address) is not None:
+            return True
+        blocked_starts: list[int] = self.blocked_starts[ip_version]
+        return bisect.bisect_right(blocked_starts, last_address) > \
+                bisect.bisect_right(blocked_starts, first_address)
+
+    def query(self, query_str: str) -> str:
+        """
+        Answers one query. A plain IP gets
+            <IP> <bad|known|unknown> <CLASSIFICATION|-> <BLOCKED_NETWORK|->
+        and a CIDR gets
+            <CIDR> <bad|known|unknown> <KNOWN_IPS> <BAD_IPS>
+        Anything else gets "<QUERY> error".
+        """
+        query_str = query_str.strip()
+        try:
+            if "/" not in query_str:
+                ip_address_obj: typing.Union[IPv4Address, IPv6Address] = \
+                        ipaddress.ip_address(query_str)
+                return self.query_address(ip_address_obj)
+            return self.query_network(ipaddress.ip_network(query_str,
+                                                           strict=False))
+        except ValueError:
+            return query_str + " error"
+
+    def query_address(self, ip_address_obj: typing.Union[IPv4Address,
+                                                         IPv6Address]) -> str:
+        ip_version: int = ip_address_obj.version
+        address: int = int(ip_address_obj)
+        addresses: typing.MutableSequence[int] = self.addresses[ip_version]
+        index: int = bisect.bisect_left(addresses, address)
+        score: typing.Optional[int] = None
+        ip_bad: int = 0
+        if index < len(addresses) and addresses[index] == address:
+            score = self.scores[ip_version][index]
+            ip_bad = self.bad[ip_version][index]
+        blocked_network: typing.Optional[typing.Union[IPv4Network,
+                                                      IPv6Network]] = \
+                self.blocked_network(ip_version, address)
+        verdict: str = "unknown"
+        if blocked_network is not None or ip_bad:
+            verdict = "bad"
+        elif score is not None:
+            verdict = "known"
+        return " ".join((
+            str(ip_address_obj),
+            verdict,
+            "-" if score is None else
+                    ipcatalog.SCORE_TO_CLASSIFICATION.get(score, str(score)),
+            "-" if blocked_network is None else str(blocked_network),
+        ))
+
+    def query_network(self, network: typing.Union[IPv4Network,
+                                                  IPv6Network]) -> str:
+        ip_version: int = network.version
+        addresses: typing.MutableSequence[int] = self.addresses[ip_version]
+        start: int = bisect.bisect_left(addresses,
+                                        int(network.network_address))
+        end: int = bisect.bisect_right(addresses,
+                                       int(network.broadcast_address))
+        bad_count: int = sum(self.bad[ip_version][start:end])
+        verdict: str = "unknown"
+        if bad_count > 0 or self.blocked_overlaps(
+                ip_version, int(network.network_address),
+                int(network.broadcast_address)):
+            verdict = "bad"
+        elif end > start:
+            verdict = "known"
+        return f"{network} {verdict} {end - start} {bad_count}"
+
+class VerdictServer:
+    """
+    Answers queries from a VerdictTable, swapping in a fresh table in the
+    background whenever the database changes, and also every so often when
+    scores decay, since the current scores change without it.
+    """
+
+    def __init__(self, database_path: str, min_score: float,
+                 subnet4_length: typing.Optional[int],
+                 subnet6_length: typing.Optional[int]) -> None:
+        self.database_path: str = database_path
+        self.min_score: float = min_score
+        self.subnet4_length: typing.Optional[int] = subnet4_length
+        self.subnet6_length: typing.Optional[int] = subnet6_length
+        self.database_mtime: float = self.current_mtime()
+        self.table_time: float = time.monotonic()
+        """When the table was last loaded"""
+        self.table: VerdictTable = self.load_table()
+
+    def load_table(self) -> VerdictTable:
+        start_time: float = time.perf_counter()
+        table: VerdictTable = VerdictTable.load(
+                self.database_path, self.min_score, self.subnet4_length,
+                self.subnet6_length)
+        print(f"Loaded {len(table.addresses[4])} IPv4 and " +
+              f"{len(table.addresses[6])} IPv6 addresses, " +
+              f"{sum(len(networks) for networks in table.blocked_networks.values())} " +
+              f"blocked networks in {time.perf_counter() - start_time:.2f}s",
+              file=sys.stderr)
+        return table
+
+    def current_mtime(self) -> float:
+        """
+        :return: The latest modification time of the database or its WAL.
+        """
+        mtime: float = 0
+        for path in (self.database_path, self.database_path + "-wal"):
+            try:
+                mtime = max(mtime, os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+    async def watch_database(self) -> None:
+        """
+        Reloads the table whenever the database changes, or once its decay
+        reload interval has passed. The old table keeps answering queries
+        until the new one is ready.
+        """
+        while True:
+            await asyncio.sleep(RELOAD_CHECK_INTERVAL)
+            mtime: float = self.current_mtime()
+            decay_reload_interval: typing.Optional[float] = \
+                    self.table.decay_reload_interval
+            if mtime == self.database_mtime and \
+                    (decay_reload_interval is None or
+                     time.monotonic() - self.table_time <
+                     decay_reload_interval):
+                continue
+            self.database_mtime = mtime
+            self.table_time = time.monotonic()
+            try:
+                self.table = await asyncio.to_thread(self.load_table)
+            except Exception as e:
+                print(f"WARNING: Failed to reload {self.database_path}: {e}",
+                      file=sys.stderr)
+
+    async def handle_stream(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        """
+        Answers newline separated queries on a stream connection, one line
+        per query, in order.
+        """
+        undrained_count: int = 0
+        """Number of answers written since the last drain"""
+        try:
+            while True:
+                line: bytes = await reader.readline()
+                if line == b"":
+                    break
+                # write hands the answer to the transport right away;
+                # draining only waits for a slow client, so it is done for
+                # batches of pipelined queries instead of every line
+                writer.write(self.table.query(
+                        line.decode("utf-8", "replace")).encode("utf-8") +
+                        b"\n")
+                undrained_count += 1
+                if undrained_count >= STREAM_DRAIN_INTERVAL:
+                    await writer.drain()
+                    undrained_count = 0
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class VerdictDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Answers UDP queries. Each datagram holds newline separated queries and
+    gets one datagram back with the answers.
+    """
+
+    def __init__(self, server: VerdictServer) -> None:
+        self.server: VerdictServer = server
+        self.transport: typing.Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        assert self.transport is not None
+        table: VerdictTable = self.server.table
+        self.transport.sendto("\n".join(
+            table.query(query_str)
+            for query_str in data.decode("utf-8", "replace").splitlines()
+            if query_str.strip() != ""
+        ).encode("utf-8") + b"\n", addr)
+
+async def serve(parsedargs: dict[str, typing.Any]) -> None:
+    server: VerdictServer = VerdictServer(
+            str(parsedargs["database"]), parsedargs["min_score"],
+            parsedargs["subnet4"], parsedargs["subnet6"])
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    if parsedargs["unix"] is not None:
+        if os.path.exists(parsedargs["unix"]):
+            os.unlink(parsedargs["unix"])
+        await asyncio.start_unix_server(server.handle_stream,
+                                        parsedargs["unix"])
+        print(f"Listening on {parsedargs['unix']}", file=sys.stderr)
+    if parsedargs["udp"] is not None:
+        host, _, port = parsedargs["udp"].rpartition(":")
+        await loop.create_datagram_endpoint(
+                lambda: VerdictDatagramProtocol(server),
+                local_addr=(host.strip("[]"), int(port)))
+        print(f"Listening on udp {parsedargs['udp']}", file=sys.stderr)
+    await server.watch_database()
+
+async def loadtest(parsedargs: dict[str, typing.Any]) -> None:
+    """
+    Sends queries from several concurrent connections, one at a time per
+    connection, and reports the latency percentiles.
+    """
+    query_strs: list[str] = []
+    if parsedargs["queries_from"] is not None:
+        with open(parsedargs["queries_from"]) as queries_file:
+            query_strs = [line.strip() for line in queries_file
+                          if line.strip() != ""]
+    if len(query_strs) == 0:
+        query_strs = [str(IPv4Address(random.getrandbits(32)))
+                      for _ in range(10000)]
+    latencies: list[float] = []
+    per_connection: int = parsedargs["requests"] // parsedargs["connections"]
+
+    async def stream_client() -> None:
+        reader, writer = await asyncio.open_unix_connection(parsedargs["unix"])
+        for _ in range(per_connection):
+            start_time: float = time.perf_counter()
+            writer.write(random.choice(query_strs).encode("utf-8") + b"\n")
+            await reader.readline()
+            latencies.append(time.perf_counter() - start_time)
+        writer.close()
+
+    async def datagram_client() -> None:
+        host, _, port = parsedargs["udp"].rpartition(":")
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        responses: asyncio.Queue = asyncio.Queue()
+
+        class ClientProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data: bytes, addr) -> None:
+                responses.put_nowait(data)
+
+        transport, _ = await loop.create_datagram_endpoint(
+                ClientProtocol, remote_addr=(host.strip("[]"), int(port)))
+        for _ in range(per_connection):
+            start_time: float = time.perf_counter()
+            transport.sendto(random.choice(query_strs).encode("utf-8"))
+            try:
+                await asyncio.wait_for(responses.get(), 1)
+            except asyncio.TimeoutError:
+                continue
+            latencies.append(time.perf_counter() - start_time)
+        transport.close()
+
+    client: typing.Callable[[], typing.Awaitable[None]] = \
+            stream_client if parsedargs["unix"] is not None \
+            else datagram_client
+    start_time: float = time.perf_counter()
+    await asyncio.gather(*(client()
+                           for _ in range(parsedargs["connections"])))
+    elapsed_time: float = time.perf_counter() - start_time
+    if len(latencies) == 0:
+        print("ERROR: No queries were answered")
+        return
+    latencies.sort()
+    print(f"{len(latencies)} queries in {elapsed_time:.2f}s " +
+          f"({len(latencies) / elapsed_time:.0f} queries/s), " +
+          f"{per_connection * parsedargs['connections'] - len(latencies)} " +
+          "lost")
+    for percentile in (50, 90, 99, 99.9):
+        print(f"  p{percentile}: " +
+              f"{latencies[int(len(latencies) * percentile / 100)] * 1e6:.0f}us")
+    print(f"  max: {latencies[-1] * 1e6:.0f}us")
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description="Answers \"is this IP known-bad?\" queries from " +
+            "the ipcatalog database.")
+    argparser.add_argument("--unix", default=None,
+                           help="Unix socket path to listen on or connect " +
+                           "to. Defaults to ipcatalogd.sock if --udp is " +
+                           "not given.")
+    argparser.add_argument("--udp", default=None,
+                           help="HOST:PORT to listen on or send to over UDP.")
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+    serve_parser: argparse.ArgumentParser = subparsers.add_parser(
+            "serve", help="Run the lookup service.")
+    serve_parser.add_argument("--database", default="ipcatalog.db",
+                              help="The database file with the IPs.")
+    serve_parser.add_argument("--min-score", type=float, default=3,
+                              help="Minimum current score of a bad IP or " +
+                              "subnet.")
+    serve_parser.add_argument("--subnet4", type=int, default=None,
+                              help="Also treat IPv4 subnets of this length " +
+                              "scoring at least --min-score as bad.")
+    serve_parser.add_argument("--subnet6", type=int, default=None,
+                              help="Same as --subnet4 for IPv6.")
+    loadtest_parser: argparse.ArgumentParser = subparsers.add_parser(
+            "loadtest", help="Measure the latency of a running service.")
+    loadtest_parser.add_argument("--requests", type=int, default=100000)
+    loadtest_parser.add_argument("--connections", type=int, default=8)
+    loadtest_parser.add_argument("--queries-from", default=None,
+                                 help="File with one query per line. " +
+                                 "Defaults to random IPv4 addresses.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+    if parsedargs["unix"] is None and parsedargs["udp"] is None:
+        parsedargs["unix"] = "ipcatalogd.sock"
+
+    try:
+        if parsedargs["command"] == "serve":
+            asyncio.run(serve(parsedargs))
+        else:
+            asyncio.run(loadtest(parsedargs))
+    except KeyboardInterrupt:
+        pass
+    except sqlite3.Error as e:
+        print(f"ERROR: Could not read {parsedargs['database']}: {e}",
+              file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
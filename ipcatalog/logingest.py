@@ -0,0 +1,384 @@
+import argparse
+import datetime
+import glob
+import ipaddress
+from ipaddress import IPv4Network, IPv6Network
+import json
+import os
+import sys
+import time
+import typing
+
+import ipcatalog
+
+READ_CHUNK_SIZE: int = 1024 * 1024
+"""Most bytes read from one file before moving on to the next"""
+
+MAX_LINE_LENGTH: int = 16 * 1024 * 1024
+"""Longer lines are skipped instead of buffered"""
+
+FLUSH_INTERVAL: float = 2
+"""Seconds between writes of the collected sightings to the catalog"""
+
+MAX_PENDING_IPS: int = 50000
+"""Distinct IPs collected before they are written early"""
+
+POLL_INTERVAL: float = 0.5
+"""Seconds to sleep when every file has been read to the end"""
+
+RESCAN_INTERVAL: float = 10
+"""Seconds between checks for new files matching the patterns"""
+
+SIGHTINGS_COMPACT_INTERVAL: float = 10 * 60
+"""Seconds between merges of old per-minute sightings into hours"""
+
+Event = tuple[str, int, list[int], str]
+"""(source IP, unix time, triggered WAF rule IDs, log source)"""
+
+def parse_timestamp(timestamp_str: str) -> typing.Optional[int]:
+    """
+    Parses an ISO 8601 timestamp like the @timestamp of the Elastic beats.
+
+    :return: The unix time, or None if it couldn't be parsed.
+    """
+    try:
+        return int(datetime.datetime.fromisoformat(
+                timestamp_str.replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        return None
+
+def parse_event(line: bytes) -> typing.Optional[Event]:
+    """
+    Extracts the source of one log line. Understands the Coraza (modsec)
+    audit log and caddy access log written by webandaid, and the ECS
+    documents written by packetbeat and filebeat.
+
+    :return: The event, or None if the line has no source IP.
+    """
+    try:
+        json_dict: typing.Any = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(json_dict, dict):
+        return None
+
+    ip_address_str: typing.Optional[str] = None
+    timestamp: typing.Optional[int] = None
+    rules: list[int] = []
+    source: str = ""
+    try:
+        if "transaction" in json_dict:
+            source = "modsec"
+            transaction: dict = json_dict["transaction"]
+            ip_address_str = transaction.get("client_ip")
+            if "unix_timestamp" in transaction:
+                timestamp = transaction["unix_timestamp"] // 1000000000
+            for waf_message in json_dict.get("messages") or ():
+                try:
+                    rules.append(int(waf_message["data"]["id"]))
+                except (KeyError, TypeError, ValueError):
+                    pass
+        elif "request" in json_dict and isinstance(json_dict["request"],
+                                                   dict):
+            source = "caddy"
+            ip_address_str = json_dict["request"].get("client_ip") or \
+                    json_dict["request"].get("remote_ip")
+            if "ts" in json_dict:
+                timestamp = int(json_dict["ts"])
+        elif isinstance(json_dict.get("source"), dict):
+            source = "beats"
+            if isinstance(json_dict.get("agent"), dict) and \
+                    isinstance(json_dict["agent"].get("type"), str):
+                source = json_dict["agent"]["type"]
+            ip_address_str = json_dict["source"].get("ip")
+            if "@timestamp" in json_dict:
+                timestamp = parse_timestamp(json_dict["@timestamp"])
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if not isinstance(ip_address_str, str):
+        return None
+    return (ip_address_str, int(time.time()) if timestamp is None
+            else timestamp, rules, source)
+
+class LogFollower:
+    """
+    Reads the complete lines appended to one file, picking up where the
+    last run left off.
+    """
+
+    def __init__(self, path: str, device: int, inode: int,
+                 offset: int) -> None:
+        self.path: str = path
+        self.device: int = device
+        self.inode: int = inode
+        self.offset: int = offset
+        """Position after the last complete line that was read"""
+        self.partial_line: bytes = b""
+        self.skipping_line: bool = False
+        """Whether the rest of an overlong line is being thrown away"""
+        self.moved: bool = False
+        """Whether path now holds a different file, from log rotation"""
+
+    def read_lines(self) -> list[bytes]:
+        """
+        :return: Up to READ_CHUNK_SIZE bytes of new complete lines.
+        """
+        try:
+            with open(self.path, "rb") as log_file:
+                stat_result: os.stat_result = os.fstat(log_file.fileno())
+                if stat_result.st_ino != self.inode or \
+                        stat_result.st_dev != self.device:
+                    self.moved = True
+                    return []
+                if stat_result.st_size < self.offset:
+                    # Truncated, so start over.
+                    self.offset = 0
+                    self.partial_line = b""
+                    self.skipping_line = False
+                log_file.seek(self.offset + len(self.partial_line))
+                chunk: bytes = log_file.read(READ_CHUNK_SIZE)
+        except OSError:
+            self.moved = True
+            return []
+        if chunk == b"":
+            return []
+
+        data: bytes = self.partial_line + chunk
+        last_newline: int = data.rfind(b"\n")
+        if last_newline == -1:
+            if len(data) > MAX_LINE_LENGTH:
+                self.offset += len(data)
+                self.partial_line = b""
+                self.skipping_line = True
+            else:
+                self.partial_line = data
+            return []
+        self.offset += last_newline + 1
+        self.partial_line = data[last_newline + 1:]
+        lines: list[bytes] = data[:last_newline].split(b"\n")
+        if self.skipping_line:
+            lines = lines[1:]
+            self.skipping_line = False
+        return lines
+
+class LogIngester:
+    """
+    Follows log files and writes the IPs in them to the catalog in batches.
+    """
+
+    def __init__(self, shell: ipcatalog.IpCatalogShell,
+                 patterns: list[str],
+                 ignored_networks: list[typing.Union[IPv4Network,
+                                                     IPv6Network]],
+                 enrich: bool) -> None:
+        self.shell: ipcatalog.IpCatalogShell = shell
+        self.patterns: list[str] = patterns
+        self.ignored_networks: list[typing.Union[IPv4Network,
+                                                 IPv6Network]] = \
+                ignored_networks
+        self.enrich: bool = enrich
+        self.followers: dict[tuple[int, int], LogFollower] = {}
+        """Maps (device, inode) to the follower of that file"""
+        self.sightings: dict[str, ipcatalog.Sighting] = {}
+        self.ip_cache: dict[str, typing.Optional[str]] = {}
+        """Maps IP strings from the logs to the normalized IP, or None if
+        ignored, so each address is parsed only once per batch"""
+        self.event_count: int = 0
+        """Events collected since the last flush"""
+
+    def scan_files(self) -> None:
+        """
+        Starts following files that newly match the patterns, and stops
+        following files that were rotated away.
+        """
+        assert self.shell.database is not None
+        found_file_ids: set[tuple[int, int]] = set()
+        for pattern in self.patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat_result: os.stat_result = os.stat(path)
+                except OSError:
+                    continue
+                file_id: tuple[int, int] = (stat_result.st_dev,
+                                            stat_result.st_ino)
+                found_file_ids.add(file_id)
+                if file_id in self.followers:
+                    # Possibly renamed by log rotation, keep reading it.
+                    self.followers[file_id].path = path
+                    self.followers[file_id].moved = False
+                    continue
+                saved_offset: typing.Optional[tuple] = \
+                        self.shell.database.execute(
+                        "SELECT offset FROM ingestoffsets WHERE " +
+                        "device=? AND inode=?;", file_id).fetchone()
+                offset: int = 0 if saved_offset is None or \
+                        saved_offset[0] > stat_result.st_size \
+                        else saved_offset[0]
+                self.followers[file_id] = LogFollower(path, *file_id, offset)
+        for file_id in list(self.followers):
+            if file_id not in found_file_ids and self.followers[file_id].moved:
+                del self.followers[file_id]
+
+    def read_files(self) -> int:
+        """
+        Reads a chunk from every followed file.
+
+        :return: The number of bytes read.
+        """
+        bytes_read: int = 0
+        event_count: int = 0
+        for follower in list(self.followers.values()):
+            position: int = follower.offset + len(follower.partial_line)
+            lines: list[bytes] = follower.read_lines()
+            bytes_read += max(0, follower.offset +
+                              len(follower.partial_line) - position)
+            for line in lines:
+                event: typing.Optional[Event] = parse_event(line)
+                if event is None:
+                    continue
+                ip_address_str, timestamp, rules, source = event
+                if ip_address_str not in self.ip_cache:
+                    self.ip_cache[ip_address_str] = \
+                            self.normalize_ip(ip_address_str)
+                normalized_ip: typing.Optional[str] = \
+                        self.ip_cache[ip_address_str]
+                if normalized_ip is None:
+                    continue
+                sighting: typing.Optional[ipcatalog.Sighting] = \
+                        self.sightings.get(normalized_ip)
+                if sighting is None:
+                    sighting = ipcatalog.Sighting(timestamp)
+                    self.sightings[normalized_ip] = sighting
+                sighting.add(timestamp, rules, source)
+                event_count += 1
+            if len(self.sightings) >= MAX_PENDING_IPS:
+                self.flush()
+        self.event_count += event_count
+        return bytes_read
+
+    def normalize_ip(self, ip_address_str: str) -> typing.Optional[str]:
+        """
+        :return: The normalized IP, or None if it is invalid or ignored.
+        """
+        try:
+            ip_address_obj = ipaddress.ip_address(ip_address_str)
+        except ValueError:
+            return None
+        if ip_address_obj.is_loopback or any(
+                ip_address_obj in network
+                for network in self.ignored_networks):
+            return None
+        return str(ip_address_obj)
+
+    def flush(self) -> None:
+        """
+        Writes the collected sightings and how far each file has been read
+        in one transaction, so nothing is counted twice after a restart.
+        """
+        assert self.shell.database is not None
+        start_time: float = time.perf_counter()
+        with self.shell.database:
+            new_ips: list[str] = self.shell.record_sightings(self.sightings)
+            self.shell.database.executemany("INSERT OR REPLACE INTO " +
+                    "ingestoffsets (device, inode, path, offset) " +
+                    "VALUES (?, ?, ?, ?);", (
+                (follower.device, follower.inode, follower.path,
+                 follower.offset)
+                for follower in self.followers.values()
+            ))
+        if len(self.sightings) > 0:
+            print(f"{self.event_count} events from {len(self.sightings)} " +
+                  f"IPs ({len(new_ips)} new) written in " +
+                  f"{time.perf_counter() - start_time:.3f}s", file=sys.stderr)
+        if self.enrich and len(new_ips) > 0:
+            if self.shell.enrichment_queue is None:
+                self.shell.enrichment_queue = \
+                        ipcatalog.EnrichmentQueue(self.shell)
+            for ip_address_str in new_ips:
+                self.shell.enrichment_queue.submit(ip_address_str)
+        self.sightings = {}
+        self.ip_cache = {}
+        self.event_count = 0
+
+    def compact_sightings(self) -> None:
+        """
+        Downsamples and expires old sightings.
+        """
+        assert self.shell.database is not None
+        with self.shell.database:
+            self.shell.compact_sightings(int(time.time()))
+
+    def run(self, follow: bool) -> None:
+        """
+        Reads the files until interrupted, or until they have all been read
+        to the end if not following them.
+        """
+        self.shell.init_db()
+        self.scan_files()
+        last_compact_time: float = time.monotonic()
+        last_flush_time: float = time.monotonic()
+        last_scan_time: float = time.monotonic()
+        try:
+            while True:
+                bytes_read: int = self.read_files()
+                now: float = time.monotonic()
+                if now - last_flush_time >= FLUSH_INTERVAL:
+                    self.flush()
+                    last_flush_time = now
+                if now - last_compact_time >= SIGHTINGS_COMPACT_INTERVAL:
+                    self.compact_sightings()
+                    last_compact_time = now
+                if bytes_read == 0:
+                    if not follow:
+                        break
+                    time.sleep(POLL_INTERVAL)
+                if now - last_scan_time >= RESCAN_INTERVAL or any(
+                        follower.moved
+                        for follower in self.followers.values()):
+                    self.scan_files()
+                    last_scan_time = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.flush()
+            self.compact_sightings()
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description="Adds the IPs in webandaid's caddy and modsec logs " +
+            "and packetbeat/filebeat ndjson output to the catalog.")
+    argparser.add_argument("patterns", nargs="+",
+                           help="Log files or glob patterns, such as " +
+                           "'caddylog-*.json'. Quote them so that files " +
+                           "created later are picked up too.")
+    argparser.add_argument("--database", default="ipcatalog.db",
+                           help="The database file with the IPs.")
+    argparser.add_argument("--once", action="store_true",
+                           help="Exit after reading the files to the end " +
+                           "instead of following them.")
+    argparser.add_argument("--ignore", action="append", default=[],
+                           help="CIDR of addresses to leave out, such as " +
+                           "the server's own. Can be repeated.")
+    argparser.add_argument("--no-enrich", action="store_true",
+                           help="Don't look up rDNS and bgp.tools " +
+                           "information for new IPs.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
+    ignored_networks: list[typing.Union[IPv4Network, IPv6Network]] = []
+    for network_str in parsedargs["ignore"]:
+        try:
+            ignored_networks.append(ipaddress.ip_network(network_str,
+                                                         strict=False))
+        except ValueError:
+            print(f"ERROR: Invalid CIDR {network_str}", file=sys.stderr)
+            return 1
+
+    shell: ipcatalog.IpCatalogShell = ipcatalog.IpCatalogShell()
+    shell.database_path = parsedargs["database"]
+    LogIngester(shell, parsedargs["patterns"], ignored_networks,
+                not parsedargs["no_enrich"]).run(not parsedargs["once"])
+    shell.do_exit("")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,183 @@
+import gc
+import typing
+
+class RadixNode:
+    """
+    A node of a RadixTree. Covers the network with the top prefixlen bits of
+    network, and holds the totals of every network at or below it.
+    """
+    __slots__ = ("network", "prefixlen", "left", "right",
+                 "score", "b", "pb", "s", "m", "best")
+
+    def __init__(self, network: int, prefixlen: int) -> None:
+        self.network: int = network
+        """The network address as an integer, host bits zeroed"""
+        self.prefixlen: int = prefixlen
+        self.left: typing.Optional[RadixNode] = None
+        """Child whose next bit is 0"""
+        self.right: typing.Optional[RadixNode] = None
+        """Child whose next bit is 1"""
+        self.score: int = 0
+        self.b: int = 0
+        self.pb: int = 0
+        self.s: int = 0
+        self.m: int = 0
+        self.best: int = 0
+        """The highest score of this node or any node below it"""
+
+    def add_totals_row(self, totals: typing.Sequence[int]) -> None:
+        """
+        Adds [score, b, pb, s, m] to this node's totals.
+        """
+        self.score += totals[0]
+        self.b += totals[1]
+        self.pb += totals[2]
+        self.s += totals[3]
+        self.m += totals[4]
+
+    def add_totals(self, other: "RadixNode") -> None:
+        """
+        Adds another node's totals to this node's totals.
+        """
+        self.score += other.score
+        self.b += other.b
+        self.pb += other.pb
+        self.s += other.s
+        self.m += other.m
+
+    def update_best(self) -> None:
+        """
+        Recomputes best from this node's score and its children.
+        """
+        self.best = self.score
+        if self.left is not None and self.left.best > self.best:
+            self.best = self.left.best
+        if self.right is not None and self.right.best > self.best:
+            self.best = self.right.best
+
+    def children(self) -> list["RadixNode"]:
+        """
+        :return: The children of this node, hottest subtree first.
+        """
+        child_nodes: list[RadixNode] = [child for child in (self.left,
+                                        self.right) if child is not None]
+        child_nodes.sort(key=lambda child: (child.best, child.score),
+                         reverse=True)
+        return child_nodes
+
+class RadixTree:
+    """
+    Path-compressed binary trie (Patricia trie) of networks. Only the
+    networks it is built from and the points where two of them diverge get
+    a node, so n networks take fewer than 2n nodes. Every node keeps the
+    totals of its subtree and the best score below it, so any level can be
+    read and cold branches skipped without another pass.
+    """
+
+    def __init__(self, address_bits: int) -> None:
+        """
+        :param address_bits: 32 for IPv4, 128 for IPv6.
+        """
+        self.address_bits: int = address_bits
+        self.root: RadixNode = RadixNode(0, 0)
+        self.node_count: int = 1
+
+    @classmethod
+    def from_networks(cls, address_bits: int, prefixlen: int,
+                      networks: dict[int, typing.Sequence[int]]) \
+            -> "RadixTree":
+        """
+        Builds a tree from networks that all have the same prefix length.
+        The networks are sorted, so every branch point is found from the
+        previous network alone, and the totals are added up in one pass at
+        the end.
+
+        :param address_bits: 32 for IPv4, 128 for IPv6.
+        :param prefixlen: The prefix length of all the networks.
+        :param networks: Maps network number, which is the network address
+                         shifted right by the host bits, to
+                         [score, b, pb, s, m].
+        """
+        # Nodes never form reference cycles, and letting the garbage collector
+        # rescan millions of them as they are created doubles the build time.
+        gc_was_enabled: bool = gc.isenabled()
+        gc.disable()
+        try:
+            return cls._from_networks(address_bits, prefixlen, networks)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    @classmethod
+    def _from_networks(cls, address_bits: int, prefixlen: int,
+                       networks: dict[int, typing.Sequence[int]]) \
+            -> "RadixTree":
+        radix_tree: RadixTree = cls(address_bits)
+        root: RadixNode = radix_tree.root
+        if prefixlen == 0:
+            for totals in networks.values():
+                root.add_totals_row(totals)
+            root.update_best()
+            return radix_tree
+
+        host_bits: int = address_bits - prefixlen
+        node_stack: list[RadixNode] = [root]
+        """The path from the root to the previous network"""
+        previous_network: typing.Optional[int] = None
+        for network in sorted(networks):
+            leaf: RadixNode = RadixNode(network << host_bits, prefixlen)
+            leaf.add_totals_row(networks[network])
+            radix_tree.node_count += 1
+            if previous_network is None:
+                if network >> (prefixlen - 1) & 1:
+                    root.right = leaf
+                else:
+                    root.left = leaf
+                node_stack.append(leaf)
+                previous_network = network
+                continue
+
+            common_length: int = prefixlen - \
+                    (previous_network ^ network).bit_length()
+            last_popped: typing.Optional[RadixNode] = None
+            while node_stack[-1].prefixlen > common_length:
+                last_popped = node_stack.pop()
+            parent: RadixNode = node_stack[-1]
+            if parent.prefixlen < common_length:
+                # The previous network's branch diverges from this one
+                # somewhere along the edge from parent, so split it.
+                assert last_popped is not None
+                branch: RadixNode = RadixNode(
+                        network >> (prefixlen - common_length) <<
+                        (address_bits - common_length), common_length)
+                branch.left = last_popped
+                radix_tree.node_count += 1
+                if parent.right is last_popped:
+                    parent.right = branch
+                else:
+                    parent.left = branch
+                node_stack.append(branch)
+                parent = branch
+            # Sorted order means this network is always on the right.
+            parent.right = leaf
+            node_stack.append(leaf)
+            previous_network = network
+
+        # Add up the totals of the branch points from the bottom up.
+        visit_stack: list[tuple[RadixNode, bool]] = [(root, False)]
+        while len(visit_stack) > 0:
+            node, children_done = visit_stack.pop()
+            if node.prefixlen == prefixlen:
+                node.update_best()
+                continue
+            if not children_done:
+                visit_stack.append((node, True))
+                for child in (node.left, node.right):
+                    if child is not None:
+                        visit_stack.append((child, False))
+                continue
+            for child in (node.left, node.right):
+                if child is not None:
+                    node.add_totals(child)
+            node.update_best()
+        return radix_tree
@@ -0,0 +1,271 @@
+"""
+Compact read-only snapshots of the catalog for hosts without sqlite or the
+shell. Only needs the standard library.
+
+File layout, all integers little-endian:
+    header          HEADER_STRUCT, with the count and section offsets below
+    for IPv4 then IPv6:
+        keys        count packed big-endian addresses, sorted, 4 or 16 bytes
+        scores      count signed bytes
+        asns        count uint32, 0 if unknown
+        ccs         count uint32 indexes into the string table
+        isps        count uint32 indexes into the string table
+    string offsets  string_count + 1 uint32 offsets into the string data
+    string data     UTF-8 strings back to back
+A string index of NO_STRING means NULL.
+"""
+import argparse
+import bisect
+import ipaddress
+from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
+import mmap
+import os
+import struct
+import sys
+import time
+import typing
+
+MAGIC: bytes = b"IPCSNAP\x00"
+FORMAT_VERSION: int = 1
+
+SECTION_STRUCT: str = "QQQQQQ"
+"""count, keys, scores, asns, ccs and isps offsets of one IP version"""
+HEADER_STRUCT: struct.Struct = struct.Struct(
+        "<8sIIqQ" + SECTION_STRUCT + SECTION_STRUCT + "QQ")
+"""magic, format version, flags, creation time, string count, the IPv4 and
+IPv6 sections, then the string offsets and string data offsets"""
+
+KEY_SIZES: dict[int, int] = {4: 4, 6: 16}
+NO_STRING: int = 0xffffffff
+
+SnapshotRecord = tuple[int, typing.Optional[int], typing.Optional[str],
+                       typing.Optional[str]]
+"""(score, asn, cc, isp)"""
+
+def write_snapshot(path: str, rows: typing.Iterable[tuple]) -> int:
+    """
+    Writes a snapshot. The file is written next to path and renamed over it
+    so readers never see a partial snapshot.
+
+    :param path: The snapshot file.
+    :param rows: (version, ipbin, score, asn, cc, isp) sorted by version
+                 then ipbin.
+    :return: The number of IPs written.
+    """
+    keys: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+    scores: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+    asns: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+    ccs: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+    isps: dict[int, bytearray] = {4: bytearray(), 6: bytearray()}
+    counts: dict[int, int] = {4: 0, 6: 0}
+    string_indexes: dict[str, int] = {}
+    pack_uint32: typing.Callable[[int], bytes] = struct.Struct("<I").pack
+    pack_int8: typing.Callable[[int], bytes] = struct.Struct("<b").pack
+
+    def string_index(string: typing.Optional[str]) -> int:
+        if string is None:
+            return NO_STRING
+        return string_indexes.setdefault(string, len(string_indexes))
+
+    for ip_version, ipbin, score, asn, cc, isp in rows:
+        keys[ip_version] += ipbin
+        scores[ip_version] += pack_int8(score)
+        asns[ip_version] += pack_uint32(asn or 0)
+        ccs[ip_version] += pack_uint32(string_index(cc))
+        isps[ip_version] += pack_uint32(string_index(isp))
+        counts[ip_version] += 1
+
+    string_offsets: bytearray = bytearray(pack_uint32(0))
+    string_data: bytearray = bytearray()
+    for string in string_indexes:
+        string_data += string.encode("utf-8")
+        string_offsets += pack_uint32(len(string_data))
+
+    sections: list[bytearray] = []
+    header_fields: list[typing.Any] = [MAGIC, FORMAT_VERSION, 0,
+                                       int(time.time()), len(string_indexes)]
+    offset: int = HEADER_STRUCT.size
+    for ip_version in (4, 6):
+        header_fields.append(counts[ip_version])
+        for section in (keys[ip_version], scores[ip_version],
+                        asns[ip_version], ccs[ip_version],
+                        isps[ip_version]):
+            header_fields.append(offset)
+            sections.append(section)
+            offset += len(section)
+    header_fields.extend((offset, offset + len(string_offsets)))
+    sections.extend((string_offsets, string_data))
+
+    temp_path: str = path + ".tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(HEADER_STRUCT.pack(*header_fields))
+        for section in sections:
+            snapshot_file.write(section)
+    os.replace(temp_path, path)
+    return counts[4] + counts[6]
+
+class _KeyView:
+    """
+    Sequence of the keys of one IP version, read from the map on demand so
+    bisect can search them without loading them.
+    """
+
+    def __init__(self, buffer: mmap.mmap, offset: int, count: int,
+                 key_size: int) -> None:
+        self.buffer: mmap.mmap = buffer
+        self.offset: int = offset
+        self.count: int = count
+        self.key_size: int = key_size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> bytes:
+        start: int = self.offset + index * self.key_size
+        return self.buffer[start:start + self.key_size]
+
+class Snapshot:
+    """
+    Snapshot opened with mmap. Opening only reads the header; lookups
+    binary search the keys in place, so only the pages they touch are read.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as snapshot_file:
+            self.buffer: mmap.mmap = mmap.mmap(snapshot_file.fileno(), 0,
+                                               access=mmap.ACCESS_READ)
+        if len(self.buffer) < HEADER_STRUCT.size:
+            self.buffer.close()
+            raise ValueError(f"{path} is not an ipcatalog snapshot")
+        header: tuple = HEADER_STRUCT.unpack_from(self.buffer, 0)
+        if header[0] != MAGIC:
+            self.buffer.close()
+            raise ValueError(f"{path} is not an ipcatalog snapshot")
+        if header[1] != FORMAT_VERSION:
+            self.buffer.close()
+            raise ValueError(f"{path} has snapshot format version " +
+                             f"{header[1]}, expected {FORMAT_VERSION}")
+        self.created: int = header[3]
+        """Unix time the snapshot was written"""
+        self.string_count: int = header[4]
+        self.sections: dict[int, tuple[int, ...]] = {4: header[5:11],
+                                                     6: header[11:17]}
+        """Maps IP version to (count, keys, scores, asns, ccs, isps)"""
+        self.string_offsets: int = header[17]
+        self.string_data: int = header[18]
+        self.keys: dict[int, _KeyView] = {
+            ip_version: _KeyView(self.buffer, section[1], section[0],
+                                 KEY_SIZES[ip_version])
+            for ip_version, section in self.sections.items()
+        }
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.sections[4][0] + self.sections[6][0]
+
+    def close(self) -> None:
+        self.buffer.close()
+
+    def string(self, index: int) -> typing.Optional[str]:
+        """
+        :return: A string from the string table, or None for NO_STRING.
+        """
+        if index == NO_STRING:
+            return None
+        start, end = struct.unpack_from("<II", self.buffer,
+                                        self.string_offsets + index * 4)
+        return self.buffer[self.string_data + start:
+                           self.string_data + end].decode("utf-8")
+
+    def record(self, ip_version: int, index: int) -> SnapshotRecord:
+        """
+        :return: The columns of the index-th IP of a version.
+        """
+        _, _, scores, asns, ccs, isps = self.sections[ip_version]
+        score: int = struct.unpack_from("<b", self.buffer, scores + index)[0]
+        asn: int = struct.unpack_from("<I", self.buffer, asns + index * 4)[0]
+        cc: int = struct.unpack_from("<I", self.buffer, ccs + index * 4)[0]
+        isp: int = struct.unpack_from("<I", self.buffer, isps + index * 4)[0]
+        return (score, asn or None, self.string(cc), self.string(isp))
+
+    def lookup(self, ip: typing.Union[str, IPv4Address, IPv6Address]) \
+            -> typing.Optional[SnapshotRecord]:
+        """
+        :return: The record of an IP, or None if it isn't in the snapshot.
+        """
+        ip_address_obj: typing.Union[IPv4Address, IPv6Address] = \
+                ipaddress.ip_address(ip)
+        keys: _KeyView = self.keys[ip_address_obj.version]
+        packed: bytes = ip_address_obj.packed
+        index: int = bisect.bisect_left(keys, packed)
+        if index == len(keys) or keys[index] != packed:
+            return None
+        return self.record(ip_address_obj.version, index)
+
+    def network(self, network: typing.Union[str, IPv4Network, IPv6Network]) \
+            -> typing.Iterator[tuple[typing.Union[IPv4Address, IPv6Address],
+                                     SnapshotRecord]]:
+        """
+        :return: Every IP in a network with its record, in address order.
+        """
+        network_obj: typing.Union[IPv4Network, IPv6Network] = \
+                ipaddress.ip_network(network, strict=False)
+        ip_version: int = network_obj.version
+        keys: _KeyView = self.keys[ip_version]
+        start: int = bisect.bisect_left(keys,
+                                        network_obj.network_address.packed)
+        end: int = bisect.bisect_right(keys,
+                                       network_obj.broadcast_address.packed)
+        for index in range(start, end):
+            yield (ipaddress.ip_address(keys[index]),
+                   self.record(ip_version, index))
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description="Looks up IPs and CIDRs in an ipcatalog snapshot.")
+    argparser.add_argument("snapshot", help="The snapshot file.")
+    argparser.add_argument("queries", nargs="*",
+                           help="IPs or CIDRs to look up. Prints a summary " +
+                           "of the snapshot if none are given.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
+    try:
+        snapshot: Snapshot = Snapshot(parsedargs["snapshot"])
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    with snapshot:
+        if len(parsedargs["queries"]) == 0:
+            print(f"{snapshot.sections[4][0]} IPv4 and " +
+                  f"{snapshot.sections[6][0]} IPv6 addresses, " +
+                  f"{snapshot.string_count} strings, written " +
+                  time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.localtime(snapshot.created)))
+        for query in parsedargs["queries"]:
+            results: list[tuple[typing.Union[IPv4Address, IPv6Address],
+                                SnapshotRecord]]
+            try:
+                if "/" in query:
+                    results = list(snapshot.network(query))
+                else:
+                    record: typing.Optional[SnapshotRecord] = \
+                            snapshot.lookup(query)
+                    results = [] if record is None \
+                            else [(ipaddress.ip_address(query), record)]
+            except ValueError:
+                print(f"ERROR: Invalid IP or CIDR {query}", file=sys.stderr)
+                continue
+            if len(results) == 0:
+                print(f"{query} not found")
+            for ip_address_obj, (score, asn, cc, isp) in results:
+                print(f"{ip_address_obj} {score} AS{asn or '?'} " +
+                      f"{cc or '?'} {isp or '?'}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,142 @@
+import argparse
+import json
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import typing
+
+import nmapxmlingest
+
+SYNTHETIC_SERVICES: tuple[tuple[int, str, str, str], ...] = (
+    (21, "ftp", "vsftpd", "3.0.5"),
+    (22, "ssh", "OpenSSH", "8.9p1 Ubuntu 3ubuntu0.6"),
+    (25, "smtp", "Postfix smtpd", ""),
+    (53, "domain", "ISC BIND", "9.18.18"),
+    (80, "http", "nginx", "1.18.0"),
+    (88, "kerberos-sec", "Microsoft Windows Kerberos", ""),
+    (389, "ldap", "Microsoft Windows Active Directory LDAP", ""),
+    (443, "https", "Apache httpd", "2.4.52"),
+    (445, "microsoft-ds", "", ""),
+    (3306, "mysql", "MySQL", "8.0.36"),
+    (3389, "ms-wbt-server", "Microsoft Terminal Services", ""),
+    (5432, "postgresql", "PostgreSQL DB", "14.11"),
+    (8080, "http-proxy", "", ""),
+)
+"""(port, service, product, version) of the ports synthetic hosts have"""
+
+OPEN_PORTS_MAX: int = 6
+"""Most open ports a synthetic host has"""
+
+SCRIPT_OUTPUT_LENGTH: int = 400
+"""Length of the -sC script output of each synthetic port"""
+
+def write_synthetic_scan(nmap_xml_file: pathlib.Path, host_count: int,
+                         seed: int = 0) -> None:
+    """
+    Writes Nmap XML output like that of a -p- -sV -sC -O scan, with
+    hostnames, OS matches, a few open and filtered ports per host and
+    script output on every port.
+
+    :param nmap_xml_file: The file to write
+    :param host_count: The number of hosts in the scan
+    :param seed: Seed for the random number generator
+    """
+    rng: random.Random = random.Random(seed)
+    with open(nmap_xml_file, "w") as xml_file:
+        xml_file.write("<?xml version=\"1.0\"?>\n<nmaprun scanner=\"nmap\" " +
+                       "args=\"nmap -p- -sV -sC -O\" start=\"1700000000\">\n" +
+                       "<scaninfo type=\"syn\" protocol=\"tcp\" " +
+                       "numservices=\"65535\" services=\"1-65535\"/>\n")
+        for host_index in range(host_count):
+            ip: str = f"10.{host_index >> 16 & 255}." + \
+                    f"{host_index >> 8 & 255}.{host_index & 255}"
+            xml_file.write("<host starttime=\"1700000000\" " +
+                           "endtime=\"1700000600\"><status state=\"up\"/>" +
+                           f"<address addr=\"{ip}\" addrtype=\"ipv4\"/>" +
+                           "<hostnames><hostname " +
+                           f"name=\"host{host_index}.example.com\" " +
+                           "type=\"PTR\"/></hostnames><ports>" +
+                           "<extraports state=\"closed\" count=\"65530\"/>")
+            for port, service, product, version in rng.sample(
+                    SYNTHETIC_SERVICES, rng.randint(1, OPEN_PORTS_MAX)):
+                state: str = "open" if rng.random() < 0.9 else "filtered"
+                xml_file.write(f"<port protocol=\"tcp\" portid=\"{port}\">" +
+                               f"<state state=\"{state}\" " +
+                               "reason=\"syn-ack\"/>" +
+                               f"<service name=\"{service}\"" +
+                               (f" product=\"{product}\"" if product else "") +
+                               (f" version=\"{version}\"" if version else "") +
+                               (" tunnel=\"ssl\"" if port == 443 else "") +
+                               " method=\"probed\" conf=\"10\"/>" +
+                               "<script id=\"banner\" output=\"" +
+                               "x" * SCRIPT_OUTPUT_LENGTH + "\"/></port>")
+            xml_file.write("</ports><os>" +
+                           "<osmatch name=\"Linux 5.0 - 5.14\" " +
+                           "accuracy=\"96\"/>" +
+                           "<osmatch name=\"Linux 4.15 - 5.8\" " +
+                           f"accuracy=\"{rng.randint(85, 100)}\"/>" +
+                           "</os></host>\n")
+        xml_file.write("<runstats><finished time=\"1700001234\"/>" +
+                       f"<hosts up=\"{host_count}\" down=\"0\" " +
+                       f"total=\"{host_count}\"/></runstats>\n</nmaprun>\n")
+
+def benchmark_ingest(nmap_ports_db_path: pathlib.Path,
+                     nmap_xml_file: pathlib.Path,
+                     force: bool) -> dict[str, float]:
+    """
+    Ingests the scan into the database once, or skips it if it is
+    unchanged and force is False.
+
+    :return: The wall time in seconds and the number of SQL statements
+             SQLite ran, counting each row of an executemany.
+    """
+    nmap_ports_db = nmapxmlingest.init_db(nmap_ports_db_path)
+    statement_count: int = 0
+    def count_statement(statement: str) -> None:
+        nonlocal statement_count
+        statement_count += 1
+    nmap_ports_db.set_trace_callback(count_statement)
+    start_time: float = time.perf_counter()
+    nmapxmlingest.ingest_nmap_xml(nmap_ports_db, nmap_xml_file, force)
+    seconds: float = time.perf_counter() - start_time
+    nmap_ports_db.close()
+    return {"seconds": seconds, "statements": statement_count}
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser()
+    argparser.add_argument("--hosts", type=int, nargs="+", default=[10000],
+                           help="Scan sizes to benchmark.")
+    argparser.add_argument("--output", default=None,
+                           help="Also write the JSON results to this file.")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
+    results: dict[str, dict[str, float]] = {}
+    for host_count in parsedargs["hosts"]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            nmap_xml_file: pathlib.Path = pathlib.Path(temp_dir, "scan.xml")
+            nmap_ports_db_path: pathlib.Path = pathlib.Path(temp_dir,
+                                                            "nmapports.db")
+            write_synthetic_scan(nmap_xml_file, host_count)
+            host_results: dict[str, float] = {}
+            for name, force in (("ingest", False), ("reingest", True),
+                                ("unchanged", False)):
+                for key, value in benchmark_ingest(nmap_ports_db_path,
+                                                   nmap_xml_file,
+                                                   force).items():
+                    host_results[f"{name} {key}"] = value
+            results[str(host_count)] = host_results
+        print(f"{host_count} hosts: " + ", ".join(
+                f"{name} {value:.3f}" if isinstance(value, float) else
+                f"{name} {value}" for name, value in host_results.items()),
+              file=sys.stderr)
+    results_json: str = json.dumps(results, indent=2)
+    if parsedargs["output"] is not None:
+        with open(parsedargs["output"], "w") as output_file:
+            output_file.write(results_json + "\n")
+    print(results_json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
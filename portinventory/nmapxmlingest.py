@@ -1,21 +1,84 @@
 import argparse
+import collections
+import glob
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
 import pathlib
 import sqlite3
 import sys
 import typing
 import xml.etree.ElementTree as ElementTree
 
-def main(argv: list[str]) -> int:
-    argparser: argparse.ArgumentParser = argparse.ArgumentParser()
-    argparser.add_argument("--sqlite-db", type=pathlib.Path,
-                           default="nmapports.db",
-                           help="The database file with the ports.")
-    argparser.add_argument("nmap_xml_file", type=pathlib.Path,
-                           help="The XML file outputted from Nmap")
-    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+HOST_BATCH_SIZE: int = 1000
+"""Number of parsed hosts written to the database at once"""
+
+READ_CHUNK_SIZE: int = 1 << 16
+"""Number of bytes of an XML file read at a time"""
+
+HOST_END_TAG: bytes = b"</host>"
+"""Closes each host; the hosts up to the last one in an unfinished file are
+complete"""
+
+WORKER_PARSE_MAX_SIZE: int = 1 << 20
+"""Largest file in bytes parsed by a worker process; larger files are
+streamed by the writer so their hosts are never all in memory at once"""
+
+FILES_PER_TASK: int = 4
+"""Number of files sent to a worker process at once"""
+
+PENDING_TASKS_PER_JOB: int = 2
+"""Number of tasks handed to each worker process ahead of the writer"""
+
+RUNSTATS_TAIL_SIZE: int = 4096
+"""Number of bytes at the end of a file searched for <runstats>, which has
+the scan's finish time"""
+
+UPSERT_INGESTED_FILE_STATEMENT: str = ("INSERT INTO ingested_files (path, " + 
+        "size, mtime, hash, hostsend, finished, provisionaltime) " + 
+        "VALUES (?, ?, ?, ?, ?, ?, ?) " + 
+        "ON CONFLICT DO UPDATE SET size=excluded.size, " + 
+        "mtime=excluded.mtime, hash=excluded.hash, " + 
+        "hostsend=excluded.hostsend, finished=excluded.finished, " + 
+        "provisionaltime=excluded.provisionaltime;")
+"""Records how much of a file has been ingested"""
+
+UPSERT_HOST_STATEMENT: str = ("INSERT INTO hosts (ip, hostname, os, " + 
+        "osconf, scantime) VALUES (?, ?, ?, ?, ?) " + 
+        "ON CONFLICT DO UPDATE SET " + 
+        "hostname=coalesce(excluded.hostname, hostname), " + 
+        "os=coalesce(excluded.os, os), " + 
+        "osconf=CASE WHEN excluded.os IS NULL THEN osconf " + 
+        "ELSE excluded.osconf END, " + 
+        "scantime=excluded.scantime;")
+"""Adds a host from a (ip, hostname, os, osconf, scantime) row, keeping the
+hostname and OS it already has if the scan didn't find them"""
+
+INSERT_UNFINISHED_HOST_STATEMENT: str = ("INSERT OR IGNORE INTO " + 
+        "unfinished_hosts (path, ip) VALUES (?, ?);")
+"""Records that a host was ingested from an unfinished scan"""
+
+DELETE_PORTS_STATEMENT: str = "DELETE FROM ports WHERE ip=?;"
+"""Removes the ports of a host before its open ports are added"""
 
+UPSERT_PORT_STATEMENT: str = ("INSERT INTO ports (ip, protocol, port, " + 
+        "service, tunnel, servicever, serviceconf) " + 
+        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET " + 
+        "service=excluded.service, tunnel=excluded.tunnel, " + 
+        "servicever=excluded.servicever, " + 
+        "serviceconf=excluded.serviceconf;")
+"""Adds an open port from a (ip, protocol, port, service, tunnel,
+servicever, serviceconf) row"""
 
-    nmap_ports_db = sqlite3.connect(str(parsedargs["sqlite_db"]))
+def init_db(sqlite_db: pathlib.Path) -> sqlite3.Connection:
+    """
+    Opens the database with the ports, creating the tables if needed.
+
+    :param sqlite_db: The database file with the ports
+    :return: The connection to the database
+    """
+    nmap_ports_db: sqlite3.Connection = sqlite3.connect(str(sqlite_db))
     nmap_ports_db.execute("CREATE TABLE IF NOT EXISTS hosts (" + 
             "ip TEXT NOT NULL, hostname TEXT, " + 
             "os TEXT, osconf INTEGER, scantime INTEGER NOT NULL, " + 
@@ -25,116 +88,647 @@ def main(argv: list[str]) -> int:
             "port INTEGER NOT NULL, service TEXT, " + 
             "tunnel TEXT, servicever TEXT, " + 
             "serviceconf INTEGER, PRIMARY KEY(ip, protocol, port));")
+    # The size, modification time in nanoseconds and SHA-256 of each file
+    # as it was last ingested, how many bytes up to the end of its last
+    # complete host were ingested, whether the scan had finished and, if
+    # not, the scan time its hosts were given until it does
+    nmap_ports_db.execute("CREATE TABLE IF NOT EXISTS ingested_files (" + 
+            "path TEXT NOT NULL, size INTEGER NOT NULL, " + 
+            "mtime INTEGER NOT NULL, hash TEXT NOT NULL, " + 
+            "hostsend INTEGER NOT NULL, finished INTEGER NOT NULL, " + 
+            "provisionaltime INTEGER, PRIMARY KEY(path));")
+    if "provisionaltime" not in {row[1] for row in nmap_ports_db.execute(
+            "PRAGMA table_info(ingested_files);")}:
+        # Added to give hosts of unfinished scans their finish time later
+        nmap_ports_db.execute("ALTER TABLE ingested_files " +
+                              "ADD COLUMN provisionaltime INTEGER;")
+    # The hosts ingested from each unfinished scan, which get the scan's
+    # finish time once it is read
+    nmap_ports_db.execute("CREATE TABLE IF NOT EXISTS unfinished_hosts (" + 
+            "path TEXT NOT NULL, ip TEXT NOT NULL, " + 
+            "PRIMARY KEY(path, ip));")
     nmap_ports_db.commit()
-    nmap_root = ElementTree.parse(parsedargs["nmap_xml_file"])
-    runstats_tag: typing.Optional[ElementTree.Element] = nmap_root.find("runstats")
+    return nmap_ports_db
+
+def parse_host(host_tag: ElementTree.Element) \
+        -> typing.Optional[tuple[tuple, typing.Optional[list[tuple]]]]:
+    """
+    Reads a host and its open ports from a <host> element.
+
+    :param host_tag: A <host> element from the Nmap XML output
+    :return: The (ip, hostname, os, osconf) of the host and the rows for
+             UPSERT_PORT_STATEMENT, which are None if the host has no
+             <ports>, or None if the host has no address.
+    """
+    address_tag: typing.Optional[ElementTree.Element] = \
+            host_tag.find("address")
+    if address_tag is None:
+        # No IP returned - not sure what to do. Skip.
+        return None
+    host_ip_address: str = address_tag.attrib["addr"]
+
+    hostname_str: typing.Optional[str] = None
+    hostname_tag: typing.Optional[ElementTree.Element] = \
+            host_tag.find("hostnames/hostname")
+    if hostname_tag is not None:
+        hostname_str = hostname_tag.attrib["name"]
+
+    port_rows: typing.Optional[list[tuple]] = None
+    ports_tag: typing.Optional[ElementTree.Element] = \
+            host_tag.find("ports")
+    if ports_tag is not None:
+        port_rows = []
+        for port_tag in ports_tag.findall("port"):
+            port_state_tag: typing.Optional[ElementTree.Element] = \
+                    port_tag.find("state")
+            if port_state_tag is None or \
+                    port_state_tag.attrib["state"] != "open":
+                continue
+            service_name: typing.Optional[str] = None
+            service_conf: typing.Optional[str] = None
+            tunnel: typing.Optional[str] = None
+            service_version_str: str = ""
+            port_service_tag: typing.Optional[ElementTree.Element] = \
+                    port_tag.find("service")
+            if port_service_tag is not None:
+                service_name = port_service_tag.attrib["name"]
+                service_conf = port_service_tag.attrib["conf"]
+                tunnel = port_service_tag.attrib.get("tunnel")
+                if "product" in port_service_tag.attrib:
+                    service_version_str += port_service_tag.attrib["product"]
+                if "version" in port_service_tag.attrib:
+                    service_version_str += " " + \
+                            port_service_tag.attrib["version"]
+                if "extrainfo" in port_service_tag.attrib:
+                    service_version_str += " (" + \
+                            port_service_tag.attrib["extrainfo"] + ")"
+            port_rows.append((
+                host_ip_address,
+                port_tag.attrib["protocol"],
+                int(port_tag.attrib["portid"]),
+                service_name,
+                tunnel,
+                service_version_str \
+                        if service_version_str.strip() != "" else None,
+                service_conf,
+            ))
+
+    best_os_match: typing.Optional[str] = None
+    best_os_match_acc: typing.Optional[int] = None
+    """Accuracy of the best OS match"""
+    os_tag: typing.Optional[ElementTree.Element] = \
+            host_tag.find("os")
+    if os_tag is not None:
+        best_os_match = ""
+        for osmatch_tag in os_tag.findall("osmatch"):
+            osmatch_accuracy: int = int(osmatch_tag.attrib["accuracy"])
+            if best_os_match_acc is None or \
+                    osmatch_accuracy > best_os_match_acc:
+                best_os_match = osmatch_tag.attrib["name"]
+                best_os_match_acc = osmatch_accuracy
+
+    return ((host_ip_address, hostname_str, best_os_match,
+             best_os_match_acc), port_rows)
+
+class NmapXmlReader:
+    """
+    Iterates over the hosts of Nmap XML output as parse_host returns them,
+    parsing one <host> at a time so memory stays flat however large the
+    scan is.
+    """
+
+    nmap_xml_file: pathlib.Path
+    """The XML file outputted from Nmap"""
+
+    start_offset: int
+    """Where to start reading, either 0 or the end of a host"""
+
+    end_offset: typing.Optional[int]
+    """Where to stop reading, after the last complete host of an unfinished
+    scan, or None to read the whole finished scan"""
+
+    def __init__(self, nmap_xml_file: pathlib.Path, start_offset: int = 0,
+                 end_offset: typing.Optional[int] = None):
+        self.nmap_xml_file = nmap_xml_file
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+
+    def __iter__(self) -> typing.Iterator[tuple[tuple,
+                                                typing.Optional[list[tuple]]]]:
+        xml_parser: ElementTree.XMLPullParser = \
+                ElementTree.XMLPullParser(events=("start", "end"))
+        nmap_root: typing.Optional[ElementTree.Element] = None
+        """The <nmaprun> element, whose finished children are removed"""
+        if self.start_offset > 0:
+            # Only <nmaprun> is open between hosts
+            xml_parser.feed(b"<nmaprun>")
+        with open(self.nmap_xml_file, "rb") as xml_file:
+            xml_file.seek(self.start_offset)
+            remaining_size: typing.Optional[int] = None \
+                    if self.end_offset is None \
+                    else self.end_offset - self.start_offset
+            while remaining_size is None or remaining_size > 0:
+                chunk: bytes = xml_file.read(READ_CHUNK_SIZE
+                        if remaining_size is None
+                        else min(READ_CHUNK_SIZE, remaining_size))
+                if chunk == b"":
+                    break
+                if remaining_size is not None:
+                    remaining_size -= len(chunk)
+                xml_parser.feed(chunk)
+                for event, element in xml_parser.read_events():
+                    if nmap_root is None:
+                        nmap_root = element
+                    if event != "end" or element.tag != "host":
+                        continue
+                    parsed_host: typing.Optional[tuple[tuple,
+                            typing.Optional[list[tuple]]]] = \
+                            parse_host(element)
+                    # Drop the hosts parsed so far, including this one
+                    nmap_root.clear()
+                    if parsed_host is not None:
+                        yield parsed_host
+        if self.end_offset is not None:
+            xml_parser.feed(b"</nmaprun>")
+        xml_parser.close()
+
+class NmapXmlChanges:
+    """
+    What is new in a file since it was last ingested, as check_nmap_xml
+    works it out.
+    """
+
+    nmap_xml_reader: typing.Optional[NmapXmlReader]
+    """Reads the new hosts, or None if there are none"""
+
+    scan_time_utc: int
+    """Scan time of the new hosts: the finish time of a finished scan, or
+    the provisional time of an unfinished one"""
+
+    restarted: bool
+    """Whether the file is read from the start, replacing what was ingested
+    from it before"""
+
+    previous_provisional_time: typing.Optional[int]
+    """Scan time given to the hosts of the file while it was unfinished, if
+    it was"""
+
+    ingested_row: tuple
+    """The (size, mtime, hash, hostsend, finished, provisionaltime) of the
+    file for UPSERT_INGESTED_FILE_STATEMENT"""
+
+    def __init__(self, nmap_xml_reader: typing.Optional[NmapXmlReader],
+                 scan_time_utc: int, restarted: bool,
+                 previous_provisional_time: typing.Optional[int],
+                 ingested_row: tuple):
+        self.nmap_xml_reader = nmap_xml_reader
+        self.scan_time_utc = scan_time_utc
+        self.restarted = restarted
+        self.previous_provisional_time = previous_provisional_time
+        self.ingested_row = ingested_row
+
+def read_finish_time(file_tail: bytes) -> int:
+    """
+    :param file_tail: The end of a finished scan's XML file
+    :return: The time in its <runstats><finished> tag.
+    """
+    runstats_index: int = file_tail.rfind(b"<runstats")
+    nmaprun_end_index: int = file_tail.rfind(b"</nmaprun>")
     finished_tag: typing.Optional[ElementTree.Element] = None
-    if runstats_tag is not None:
-        finished_tag = runstats_tag.find("finished")
+    if runstats_index != -1:
+        finished_tag = ElementTree.fromstring(
+                file_tail[runstats_index:nmaprun_end_index]).find("finished")
     if finished_tag is None:
         raise ValueError("Attempted to ingest an incomplete scan " + 
                          "(<finished> tag missing)")
-    assert finished_tag is not None
-    scan_time_utc: int = int(finished_tag.attrib["time"].strip())
-    for host_tag in nmap_root.findall("host"):
-        address_tag: typing.Optional[ElementTree.Element] = \
-                host_tag.find("address")
-        if address_tag is None:
-            # No IP returned - not sure what to do. Skip.
-            continue
-        host_ip_address: str = address_tag.attrib["addr"]
-        nmap_ports_db.execute("INSERT INTO hosts (ip, scantime) " + 
-                              "VALUES (?, ?) ON CONFLICT DO " + 
-                              "UPDATE SET scantime=excluded.scantime;", 
-                              (host_ip_address, scan_time_utc))
-
-        hostnames_tag: typing.Optional[ElementTree.Element] = \
-                host_tag.find("hostnames")
-        if hostnames_tag is not None:
-            for hostname_tag in hostnames_tag.findall("hostname"):
-                hostname_str = hostname_tag.attrib["name"]
-                nmap_ports_db.execute("UPDATE hosts SET hostname=? " + 
-                        "WHERE ip=?", (hostname_tag.attrib["name"], 
-                        host_ip_address))
-                break
-
-        ports_tag: typing.Optional[ElementTree.Element] = \
-                host_tag.find("ports")
-        if ports_tag is not None:
-            nmap_ports_db.execute("DELETE FROM ports WHERE ip=?",
-                                  (host_ip_address,))
-            for port_tag in ports_tag.findall("port"):
-                port_open: bool = False
-                port_state_tag: typing.Optional[ElementTree.Element] = \
-                        port_tag.find("state")
-                if port_state_tag is not None and \
-                        port_state_tag.attrib["state"] == "open":
-                    port_open = True
-
-                ip_port_tuple: tuple = (
-                    host_ip_address, 
-                    port_tag.attrib["protocol"], 
-                    int(port_tag.attrib["portid"])
-                )
-                """Tuple with the IP, protocol, and port"""
-                if port_open:
-                    nmap_ports_db.execute("INSERT INTO ports (ip, " + 
-                            "protocol, port) VALUES (?, ?, ?);", ip_port_tuple)
-                port_service_tag: typing.Optional[ElementTree.Element] = \
-                        port_tag.find("service")
-                if port_service_tag is not None:
-                    nmap_ports_db.execute("UPDATE ports SET " + 
-                            "service=?,serviceconf=? WHERE " + 
-                            "ip=? AND protocol=? AND port=?;", 
-                            (port_service_tag.attrib["name"], 
-                             port_service_tag.attrib["conf"]) + ip_port_tuple)
-                    if "tunnel" in port_service_tag.attrib:
-                        nmap_ports_db.execute("UPDATE ports SET " + 
-                                "tunnel=? WHERE " + 
-                                "ip=? AND protocol=? AND port=?;",
-                                (port_service_tag.attrib["tunnel"],) + 
-                                ip_port_tuple)
-                    else:
-                        # Set tunnel to NULL if no tunnel
-                        nmap_ports_db.execute("UPDATE ports SET " + 
-                                "tunnel=? WHERE " + 
-                                "ip=? AND protocol=? AND port=?;",
-                                (None,) + 
-                                ip_port_tuple)
-                    service_version_str: str = ""
-                    if "product" in port_service_tag.attrib:
-                        service_version_str += port_service_tag.attrib["product"]
-                    if "version" in port_service_tag.attrib:
-                        service_version_str += " " + \
-                                port_service_tag.attrib["version"]
-                    if "extrainfo" in port_service_tag.attrib:
-                        service_version_str += " (" + \
-                                port_service_tag.attrib["extrainfo"] + ")"
-                    if service_version_str.strip() != "":
-                        nmap_ports_db.execute("UPDATE ports SET " + 
-                                "servicever=? WHERE " + 
-                                "ip=? AND protocol=? AND port=?;",
-                                (service_version_str,) + ip_port_tuple)
-        os_tag: typing.Optional[ElementTree.Element] = \
-                host_tag.find("os")
-        if os_tag is not None:
-            best_os_match: str = ""
-            best_os_match_acc: typing.Optional[int] = None
-            """Accuracy of the best OS match"""
-            for osmatch_tag in os_tag.findall("osmatch"):
-                osmatch_accuracy: int = int(osmatch_tag.attrib["accuracy"])
-                if best_os_match_acc is None or \
-                        osmatch_accuracy > best_os_match_acc:
-                    best_os_match = osmatch_tag.attrib["name"]
-                    best_os_match_acc = osmatch_accuracy
-            nmap_ports_db.execute("UPDATE hosts SET os=?,osconf=? " + 
-                "WHERE ip=?;", (best_os_match, best_os_match_acc, 
-                                host_ip_address))
+    return int(finished_tag.attrib["time"].strip())
+
+def check_nmap_xml(nmap_xml_file: pathlib.Path,
+                   ingested_row: typing.Optional[tuple]) \
+        -> typing.Optional[NmapXmlChanges]:
+    """
+    Works out what is new in a file since it was last ingested. A file
+    with the same size and modification time is skipped without reading
+    it, and one with the same content without parsing it. If an unfinished
+    scan was appended to, only the hosts after the ones already ingested
+    are read.
+
+    :param nmap_xml_file: The XML file outputted from Nmap
+    :param ingested_row: The (size, mtime, hash, hostsend, finished,
+                         provisionaltime) of the file in ingested_files, or
+                         None to ingest it all
+    :return: What is new, or None if the file is unchanged.
+    """
+    nmap_xml_stat: os.stat_result = nmap_xml_file.stat()
+    if ingested_row is not None and \
+            ingested_row[0] == nmap_xml_stat.st_size and \
+            ingested_row[1] == nmap_xml_stat.st_mtime_ns:
+        return None
+
+    file_hash = hashlib.sha256()
+    ingested_hash: typing.Optional[str] = None
+    """Hash of as many bytes as were there when the file was ingested"""
+    if ingested_row is not None and ingested_row[0] == 0:
+        ingested_hash = file_hash.hexdigest()
+    file_size: int = 0
+    hosts_end: int = 0
+    """Offset right after the last </host>"""
+    file_tail: bytes = b""
+    """The last bytes read, to find tags split across chunks and the
+    <runstats> at the end"""
+    with open(nmap_xml_file, "rb") as xml_file:
+        while (chunk := xml_file.read(READ_CHUNK_SIZE)) != b"":
+            if ingested_row is not None and \
+                    file_size < ingested_row[0] <= file_size + len(chunk):
+                ingested_file_hash = file_hash.copy()
+                ingested_file_hash.update(chunk[:ingested_row[0] - file_size])
+                ingested_hash = ingested_file_hash.hexdigest()
+            file_hash.update(chunk)
+            search_bytes: bytes = file_tail + chunk
+            host_end_index: int = search_bytes.rfind(HOST_END_TAG)
+            if host_end_index != -1:
+                hosts_end = file_size - len(file_tail) + host_end_index + \
+                        len(HOST_END_TAG)
+            file_size += len(chunk)
+            file_tail = search_bytes[-RUNSTATS_TAIL_SIZE:]
+    content_hash: str = file_hash.hexdigest()
+    finished: bool = file_tail.rstrip().endswith(b"</nmaprun>")
+
+    previous_provisional_time: typing.Optional[int] = None
+    if ingested_row is not None and not ingested_row[4]:
+        previous_provisional_time = ingested_row[5]
+    if ingested_row is not None and ingested_row[2] == content_hash:
+        # Only the modification time changed
+        return NmapXmlChanges(None, 0, False, previous_provisional_time,
+                              (file_size, nmap_xml_stat.st_mtime_ns,
+                               content_hash) + tuple(ingested_row[3:]))
+    start_offset: int = 0
+    if previous_provisional_time is not None and \
+            ingested_hash == ingested_row[2]:
+        start_offset = ingested_row[3]
+    scan_time_utc: int
+    provisional_time: typing.Optional[int] = None
+    if finished:
+        scan_time_utc = read_finish_time(file_tail)
+    else:
+        # Keep the time the first hosts of the scan were given, so all of
+        # them are updated together once it finishes
+        provisional_time = previous_provisional_time \
+                if start_offset > 0 and previous_provisional_time is not None \
+                else nmap_xml_stat.st_mtime_ns // 1000000000
+        scan_time_utc = provisional_time
+    nmap_xml_reader: typing.Optional[NmapXmlReader] = None
+    if finished or hosts_end > start_offset:
+        nmap_xml_reader = NmapXmlReader(nmap_xml_file, start_offset,
+                                        None if finished else hosts_end)
+    return NmapXmlChanges(nmap_xml_reader, scan_time_utc, start_offset == 0,
+                          previous_provisional_time,
+                          (file_size, nmap_xml_stat.st_mtime_ns,
+                           content_hash, max(hosts_end, start_offset),
+                           int(finished), provisional_time))
+
+def ingested_file_key(nmap_xml_file: pathlib.Path) -> str:
+    """
+    :return: The path of the file in ingested_files.
+    """
+    return str(nmap_xml_file.resolve())
+
+def get_ingested_row(nmap_ports_db: sqlite3.Connection,
+                     nmap_xml_file: pathlib.Path) -> typing.Optional[tuple]:
+    """
+    :return: The (size, mtime, hash, hostsend, finished, provisionaltime)
+             of the file in ingested_files, or None if it was never
+             ingested.
+    """
+    return nmap_ports_db.execute("SELECT size, mtime, hash, hostsend, " + 
+                                 "finished, provisionaltime FROM " + 
+                                 "ingested_files WHERE path=?;",
+                                 (ingested_file_key(nmap_xml_file),)) \
+            .fetchone()
+
+def write_hosts(nmap_ports_db: sqlite3.Connection,
+                parsed_hosts: typing.Iterable[tuple[tuple,
+                        typing.Optional[list[tuple]]]],
+                scan_time_utc: int,
+                unfinished_path: typing.Optional[str] = None) -> int:
+    """
+    Writes hosts as parse_host returns them with executemany, a batch of
+    HOST_BATCH_SIZE at a time, replacing the ports of each host that has
+    <ports> with its open ports. Doesn't commit.
+
+    :param nmap_ports_db: The database with the ports
+    :param parsed_hosts: The hosts and their port rows
+    :param scan_time_utc: The scan time to give the hosts
+    :param unfinished_path: If the hosts are from an unfinished scan, the
+                            path of its file in ingested_files, to record
+                            them in unfinished_hosts
+    :return: The number of hosts written
+    """
+    host_count: int = 0
+    host_rows: dict[str, tuple] = {}
+    """Maps IPs of the hosts not written yet to their host rows"""
+    port_rows: dict[str, list[tuple]] = {}
+    """Maps IPs of the hosts not written yet to their port rows"""
+    def write_batch() -> None:
+        nmap_ports_db.executemany(UPSERT_HOST_STATEMENT, host_rows.values())
+        if unfinished_path is not None:
+            nmap_ports_db.executemany(INSERT_UNFINISHED_HOST_STATEMENT,
+                                      ((unfinished_path, ip)
+                                       for ip in host_rows))
+        nmap_ports_db.executemany(DELETE_PORTS_STATEMENT,
+                                  ((ip,) for ip in port_rows))
+        nmap_ports_db.executemany(UPSERT_PORT_STATEMENT, (
+                port_row for ip_port_rows in port_rows.values()
+                for port_row in ip_port_rows))
+        host_rows.clear()
+        port_rows.clear()
+    for host_row, host_port_rows in parsed_hosts:
+        if host_row[0] in host_rows or len(host_rows) >= HOST_BATCH_SIZE:
+            # Write the batch first so a repeated host replaces the earlier
+            # one like it would in a later scan
+            write_batch()
+        host_rows[host_row[0]] = host_row + (scan_time_utc,)
+        if host_port_rows is not None:
+            port_rows[host_row[0]] = host_port_rows
+        host_count += 1
+    write_batch()
+    return host_count
+
+def write_nmap_xml(nmap_ports_db: sqlite3.Connection,
+                   nmap_xml_file: pathlib.Path,
+                   nmap_xml_changes: NmapXmlChanges,
+                   parsed_hosts: typing.Iterable[tuple[tuple,
+                           typing.Optional[list[tuple]]]]) -> int:
+    """
+    Writes the new hosts of a file and records it in ingested_files. Once
+    an unfinished scan has finished, the hosts ingested from it before
+    that still have its provisional scan time get its finish time. Doesn't
+    commit.
+
+    :param nmap_ports_db: The database with the ports
+    :param nmap_xml_file: The XML file outputted from Nmap
+    :param nmap_xml_changes: What is new in it, from check_nmap_xml
+    :param parsed_hosts: The new hosts and their port rows
+    :return: The number of hosts written
+    """
+    path_key: str = ingested_file_key(nmap_xml_file)
+    finished: bool = bool(nmap_xml_changes.ingested_row[4])
+    if nmap_xml_changes.previous_provisional_time is not None and \
+            (finished or nmap_xml_changes.restarted):
+        if finished and not nmap_xml_changes.restarted:
+            nmap_ports_db.execute("UPDATE hosts SET scantime=? WHERE " + 
+                                  "scantime=? AND ip IN (SELECT ip FROM " + 
+                                  "unfinished_hosts WHERE path=?);",
+                                  (nmap_xml_changes.scan_time_utc,
+                                   nmap_xml_changes.previous_provisional_time,
+                                   path_key))
+        nmap_ports_db.execute("DELETE FROM unfinished_hosts WHERE path=?;",
+                              (path_key,))
+    host_count: int = write_hosts(nmap_ports_db, parsed_hosts,
+                                  nmap_xml_changes.scan_time_utc,
+                                  None if finished else path_key)
+    nmap_ports_db.execute(UPSERT_INGESTED_FILE_STATEMENT,
+                          (path_key,) + nmap_xml_changes.ingested_row)
+    return host_count
+
+def ingest_nmap_xml(nmap_ports_db: sqlite3.Connection,
+                    nmap_xml_file: pathlib.Path,
+                    force: bool = False) -> typing.Optional[int]:
+    """
+    Streams the new hosts of the Nmap XML output into the database and
+    records them in ingested_files, in one transaction. Hosts of a scan
+    that hasn't finished get the file's modification time as scan time
+    until it does.
+
+    :param nmap_ports_db: The database with the ports
+    :param nmap_xml_file: The XML file outputted from Nmap
+    :param force: Whether to ingest the whole file even if it was already
+    :return: The number of hosts ingested, or None if the file is unchanged
+    """
+    ingested_row: typing.Optional[tuple] = \
+            get_ingested_row(nmap_ports_db, nmap_xml_file)
+    if force and ingested_row is not None:
+        # Still drop the hosts recorded for an unfinished scan
+        ingested_row = (-1, -1, "") + tuple(ingested_row[3:])
+    nmap_xml_changes: typing.Optional[NmapXmlChanges] = \
+            check_nmap_xml(nmap_xml_file, ingested_row)
+    if nmap_xml_changes is None:
+        return None
+    try:
+        host_count: int = write_nmap_xml(
+                nmap_ports_db, nmap_xml_file, nmap_xml_changes,
+                nmap_xml_changes.nmap_xml_reader
+                if nmap_xml_changes.nmap_xml_reader is not None else [])
+    except BaseException:
+        nmap_ports_db.rollback()
+        raise
+    nmap_ports_db.commit()
+    return host_count
+
+def parse_nmap_xml(nmap_xml_file_row: tuple[pathlib.Path,
+                                            typing.Optional[tuple]]) \
+        -> tuple[pathlib.Path, typing.Optional[NmapXmlChanges],
+                 list[tuple[tuple, typing.Optional[list[tuple]]]],
+                 typing.Optional[str]]:
+    """
+    Reads the new hosts of Nmap XML output, in a worker process. Files
+    over WORKER_PARSE_MAX_SIZE are only checked, and keep their reader for
+    the writer to stream the hosts from.
+
+    :param nmap_xml_file_row: The XML file outputted from Nmap and its row
+                              in ingested_files, as for check_nmap_xml
+    :return: The file, what is new in it (None if it is unchanged or
+             couldn't be read), the new hosts and their port rows, and why
+             the file couldn't be read, if it couldn't.
+    """
+    nmap_xml_file, ingested_row = nmap_xml_file_row
+    try:
+        nmap_xml_changes: typing.Optional[NmapXmlChanges] = \
+                check_nmap_xml(nmap_xml_file, ingested_row)
+        if nmap_xml_changes is None or \
+                nmap_xml_changes.nmap_xml_reader is None or \
+                nmap_xml_changes.ingested_row[0] > WORKER_PARSE_MAX_SIZE:
+            return (nmap_xml_file, nmap_xml_changes, [], None)
+        parsed_hosts: list[tuple[tuple, typing.Optional[list[tuple]]]] = \
+                list(nmap_xml_changes.nmap_xml_reader)
+    except (OSError, ValueError, ElementTree.ParseError) as e:
+        return (nmap_xml_file, None, [], str(e))
+    # The reader only points at the file, which the writer doesn't need
+    nmap_xml_changes.nmap_xml_reader = None
+    return (nmap_xml_file, nmap_xml_changes, parsed_hosts, None)
+
+def ingest_nmap_xml_files(nmap_ports_db: sqlite3.Connection,
+                          nmap_xml_files: list[pathlib.Path],
+                          jobs: int, force: bool = False) -> tuple[int, int]:
+    """
+    Parses the new hosts of the files in a pool of processes and writes
+    them from this process, the only one writing to the database. Files
+    are written in order, each together with its row in ingested_files,
+    and committed every HOST_BATCH_SIZE hosts. Only PENDING_TASKS_PER_JOB
+    tasks per process are parsed ahead of the writer, and files over
+    WORKER_PARSE_MAX_SIZE are streamed by the writer in a transaction of
+    their own, so memory stays flat however large the files are. Files
+    that can't be read are skipped.
+
+    :param nmap_ports_db: The database with the ports
+    :param nmap_xml_files: The XML files outputted from Nmap
+    :param jobs: The number of processes parsing files
+    :param force: Whether to ingest whole files even if they were already
+    :return: The number of files that were unchanged and that were skipped
+    """
+    ingested_rows: dict[str, tuple] = {}
+    """Maps paths to their rows in ingested_files"""
+    for ingested_row in nmap_ports_db.execute("SELECT path, size, " + 
+            "mtime, hash, hostsend, finished, provisionaltime " + 
+            "FROM ingested_files;"):
+        ingested_rows[ingested_row[0]] = ingested_row[1:]
+        if force:
+            # Still drop the hosts recorded for an unfinished scan
+            ingested_rows[ingested_row[0]] = \
+                    (-1, -1, "") + tuple(ingested_row[4:])
+    unchanged_count: int = 0
+    changed_files: list[tuple[pathlib.Path, typing.Optional[tuple]]] = []
+    """The files that may have changed, with their rows in ingested_files"""
+    for nmap_xml_file in nmap_xml_files:
+        ingested_row: typing.Optional[tuple] = \
+                ingested_rows.get(ingested_file_key(nmap_xml_file))
+        if ingested_row is not None:
+            # Leave the files with the same size and modification time out
+            # here so they aren't even sent to the pool
+            try:
+                nmap_xml_stat: os.stat_result = nmap_xml_file.stat()
+            except OSError:
+                pass
+            else:
+                if ingested_row[0] == nmap_xml_stat.st_size and \
+                        ingested_row[1] == nmap_xml_stat.st_mtime_ns:
+                    unchanged_count += 1
+                    continue
+        changed_files.append((nmap_xml_file, ingested_row))
+    if len(changed_files) == 0:
+        return (unchanged_count, 0)
+
+    skipped_count: int = 0
+    uncommitted_count: int = 0
+    """Number of hosts and files written since the last commit"""
+    pool_size: int = min(jobs, len(changed_files))
+    with multiprocessing.Pool(pool_size) as pool:
+        pending_tasks: collections.deque[
+                multiprocessing.pool.MapResult] = collections.deque()
+        """Tasks of FILES_PER_TASK files being parsed, in the order they
+        are written"""
+        next_file_index: int = 0
+        parsed_files: collections.deque[tuple] = collections.deque()
+        """Parsed files of the task being written"""
+        while len(parsed_files) > 0 or len(pending_tasks) > 0 or \
+                next_file_index < len(changed_files):
+            while next_file_index < len(changed_files) and \
+                    len(pending_tasks) < pool_size * PENDING_TASKS_PER_JOB:
+                pending_tasks.append(pool.map_async(parse_nmap_xml,
+                        changed_files[next_file_index:
+                                      next_file_index + FILES_PER_TASK],
+                        chunksize=FILES_PER_TASK))
+                next_file_index += FILES_PER_TASK
+            if len(parsed_files) == 0:
+                # Taking the results in the order the files were given
+                # means a host in several files ends up as in the last one
+                parsed_files.extend(pending_tasks.popleft().get())
+            nmap_xml_file, nmap_xml_changes, parsed_hosts, error = \
+                    parsed_files.popleft()
+            if error is None and nmap_xml_changes is not None and \
+                    nmap_xml_changes.nmap_xml_reader is not None:
+                # A large file left for the writer to stream, in a
+                # transaction of its own so a parse error part way through
+                # only rolls back this file
+                nmap_ports_db.commit()
+                uncommitted_count = 0
+                try:
+                    write_nmap_xml(nmap_ports_db, nmap_xml_file,
+                                   nmap_xml_changes,
+                                   nmap_xml_changes.nmap_xml_reader)
+                except (OSError, ValueError, ElementTree.ParseError) as e:
+                    nmap_ports_db.rollback()
+                    error = str(e)
+                else:
+                    nmap_ports_db.commit()
+                    continue
+            if error is not None:
+                print(f"ERROR: Skipped {nmap_xml_file}: {error}",
+                      file=sys.stderr)
+                skipped_count += 1
+                continue
+            if nmap_xml_changes is None:
+                unchanged_count += 1
+                continue
+            uncommitted_count += write_nmap_xml(nmap_ports_db, nmap_xml_file,
+                                                nmap_xml_changes,
+                                                parsed_hosts) + 1
+            if uncommitted_count >= HOST_BATCH_SIZE:
+                nmap_ports_db.commit()
+                uncommitted_count = 0
     nmap_ports_db.commit()
+    return (unchanged_count, skipped_count)
+
+def find_nmap_xml_files(paths: list[str]) -> list[pathlib.Path]:
+    """
+    :param paths: XML files, directories with XML files in them at any
+                  depth, and glob patterns, which may contain **
+    :return: The XML files, sorted within each path and without duplicates.
+    """
+    nmap_xml_files: dict[pathlib.Path, None] = {}
+    """The files found in order, as a dict to leave out duplicates"""
+    for path_str in paths:
+        path: pathlib.Path = pathlib.Path(path_str)
+        if path.is_dir():
+            found_files: list[pathlib.Path] = sorted(path.rglob("*.xml"))
+        elif path.exists():
+            found_files = [path]
+        else:
+            found_files = sorted(pathlib.Path(found_file) for found_file in
+                                 glob.glob(path_str, recursive=True))
+        for found_file in found_files:
+            nmap_xml_files[found_file] = None
+    return list(nmap_xml_files)
+
+def main(argv: list[str]) -> int:
+    argparser: argparse.ArgumentParser = argparse.ArgumentParser()
+    argparser.add_argument("--sqlite-db", type=pathlib.Path,
+                           default="nmapports.db",
+                           help="The database file with the ports.")
+    argparser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                           help="Number of processes parsing XML files " +
+                           "when given more than one.")
+    argparser.add_argument("--force", action="store_true",
+                           help="Ingest the files even if they are " +
+                           "unchanged since they were last ingested.")
+    argparser.add_argument("nmap_xml_files", nargs="+",
+                           help="The XML files outputted from Nmap, " +
+                           "directories with them, or glob patterns")
+    parsedargs: dict[str, typing.Any] = vars(argparser.parse_args(argv[1:]))
+
+    nmap_xml_files: list[pathlib.Path] = \
+            find_nmap_xml_files(parsedargs["nmap_xml_files"])
+    if len(nmap_xml_files) == 0:
+        print("ERROR: No XML files found", file=sys.stderr)
+        return 1
 
+    nmap_ports_db: sqlite3.Connection = init_db(parsedargs["sqlite_db"])
+    skipped_count: int = 0
+    if len(nmap_xml_files) == 1:
+        try:
+            ingest_nmap_xml(nmap_ports_db, nmap_xml_files[0],
+                            parsedargs["force"])
+        except (OSError, ValueError, ElementTree.ParseError) as e:
+            print(f"ERROR: Skipped {nmap_xml_files[0]}: {e}",
+                  file=sys.stderr)
+            skipped_count = 1
+    else:
+        skipped_count = ingest_nmap_xml_files(nmap_ports_db, nmap_xml_files,
+                                              max(parsedargs["jobs"], 1),
+                                              parsedargs["force"])[1]
     nmap_ports_db.close()
 
-    return 0
+    return 1 if skipped_count > 0 else 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))